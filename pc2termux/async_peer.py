@@ -0,0 +1,413 @@
+"""
+asyncio engine: the same chat, handshake and file protocol as Peer, but
+every connection is a coroutine on one event loop instead of a thread.
+Streams apply backpressure through drain() and StreamReader limits, and a
+semaphore caps how many incoming transfers are read at once, so memory
+stays bounded under bursts of uploads. The chat and file connections are
+encrypted with the SPAKE2 session key, as in the threaded engine.
+"""
+import asyncio
+import os
+from utils import get_local_ip, generate_password, get_serveo_command
+from discovery import Discovery
+from constants import (DEFAULT_PORT, DEFAULT_FILE_PORT, ASYNC_CHUNK, ASYNC_MAX_TRANSFERS,
+                       ASYNC_STREAM_LIMIT, HANDSHAKE_TIMEOUT, CRYPTO_RECORD_SIZE)
+from chat import (TEXT, CONTROL, ACK, PING, FILE_OFFER, STREAM_OPEN, STREAM_CLOSE,
+                  encode_frame, read_frame)
+from filetransfer import (_Checkpoint, _format_header, _format_options, _matching_offset,
+                          _parse_header, _parse_options, _preallocate)
+from secure import (Session, Spake2, available_ciphers, pick_cipher, plaintext_note,
+                    wrap_streams, secure_incoming_streams, secure_outgoing_streams)
+
+
+async def _ainput(prompt=''):
+    return await asyncio.get_running_loop().run_in_executor(None, input, prompt)
+
+
+async def _read_control(reader):
+    """The next CONTROL frame as (verb, arg), or (None, '') on timeout or anything else."""
+    try:
+        frame = await asyncio.wait_for(read_frame(reader), HANDSHAKE_TIMEOUT)
+    except (asyncio.TimeoutError, ValueError, OSError):
+        frame = None
+    if frame is None or frame[0] != CONTROL:
+        return None, ''
+    verb, _, arg = frame[1].decode(errors='replace').partition(' ')
+    return verb, arg
+
+
+async def _send_control(writer, text):
+    writer.write(encode_frame(CONTROL, text))
+    await writer.drain()
+
+
+async def client_handshake(reader, writer, password):
+    """chat.client_handshake for streams; returns (ok, features or reason, session)."""
+    spake = Spake2(password, initiator=True)
+    offered = ','.join(available_ciphers())
+    await _send_control(writer, f"spake2 {spake.message()} {offered}")
+    verb, arg = await _read_control(reader)
+    if verb != 'spake2':
+        return False, arg or verb or "No handshake reply", None
+    try:
+        message, cipher, confirm = arg.split(' ')
+        if cipher not in offered.split(','):
+            raise ValueError(cipher)
+        spake.finish(message, offered, cipher)
+    except ValueError:
+        return False, "Malformed handshake reply", None
+    if not spake.check(confirm):
+        await _send_control(writer, "error Wrong password")
+        return False, "Wrong password (or the handshake was tampered with)", None
+    await _send_control(writer, f"confirm {spake.confirm}")
+    verb, arg = await _read_control(reader)
+    if verb != 'ok':
+        return False, arg or verb or "No handshake reply", None
+    return True, arg, Session(spake.key, cipher)
+
+
+async def server_handshake(reader, writer, password, features='single'):
+    """
+    chat.server_handshake for streams; returns (ok, reason, session). The
+    'single' feature tells clients this host takes one plain file per
+    connection, so they don't stripe or batch.
+    """
+    verb, arg = await _read_control(reader)
+    if verb == 'auth':
+        await _send_control(writer, "error Unsupported handshake (update pc2termux)")
+        return False, "old client", None
+    if verb != 'spake2':
+        return False, "No handshake", None
+    message, _, offered = arg.partition(' ')
+    cipher = pick_cipher(offered.split(','))
+    if cipher is None:
+        await _send_control(writer, "error No common cipher")
+        return False, "no common cipher", None
+    spake = Spake2(password, initiator=False)
+    try:
+        spake.finish(message, offered, cipher)
+    except ValueError as e:
+        await _send_control(writer, f"error {e}")
+        return False, str(e).lower(), None
+    await _send_control(writer, f"spake2 {spake.message()} {cipher} {spake.confirm}")
+    verb, arg = await _read_control(reader)
+    if verb != 'confirm' or not spake.check(arg):
+        if verb == 'confirm':
+            await _send_control(writer, "error Wrong password")
+        return False, "wrong password", None
+    await _send_control(writer, f"ok {features}".strip())
+    return True, '', Session(spake.key, cipher)
+
+
+async def receive_file(reader, writer, save_dir='received_files'):
+    """
+    Receive one file from an accepted stream pair. Speaks the plain and
+    resumable single-file protocol; batch, striped and stream headers are
+    refused so the sender reports a clean error. Returns (success, message).
+    """
+    loop = asyncio.get_running_loop()
+    line = await reader.readline()
+    if not line:
+        return False, "No data"
+    filename, filesize, options = _parse_header(line.decode().rstrip('\n'))
+    if options.get('batch') or options.get('stripe') or options.get('stream'):
+        writer.write(b"refused=unsupported by the async engine\n")
+        await writer.drain()
+        return False, "Batch/striped/stream transfers need the threaded engine"
+    os.makedirs(save_dir, exist_ok=True)
+    filepath = os.path.join(save_dir, filename)
+    resume = bool(options.get('resume'))
+    target = filepath + '.part' if resume else filepath
+    f = open(target, 'r+b' if resume and os.path.exists(target) else 'w+b')
+    try:
+        await loop.run_in_executor(None, _preallocate, f, filesize)
+        start = 0
+        ckpt = None
+        if resume:
+            ckpt = _Checkpoint.load(target + '.ckpt', filesize, int(options.get('mtime', 0)))
+            await loop.run_in_executor(None, ckpt.verify, f)
+            reply = {'offset': ckpt.offset, 'blocks': ','.join(ckpt.hashes), 'codec': 'none'}
+            writer.write((_format_options(reply) + '\n').encode())
+            await writer.drain()
+            line = await reader.readline()
+            start = int(_parse_options(line.decode().rstrip('\n')).get('start', -1))
+            if start < 0 or start > ckpt.offset:
+                return False, f"Bad resume offset {start}"
+            ckpt.rewind(start)
+        elif options:
+            writer.write(b"codec=none\n")
+            await writer.drain()
+
+        def write_at(data, offset):
+            f.seek(offset)
+            f.write(data)
+            if ckpt:
+                ckpt.feed(data)
+
+        received = start
+        while received < filesize:
+            data = await reader.read(min(ASYNC_CHUNK, filesize - received))
+            if not data:
+                break
+            await loop.run_in_executor(None, write_at, data, received)
+            received += len(data)
+    finally:
+        f.close()
+
+    if received != filesize:
+        return False, f"File transfer incomplete ({received}/{filesize} bytes)"
+    if resume:
+        os.replace(target, filepath)
+        ckpt.remove()
+        writer.write(b"ok\n")
+        await writer.drain()
+    return True, f"File received: {filename}"
+
+
+async def send_file(host, port, filepath, resume=True, session=None):
+    """
+    Send one file to a file server with loop.sendfile (zero-copy where
+    possible), or encrypted record by record when the session has a cipher.
+    """
+    if not os.path.isfile(filepath):
+        return False, "File not found"
+    loop = asyncio.get_running_loop()
+    filename = os.path.basename(filepath)
+    filesize = os.path.getsize(filepath)
+    options = {'resume': 1, 'mtime': int(os.path.getmtime(filepath))} if resume else {}
+    reader, writer = await asyncio.open_connection(host, port, limit=ASYNC_STREAM_LIMIT)
+    try:
+        if session:
+            reader, writer = await secure_outgoing_streams(session, reader, writer)
+        writer.write(_format_header(filename, filesize, options))
+        await writer.drain()
+        with open(filepath, 'rb') as f:
+            start = 0
+            if resume:
+                reply = _parse_options((await reader.readline()).decode().rstrip('\n'))
+                blocks = reply.get('blocks', '')
+                start = await loop.run_in_executor(
+                    None, _matching_offset, f, filesize, blocks.split(',') if blocks else [])
+                writer.write(f"start={start}\n".encode())
+                await writer.drain()
+            if filesize > start and session and session.encrypted:
+                f.seek(start)
+                while True:
+                    data = await loop.run_in_executor(None, f.read, CRYPTO_RECORD_SIZE)
+                    if not data:
+                        break
+                    writer.write(data)
+                    await writer.drain()
+            elif filesize > start:
+                await loop.sendfile(writer.transport, f, start, filesize - start)
+        if resume and (await reader.readline()).strip() != b'ok':
+            return False, "Receiver did not confirm the transfer"
+    except OSError as e:
+        return False, str(e)
+    finally:
+        writer.close()
+    return True, f"File '{filename}' sent"
+
+
+async def serve_files(host, port, save_dir='received_files', on_result=None, secure=None):
+    """
+    Start an asyncio file server; at most ASYNC_MAX_TRANSFERS are read at
+    once. With `secure`, a callable returning the current sessions (none
+    while nobody is connected), only transfers encrypted with one of them
+    are accepted.
+    """
+    slots = asyncio.Semaphore(ASYNC_MAX_TRANSFERS)
+
+    async def handle(reader, writer):
+        # don't let queued connections fill their read buffers while they wait
+        writer.transport.pause_reading()
+        async with slots:
+            writer.transport.resume_reading()
+            try:
+                if secure:
+                    sessions = secure()
+                    if not sessions:
+                        raise ConnectionError("Transfer refused: not connected")
+                    reader, writer = await secure_incoming_streams(sessions, reader, writer)
+                result = await receive_file(reader, writer, save_dir)
+            except Exception as e:
+                result = (False, str(e))
+            finally:
+                writer.close()
+        if on_result:
+            on_result(*result)
+
+    return await asyncio.start_server(handle, host, port, limit=ASYNC_STREAM_LIMIT,
+                                      reuse_address=True)
+
+
+class AsyncPeer:
+    def __init__(self):
+        self.ip = get_local_ip()
+        self.discovery = Discovery()
+        self.discovery.find_public_ip(self.ip)
+        self.port = DEFAULT_PORT
+        self.file_port = DEFAULT_FILE_PORT
+        self.password = generate_password(4)
+        self.connected = False
+        self.remote_ip = None
+        self.reader = None
+        self.writer = None
+        self.session = None
+        self.tunnel = False  # hosting through serveo: only the chat port is reachable
+        self.transfers = set()
+
+    def start(self):
+        asyncio.run(self._main())
+
+    @staticmethod
+    def _report_file(success, msg):
+        if success:
+            print(f"\n[File] {msg}")
+        else:
+            print(f"\n[File error] {msg}")
+
+    async def _main(self):
+        try:
+            file_server = await serve_files(self.ip, self.file_port, on_result=self._report_file,
+                                            secure=lambda: [self.session] if self.session else [])
+        except OSError as e:
+            print(f"File server error: {e}")
+            file_server = None
+        print(f"Your local IP: {self.ip}")
+        public_ip = self.discovery.public_ip() or "looking it up in the background"
+        print(f"Your public IP: {public_ip} (if behind NAT, this may not be reachable directly)")
+        choice = (await _ainput("Host (h) or Connect (c)? ")).strip().lower()
+        if choice == 'h':
+            await self._host()
+        elif choice == 'c':
+            remote_ip = (await _ainput("Enter remote IP or hostname: ")).strip()
+            remote_port_input = (await _ainput(f"Enter remote port (default {DEFAULT_PORT}): ")).strip()
+            remote_port = int(remote_port_input) if remote_port_input else DEFAULT_PORT
+            remote_password = (await _ainput("Enter remote password: ")).strip()
+            await self._connect(remote_ip, remote_port, remote_password)
+        else:
+            print("Invalid choice")
+        if file_server:
+            file_server.close()
+
+    async def _host(self):
+        use_serveo = (await _ainput("Use serveo.net tunnel for easy internet access? (y/n): ")).strip().lower()
+        if use_serveo == 'y':
+            self.tunnel = True
+            print("Run this command in another terminal (SSH must be installed):")
+            print(get_serveo_command(self.port))
+            print("Only the chat port is forwarded. Files through the tunnel need the "
+                  "threaded engine, which carries them over the chat connection.")
+            await _ainput("Press Enter after the tunnel is established...")
+        partner = asyncio.get_running_loop().create_future()
+
+        async def on_chat(reader, writer):
+            if partner.done():
+                writer.close()  # one chat partner, as with the threaded engine
+                return
+            try:
+                ok, reason, session = await server_handshake(reader, writer, self.password)
+            except OSError as e:
+                ok, reason = False, str(e)
+            if ok and not partner.done():
+                self.session = session
+                partner.set_result(wrap_streams(session, reader, writer, b'chat', initiator=False))
+            else:
+                writer.close()
+                if reason != "No handshake":
+                    print(f"Handshake failed: {reason}")
+
+        server = await asyncio.start_server(on_chat, self.ip, self.port, reuse_address=True)
+        print(f"Hosting on {self.ip}:{self.port}")
+        print(f"Password: {self.password}")
+        print("Waiting for connection...")
+        self.reader, self.writer = await partner
+        server.close()
+        self.remote_ip = self.writer.get_extra_info('peername')[0]
+        print(f"Connected by {self.remote_ip}")
+        print("Handshake successful" + plaintext_note(self.session))
+        self.connected = True
+        await self._chat()
+
+    async def _connect(self, remote_ip, remote_port, password):
+        try:
+            reader, writer = await asyncio.open_connection(remote_ip, remote_port)
+            ok, reason, session = await client_handshake(reader, writer, password)
+        except OSError as e:
+            print(f"Connection error: {e}")
+            return
+        if not ok:
+            print(f"Handshake failed: {reason}")
+            writer.close()
+            return
+        self.session = session
+        self.reader, self.writer = wrap_streams(session, reader, writer, b'chat', initiator=True)
+        self.remote_ip = remote_ip
+        self.connected = True
+        print("Handshake successful" + plaintext_note(session))
+        await self._chat()
+
+    async def _receive_loop(self):
+        try:
+            while True:
+                frame = await read_frame(self.reader)
+                if frame is None or frame == (CONTROL, b'bye'):
+                    break
+                ftype, payload = frame
+                if ftype == TEXT:
+                    print(f"\n[Remote]: {payload.decode(errors='replace')}")
+                elif ftype == PING:
+                    self.writer.write(encode_frame(ACK, payload))
+                elif ftype == FILE_OFFER:
+                    name, _, size = payload.decode(errors='replace').partition('|')
+                    print(f"\n[Remote] is sending {name} ({size} bytes)")
+                elif ftype == STREAM_OPEN:
+                    # no multiplexed streams here; the peer's transfer fails cleanly
+                    self.writer.write(encode_frame(STREAM_CLOSE, payload))
+        except (OSError, ValueError):
+            pass
+        self.connected = False
+        print("\nDisconnected from remote peer.")
+
+    async def _chat(self):
+        receiver = asyncio.create_task(self._receive_loop())
+        print("\n--- Chat ready (async engine) ---")
+        print("Commands: /sendfile <path> [more paths...]  |  /quit")
+        while self.connected:
+            try:
+                msg = await _ainput()
+            except (KeyboardInterrupt, EOFError):
+                break
+            if msg.startswith("/sendfile"):
+                paths = msg.split()[1:]
+                if not paths:
+                    print("Usage: /sendfile <path> [more paths...]")
+                elif self.tunnel:
+                    print("Failed: the tunnel only forwards chat; use the threaded engine for files")
+                    paths = []
+                for path in paths:
+                    if os.path.isfile(path):
+                        self.writer.write(encode_frame(
+                            FILE_OFFER, f"{os.path.basename(path)}|{os.path.getsize(path)}"))
+                    task = asyncio.create_task(self._send_file(path))
+                    self.transfers.add(task)
+                    task.add_done_callback(self.transfers.discard)
+            elif msg == "/quit":
+                self.writer.write(encode_frame(CONTROL, "bye"))
+                break
+            else:
+                self.writer.write(encode_frame(TEXT, msg))
+                await self.writer.drain()
+        self.connected = False
+        receiver.cancel()
+        self.writer.close()
+        print("Disconnected.")
+
+    async def _send_file(self, filepath):
+        try:
+            success, msg = await send_file(self.remote_ip, self.file_port, filepath,
+                                           session=self.session)
+        except Exception as e:
+            success, msg = False, str(e)
+        print(msg if success else f"Failed: {msg}")
@@ -0,0 +1,1005 @@
+"""
+Loopback benchmarks for the file transfer paths.
+The full sweep with JSON output:  python main.py bench --help
+Single comparisons, run from this directory:
+    python bench.py [send|receive|striped|compress|async|framing|mux|verify|startup|crypto] [size_mb]
+"""
+import asyncio
+import collections
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from constants import BUFFER_SIZE, RECV_BUFFER_SIZE
+from filetransfer import FileTransfer
+from chat import Channel, FrameParser, TEXT, PING, ACK, encode_frame
+import mux
+import secure
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def _make_file(size_mb):
+    """Create a temporary file of `size_mb` MiB of random-ish data."""
+    fd, path = tempfile.mkstemp(prefix='pc2termux-bench-')
+    block = os.urandom(1024 * 1024)
+    with os.fdopen(fd, 'wb') as f:
+        for _ in range(size_mb):
+            f.write(block)
+    return path
+
+
+def _loopback_pair():
+    """Return (client, server) sockets connected over 127.0.0.1."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    return client, server
+
+
+def _drain(sock, result):
+    buf = bytearray(1024 * 1024)
+    total = 0
+    while True:
+        n = sock.recv_into(buf)
+        if not n:
+            break
+        total += n
+    result['received'] = total
+
+
+def legacy_send_file(sock, filepath):
+    """The original send loop: 4 KiB reads, send() with short writes ignored."""
+    filesize = os.path.getsize(filepath)
+    sock.send(f"{os.path.basename(filepath)}|{filesize}\n".encode())
+    with open(filepath, 'rb') as f:
+        sent = 0
+        while sent < filesize:
+            data = f.read(BUFFER_SIZE)
+            if not data:
+                break
+            sock.send(data)
+            sent += len(data)
+
+
+def _run_send(send, path):
+    client, server = _loopback_pair()
+    result = {}
+    drain = threading.Thread(target=_drain, args=(server, result))
+    drain.start()
+    cpu0 = time.thread_time()
+    t0 = time.perf_counter()
+    send(client, path)
+    client.shutdown(socket.SHUT_WR)
+    drain.join()
+    wall = time.perf_counter() - t0
+    cpu = time.thread_time() - cpu0
+    client.close()
+    server.close()
+    return wall, cpu, result['received']
+
+
+def bench_send(size_mb=256, rounds=3):
+    """Compare legacy, copy-loop and zero-copy send paths; returns result rows."""
+    path = _make_file(size_mb)
+    modes = [
+        ('legacy', legacy_send_file),
+        ('copy', lambda s, p: FileTransfer.send_file(s, p, zero_copy=False)),
+        ('sendfile', lambda s, p: FileTransfer.send_file(s, p, zero_copy=True)),
+    ]
+    rows = []
+    try:
+        for name, send in modes:
+            best = None
+            for _ in range(rounds):
+                wall, cpu, received = _run_send(send, path)
+                if best is None or wall < best[0]:
+                    best = (wall, cpu, received)
+            wall, cpu, received = best
+            rows.append({'mode': name, 'mb_per_s': received / wall / 1e6,
+                         'sender_cpu_s': cpu, 'wall_s': wall})
+    finally:
+        os.remove(path)
+    return rows
+
+
+def legacy_receive_file(sock, save_dir):
+    """The original receive loop: a fresh bytes object per recv, one write each."""
+    data = sock.recv(BUFFER_SIZE)
+    header_line, remaining = data.split(b'\n', 1)
+    filename, filesize = header_line.decode().split('|')
+    filesize = int(filesize)
+    with open(os.path.join(save_dir, filename), 'wb') as f:
+        f.write(remaining)
+        received = len(remaining)
+        while received < filesize:
+            data = sock.recv(min(BUFFER_SIZE, filesize - received))
+            if not data:
+                break
+            f.write(data)
+            received += len(data)
+    return received == filesize, ''
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def _receive_worker(port, save_dir, mode, buffer_size, results):
+    """Runs in a fresh process so its peak RSS belongs to the receiver alone."""
+    sock = socket.create_connection(('127.0.0.1', port))
+    t0 = time.perf_counter()
+    cpu0 = time.process_time()
+    if mode == 'legacy':
+        ok, _ = legacy_receive_file(sock, save_dir)
+    else:
+        ok, _ = FileTransfer.receive_file(sock, save_dir, buffer_size=buffer_size,
+                                          use_mmap=(mode == 'mmap'))
+    results.put({'ok': ok, 'wall_s': time.perf_counter() - t0,
+                 'cpu_s': time.process_time() - cpu0, 'peak_rss_mb': _peak_rss_mb()})
+    sock.close()
+
+
+def bench_receive(size_mb=1024, buffer_size=RECV_BUFFER_SIZE):
+    """Compare the legacy, buffered and mmap receive paths; returns result rows."""
+    path = _make_file(size_mb)
+    save_dir = tempfile.mkdtemp(prefix='pc2termux-recv-')
+    ctx = multiprocessing.get_context('spawn')
+    rows = []
+    try:
+        for mode in ('legacy', 'buffered', 'mmap'):
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            results = ctx.Queue()
+            worker = ctx.Process(target=_receive_worker,
+                                 args=(listener.getsockname()[1], save_dir, mode,
+                                       buffer_size, results))
+            worker.start()
+            conn, _ = listener.accept()
+            listener.close()
+            FileTransfer.send_file(conn, path)
+            result = results.get()
+            worker.join()
+            conn.close()
+            result['mode'] = mode
+            result['mb_per_s'] = size_mb * 1024 * 1024 / result['wall_s'] / 1e6
+            rows.append(result)
+            os.remove(os.path.join(save_dir, os.path.basename(path)))
+    finally:
+        os.remove(path)
+        shutil.rmtree(save_dir, ignore_errors=True)
+    return rows
+
+
+class DelayProxy:
+    """
+    Local TCP proxy that behaves like a long, window-limited path (netem
+    style): every chunk is held for `delay` seconds in each direction and
+    at most `window` bytes may be in flight per direction per connection,
+    so one stream tops out at roughly window / (2 * delay) bytes per second.
+    `rate` (bytes/s per direction per connection) additionally caps bandwidth.
+    """
+
+    def __init__(self, target, delay=0.05, window=256 * 1024, rate=None):
+        self.target = target
+        self.delay = delay
+        self.window = window
+        self.rate = rate
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(64)
+        self.address = self.listener.getsockname()
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(self.target)
+            for src, dst in ((client, upstream), (upstream, client)):
+                self._pipe(src, dst)
+
+    def _pipe(self, src, dst):
+        line = collections.deque()
+        cond = threading.Condition()
+        state = {'in_flight': 0, 'eof': False}
+
+        def reader():
+            while True:
+                try:
+                    data = src.recv(64 * 1024)
+                except OSError:
+                    data = b''
+                with cond:
+                    while data and state['in_flight'] + len(data) > self.window:
+                        cond.wait()
+                    if not data:
+                        state['eof'] = True
+                    else:
+                        state['in_flight'] += len(data)
+                        line.append((time.monotonic() + self.delay, data))
+                    cond.notify_all()
+                if not data:
+                    return
+
+        def writer():
+            free_at = time.monotonic()
+            while True:
+                with cond:
+                    while not line and not state['eof']:
+                        cond.wait()
+                    if not line:
+                        break
+                    due, data = line.popleft()
+                if self.rate:
+                    due = max(due, free_at)
+                    free_at = due + len(data) / self.rate
+                time.sleep(max(0.0, due - time.monotonic()))
+                try:
+                    dst.sendall(data)
+                except OSError:
+                    break
+                with cond:
+                    state['in_flight'] -= len(data)
+                    cond.notify_all()
+            try:
+                dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+        threading.Thread(target=reader, daemon=True).start()
+        threading.Thread(target=writer, daemon=True).start()
+
+    def close(self):
+        self.listener.close()
+
+
+def _file_server(save_dir):
+    """A bare FileTransfer receiver on loopback, one thread per connection."""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(64)
+
+    def handle(conn):
+        FileTransfer.receive_file(conn, save_dir)
+        conn.close()
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server
+
+
+def bench_striped(size_mb=64, delay=0.025, stream_counts=(1, 2, 4, 8)):
+    """Throughput of send_striped through a DelayProxy at fixed and adaptive N."""
+    path = _make_file(size_mb)
+    save_dir = tempfile.mkdtemp(prefix='pc2termux-stripe-')
+    server = _file_server(save_dir)
+    proxy = DelayProxy(server.getsockname(), delay=delay)
+    connect = lambda: socket.create_connection(proxy.address)
+    rows = []
+    try:
+        for streams in list(stream_counts) + [None]:
+            t0 = time.perf_counter()
+            ok, msg = FileTransfer.send_striped(connect, path, streams=streams)
+            wall = time.perf_counter() - t0
+            rows.append({'streams': streams or 'adaptive', 'ok': ok, 'detail': msg,
+                         'mb_per_s': size_mb * 1024 * 1024 / wall / 1e6})
+    finally:
+        proxy.close()
+        server.close()
+        os.remove(path)
+        shutil.rmtree(save_dir, ignore_errors=True)
+    return rows
+
+
+def _make_text_file(size_mb):
+    """A compressible corpus: log-like lines with varying numbers."""
+    fd, path = tempfile.mkstemp(prefix='pc2termux-bench-', suffix='.log')
+    with os.fdopen(fd, 'w') as f:
+        i = 0
+        while f.tell() < size_mb * 1024 * 1024:
+            f.write(f"2025-01-01 12:{i % 60:02d}:{i % 59:02d} INFO worker-{i % 8} "
+                    f"handled request id={i} bytes={i * 37 % 100000} status=ok\n")
+            i += 1
+    return path
+
+
+def bench_compression(size_mb=64, rate=20e6):
+    """Goodput of raw vs compressed send_file over a `rate`-limited proxy."""
+    save_dir = tempfile.mkdtemp(prefix='pc2termux-zip-')
+    server = _file_server(save_dir)
+    proxy = DelayProxy(server.getsockname(), delay=0.001, window=4 * 1024 * 1024, rate=rate)
+    corpora = [('text', _make_text_file(size_mb)), ('random', _make_file(size_mb))]
+    rows = []
+    try:
+        for corpus, path in corpora:
+            size = os.path.getsize(path)
+            for compress in (False, True):
+                sock = socket.create_connection(proxy.address)
+                t0 = time.perf_counter()
+                ok, msg = FileTransfer.send_file(sock, path, resume=True, compress=compress)
+                wall = time.perf_counter() - t0
+                sock.close()
+                rows.append({'corpus': corpus, 'mode': 'compressed' if compress else 'raw',
+                             'ok': ok, 'detail': msg, 'goodput_mb_per_s': size / wall / 1e6})
+    finally:
+        proxy.close()
+        server.close()
+        for _, path in corpora:
+            os.remove(path)
+        shutil.rmtree(save_dir, ignore_errors=True)
+    return rows
+
+
+def _engine_worker(engine, save_dir, count, ports, results):
+    """Receive `count` files with one engine and report its peak RSS and threads."""
+    import async_peer
+    peak_threads = threading.active_count()
+    if engine == 'async':
+        async def run():
+            done = asyncio.Event()
+            received = []
+
+            def on_result(success, msg):
+                received.append(success)
+                if len(received) == count:
+                    done.set()
+            server = await async_peer.serve_files('127.0.0.1', 0, save_dir, on_result)
+            ports.put(server.sockets[0].getsockname()[1])
+            await done.wait()
+            server.close()
+            return sum(received)
+        ok = asyncio.run(run())
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1024)
+        ports.put(server.getsockname()[1])
+        handlers = []
+        outcomes = []
+        for _ in range(count):
+            conn, _ = server.accept()
+            t = threading.Thread(target=lambda c=conn: (
+                outcomes.append(FileTransfer.receive_file(c, save_dir, use_mmap=False)[0]),
+                c.close()))
+            t.start()
+            handlers.append(t)
+            peak_threads = max(peak_threads, threading.active_count())
+        for t in handlers:
+            t.join()
+        ok = sum(outcomes)
+    results.put({'ok': ok, 'peak_rss_mb': _peak_rss_mb(), 'peak_threads': peak_threads})
+
+
+def bench_engines(count=300, size_kb=512):
+    """`count` simultaneous uploads into the threaded and the async file server."""
+    import async_peer
+    save_dir = tempfile.mkdtemp(prefix='pc2termux-engines-')
+    fd, path = tempfile.mkstemp(prefix='pc2termux-bench-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(os.urandom(size_kb * 1024))
+    ctx = multiprocessing.get_context('spawn')
+    rows = []
+    try:
+        for engine in ('threaded', 'async'):
+            ports, results = ctx.Queue(), ctx.Queue()
+            worker = ctx.Process(target=_engine_worker,
+                                 args=(engine, save_dir, count, ports, results))
+            worker.start()
+            port = ports.get()
+
+            async def burst():
+                return await asyncio.gather(*[
+                    async_peer.send_file('127.0.0.1', port, path, resume=False)
+                    for _ in range(count)])
+            t0 = time.perf_counter()
+            asyncio.run(burst())
+            result = results.get()
+            wall = time.perf_counter() - t0
+            worker.join()
+            result.update(engine=engine, wall_s=wall,
+                          mb_per_s=count * size_kb * 1024 / wall / 1e6)
+            rows.append(result)
+    finally:
+        os.remove(path)
+        shutil.rmtree(save_dir, ignore_errors=True)
+    return rows
+
+
+def _chat_rate(send, receive, count):
+    """Messages per second for `count` messages from a sender thread to receive()."""
+    a, b = socket.socketpair()
+    sender = threading.Thread(target=send, args=(a,))
+    t0 = time.perf_counter()
+    sender.start()
+    got = receive(b)
+    elapsed = time.perf_counter() - t0
+    sender.join()
+    a.close()
+    b.close()
+    assert got == count, f"received {got}/{count} messages"
+    return count / elapsed
+
+
+def bench_framing(count=200000, size=64):
+    """Chat messages per second: newline text (the old path) vs binary frames."""
+    msg = 'x' * size
+
+    def line_send(sock):
+        for _ in range(count):
+            sock.send((msg + "\n").encode())
+        sock.shutdown(socket.SHUT_WR)
+
+    def line_receive(sock):
+        return sum(1 for _ in sock.makefile('r'))
+
+    def frame_send(sock):
+        channel = Channel(sock)
+        for _ in range(count):
+            channel.send_text(msg)
+        sock.shutdown(socket.SHUT_WR)
+
+    def frame_receive(sock):
+        return sum(1 for ftype, _ in Channel(sock) if ftype == TEXT)
+
+    blob = encode_frame(TEXT, msg) * count
+    lines = (msg + "\n").encode() * count
+
+    def parse_frames():
+        parser = FrameParser()
+        n = 0
+        for i in range(0, len(blob), 65536):
+            parser.feed(blob[i:i + 65536])
+            n += sum(1 for _ in parser.frames())
+        return n
+
+    def parse_lines():
+        return len(io.BytesIO(lines).readlines())
+
+    rows = [
+        {'mode': 'lines', 'msgs_per_s': _chat_rate(line_send, line_receive, count)},
+        {'mode': 'frames', 'msgs_per_s': _chat_rate(frame_send, frame_receive, count)},
+    ]
+    for mode, parse in (('parse-lines', parse_lines), ('parse-frames', parse_frames)):
+        t0 = time.perf_counter()
+        assert parse() == count
+        rows.append({'mode': mode, 'msgs_per_s': count / (time.perf_counter() - t0)})
+    return rows
+
+
+def bench_mux(size_mb=32, windows=(64 * 1024, 256 * 1024, 512 * 1024, 1024 * 1024, 4 * 1024 * 1024),
+              rate=10e6, delay=0.01):
+    """
+    A file sent as a multiplexed stream over one shaped connection while
+    the other side is pinged every 20 ms: ping RTT shows how far chat has
+    to queue behind bulk data for each per-stream window size.
+    """
+    path = _make_file(size_mb)
+    save_dir = tempfile.mkdtemp(prefix='pc2termux-bench-')
+    rows = []
+    default_window = mux.MUX_WINDOW
+
+    def pump(m, channel, rtts, sent_at):
+        try:
+            for ftype, payload in channel:
+                if m.handle(ftype, payload):
+                    continue
+                if ftype == PING:
+                    m.send(ACK, bytes(payload))
+                elif ftype == ACK:
+                    sent = sent_at.pop(bytes(payload), None)
+                    if sent is not None:
+                        rtts.append(time.perf_counter() - sent)
+        except OSError:
+            pass  # shut down at the end of the round
+
+    try:
+        for window in windows:
+            mux.MUX_WINDOW = window
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            proxy = DelayProxy(listener.getsockname(), delay=delay, window=4 * 1024 * 1024,
+                               rate=rate)
+            client = Channel(socket.create_connection(proxy.address))
+            server = Channel(listener.accept()[0])
+            receiver = lambda stream: (FileTransfer.receive_file(stream, save_dir), stream.close())
+            sides = (mux.Mux(client, True, receiver), mux.Mux(server, False, receiver))
+            rtts = []
+            sent_at = {}
+            pumps = [threading.Thread(target=pump, args=(m, channel, rtts, sent_at), daemon=True)
+                     for m, channel in zip(sides, (client, server))]
+            for t in pumps:
+                t.start()
+            result = {}
+
+            def transfer():
+                stream = sides[0].open_stream()
+                t0 = time.perf_counter()
+                result['ok'] = FileTransfer.send_file(stream, path)[0]
+                result['wall'] = time.perf_counter() - t0
+                stream.close()
+
+            sender = threading.Thread(target=transfer)
+            sender.start()
+            seq = 0
+            while sender.is_alive():
+                token = seq.to_bytes(4, 'big')
+                sent_at[token] = time.perf_counter()
+                sides[0].send(PING, token)
+                seq += 1
+                time.sleep(0.02)
+            sender.join()
+            for channel in (client, server):
+                try:
+                    channel.sock.shutdown(socket.SHUT_RDWR)  # close() alone leaves recv blocked
+                except OSError:
+                    pass
+            for t in pumps:
+                t.join()
+            for channel in (client, server):
+                channel.sock.close()
+            listener.close()
+            proxy.close()
+            rtts.sort()
+            percentile = lambda q: rtts[min(int(len(rtts) * q), len(rtts) - 1)] * 1000 if rtts \
+                else float('nan')
+            rows.append({'window_kb': window // 1024, 'mb_per_s': size_mb * 1.048576 / result['wall'],
+                         'ping_p50_ms': percentile(0.5), 'ping_p99_ms': percentile(0.99),
+                         'ok': result['ok']})
+    finally:
+        mux.MUX_WINDOW = default_window
+        os.remove(path)
+        shutil.rmtree(save_dir, ignore_errors=True)
+    return rows
+
+
+def bench_verify(size_mb=256, rounds=3, rate=None):
+    """
+    End-to-end send_file + receive_file with and without verify=True
+    (best of `rounds`), straight over loopback or through the shaping
+    proxy when `rate` (bytes/s) is given.
+    """
+    path = _make_file(size_mb)
+    save_dir = tempfile.mkdtemp(prefix='pc2termux-bench-')
+    rows = []
+    try:
+        for use_mmap in (False, True):
+            for verify in (False, True):
+                best = None
+                for _ in range(rounds):
+                    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    listener.bind(('127.0.0.1', 0))
+                    listener.listen(1)
+                    address = listener.getsockname()
+                    proxy = DelayProxy(address, delay=0, window=16 * 1024 * 1024,
+                                       rate=rate) if rate else None
+                    result = {}
+
+                    def receive():
+                        conn, _ = listener.accept()
+                        result['recv'] = FileTransfer.receive_file(conn, save_dir,
+                                                                   use_mmap=use_mmap)
+                        conn.close()
+
+                    receiver = threading.Thread(target=receive)
+                    receiver.start()
+                    cpu0 = os.times()
+                    t0 = time.perf_counter()
+                    with socket.create_connection(proxy.address if proxy else address) as sock:
+                        ok, msg = FileTransfer.send_file(sock, path, verify=verify)
+                    receiver.join()
+                    wall = time.perf_counter() - t0
+                    cpu1 = os.times()
+                    listener.close()
+                    if proxy:
+                        proxy.close()
+                    assert ok and result['recv'][0], (msg, result['recv'])
+                    if best is None or wall < best[0]:
+                        best = (wall, (cpu1.user - cpu0.user) + (cpu1.system - cpu0.system))
+                rows.append({'receive': 'mmap' if use_mmap else 'buffered', 'verify': verify,
+                             'mb_per_s': size_mb * 1.048576 / best[0], 'cpu_s': best[1]})
+    finally:
+        os.remove(path)
+        shutil.rmtree(save_dir, ignore_errors=True)
+    return rows
+
+
+def bench_crypto(size_mb=64, record_sizes=(4096, 16384, 65536, 262144, 1048576), rounds=2,
+                 handshakes=20):
+    """
+    send_file + receive_file over loopback in plaintext (sendfile) and
+    through SecureSocket for each available cipher and record size (best
+    of `rounds`), plus the time a SPAKE2 handshake costs both sides.
+    """
+    path = _make_file(size_mb)
+    save_dir = tempfile.mkdtemp(prefix='pc2termux-bench-')
+    cases = [('plaintext', None)] + [(cipher, size) for cipher in secure.available_ciphers()
+                                     for size in record_sizes]
+    rows = []
+    try:
+        for cipher, record_size in cases:
+            best = None
+            for _ in range(rounds):
+                client, server = _loopback_pair()
+                if cipher != 'plaintext':
+                    key = os.urandom(32)
+                    client = secure.SecureSocket(client, secure.Sealer(cipher, key),
+                                                 secure.Sealer(cipher, key[::-1]),
+                                                 record_size=record_size)
+                    server = secure.SecureSocket(server, secure.Sealer(cipher, key[::-1]),
+                                                 secure.Sealer(cipher, key))
+                result = {}
+
+                def receive():
+                    result['recv'] = FileTransfer.receive_file(server, save_dir)
+
+                receiver = threading.Thread(target=receive)
+                receiver.start()
+                cpu0 = os.times()
+                t0 = time.perf_counter()
+                ok, msg = FileTransfer.send_file(client, path)
+                receiver.join()
+                wall = time.perf_counter() - t0
+                cpu1 = os.times()
+                client.close()
+                server.close()
+                assert ok and result['recv'][0], (msg, result['recv'])
+                if best is None or wall < best[0]:
+                    best = (wall, (cpu1.user - cpu0.user) + (cpu1.system - cpu0.system))
+            rows.append({'cipher': cipher, 'record_kb': record_size // 1024 if record_size else None,
+                         'mb_per_s': size_mb * 1.048576 / best[0], 'cpu_s': best[1]})
+    finally:
+        os.remove(path)
+        shutil.rmtree(save_dir, ignore_errors=True)
+    times = []
+    for _ in range(handshakes):
+        t0 = time.perf_counter()
+        client, server = secure.Spake2('bench', True), secure.Spake2('bench', False)
+        client.finish(server.message(), 'chacha20-poly1305', 'chacha20-poly1305')
+        server.finish(client.message(), 'chacha20-poly1305', 'chacha20-poly1305')
+        assert client.check(server.confirm) and server.check(client.confirm)
+        times.append(time.perf_counter() - t0)
+    rows.append({'cipher': 'spake2 handshake', 'record_kb': None,
+                 'ms': 1000 * sorted(times)[len(times) // 2]})
+    return rows
+
+
+def _time_to_prompt(cmd, env, prompt=b'(u)? '):
+    """Seconds from spawning `cmd` until `prompt` shows on its stdout."""
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, env=env)
+    seen = b''
+    try:
+        while prompt not in seen:
+            data = proc.stdout.read1(4096)
+            if not data:
+                return None
+            seen += data
+        return time.perf_counter() - t0
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def bench_startup(runs=10, offline=True):
+    """
+    Time from `python main.py` to the first prompt, with an empty and then
+    a warm discovery cache. With `offline`, each run gets an empty network
+    namespace (needs `unshare`), so nothing is reachable.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    base = [sys.executable, os.path.join(here, 'main.py')]
+    # time the namespace itself too, so it can be told apart from our start-up
+    noop = [sys.executable, '-c', "print('(u)? ', flush=True)"]
+    if offline:
+        if not shutil.which('unshare') or subprocess.call(['unshare', '-rn', 'true'],
+                                                           stderr=subprocess.DEVNULL):
+            raise RuntimeError("offline mode needs 'unshare -rn' (user namespaces)")
+        base = ['unshare', '-rn'] + base
+        noop = ['unshare', '-rn'] + noop
+    home = tempfile.mkdtemp(prefix='pc2termux-bench-')
+    # bytecode goes to a scratch dir, so runs measure start-up and not compiling
+    env = dict(os.environ, HOME=home, PYTHONPYCACHEPREFIX=os.path.join(home, 'pycache'))
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    rows = []
+    try:
+        _time_to_prompt(base, env)
+        for case, cmd, cold in (('interpreter only', noop, False),
+                                ('cold cache', base, True), ('warm cache', base, False)):
+            times = []
+            for _ in range(runs):
+                if cold:
+                    shutil.rmtree(os.path.join(home, '.cache'), ignore_errors=True)
+                times.append(_time_to_prompt(cmd, env))
+            ok = sorted(t for t in times if t is not None)
+            rows.append({'case': case, 'runs': runs, 'failed': runs - len(ok),
+                         'p50_ms': 1000 * ok[len(ok) // 2] if ok else None,
+                         'max_ms': 1000 * ok[-1] if ok else None})
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+    return rows
+
+
+_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(text):
+    """'4096', '64K', '1M', '2G' -> bytes."""
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in _UNITS:
+        return int(float(text[:-1]) * _UNITS[text[-1]])
+    return int(text)
+
+
+def _make_sized_file(size):
+    fd, path = tempfile.mkstemp(prefix='pc2termux-bench-')
+    block = os.urandom(min(size, 1024 * 1024))
+    with os.fdopen(fd, 'wb') as f:
+        left = size
+        while left:
+            left -= f.write(block[:left])
+    return path
+
+
+def _serve_until_closed(listener, save_dir, buffer_size):
+    """Receive every connection into its own directory, one thread each."""
+    for n in itertools.count():
+        try:
+            conn, _ = listener.accept()
+        except OSError:
+            return
+
+        def handle(conn=conn, target=os.path.join(save_dir, str(n))):
+            try:
+                FileTransfer.receive_file(conn, target, buffer_size=buffer_size)
+            finally:
+                conn.close()
+        threading.Thread(target=handle, daemon=True).start()
+
+
+def _suite_case(path, size, files, buffer_size, concurrency, delay, rate, results):
+    """One sweep point, in a fresh process so peak RSS and CPU belong to it alone."""
+    save_dir = tempfile.mkdtemp(prefix='pc2termux-bench-')
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(64)
+    threading.Thread(target=_serve_until_closed, args=(listener, save_dir, buffer_size),
+                     daemon=True).start()
+    address = listener.getsockname()
+    proxy = None
+    if delay or rate:
+        proxy = DelayProxy(address, delay=delay, window=16 * 1024 * 1024, rate=rate)
+        address = proxy.address
+    pending = iter(range(files))
+    lock = threading.Lock()
+    latencies = []
+    failures = []
+
+    def worker():
+        while True:
+            with lock:
+                if next(pending, None) is None:
+                    return
+            t0 = time.perf_counter()
+            try:
+                with socket.create_connection(address) as sock:
+                    ok, msg = FileTransfer.send_file(sock, path)
+                    sock.shutdown(socket.SHUT_WR)
+                    while sock.recv(4096):
+                        pass  # the receiver closes once the file is on disk
+            except OSError as e:
+                ok, msg = False, str(e)
+            with lock:
+                if ok:
+                    latencies.append(time.perf_counter() - t0)
+                else:
+                    failures.append(msg)
+
+    cpu0 = os.times()
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+    cpu1 = os.times()
+    listener.close()
+    if proxy:
+        proxy.close()
+    shutil.rmtree(save_dir, ignore_errors=True)
+    latencies.sort()
+    pick = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))] if latencies else None
+    results.put({
+        'ok': len(latencies), 'failed': len(failures),
+        'errors': sorted(set(failures))[:3],
+        'wall_s': round(wall, 4),
+        'mb_per_s': round(size * len(latencies) / wall / 1e6, 2),
+        'files_per_s': round(len(latencies) / wall, 1),
+        'latency_p50_ms': pick(0.5) and round(pick(0.5) * 1000, 3),
+        'latency_p99_ms': pick(0.99) and round(pick(0.99) * 1000, 3),
+        'cpu_s': round((cpu1.user - cpu0.user) + (cpu1.system - cpu0.system), 3),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+    })
+
+
+def run_suite(sizes=('1K', '64K', '1M', '16M', '256M'), buffers=(BUFFER_SIZE, RECV_BUFFER_SIZE),
+              concurrency=(1, 4), delay_ms=0, rate_mb=0, bytes_per_case='256M',
+              max_files=200):
+    """
+    Sweep file size x receive buffer x concurrent senders over loopback,
+    optionally through the shaping proxy (one-way delay, per-connection
+    bandwidth). Each point sends enough copies of one file to move about
+    `bytes_per_case` (at least 3, at most `max_files`) and runs in its own
+    process. Returns a JSON-ready dict.
+    """
+    budget = parse_size(str(bytes_per_case))
+    ctx = multiprocessing.get_context('spawn')
+    report = {
+        'suite': 'pc2termux-transfer',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'delay_ms': delay_ms, 'rate_mb_per_s': rate_mb,
+        'results': [],
+    }
+    for size_text in sizes:
+        size = parse_size(str(size_text))
+        files = max(3, min(max_files, budget // max(size, 1)))
+        path = _make_sized_file(size)
+        try:
+            for buffer_size, streams in itertools.product(buffers, concurrency):
+                buffer_size = parse_size(str(buffer_size))
+                results = ctx.Queue()
+                worker = ctx.Process(target=_suite_case,
+                                     args=(path, size, files, buffer_size, int(streams),
+                                           delay_ms / 1000, rate_mb * 1e6 or None, results))
+                worker.start()
+                row = results.get()
+                worker.join()
+                row.update({'size': size, 'files': files, 'buffer_size': buffer_size,
+                            'concurrency': int(streams)})
+                report['results'].append(row)
+                print(f"  {size:>11} B  buf {buffer_size:>8}  x{streams:<3} "
+                      f"{row['mb_per_s']:>9.1f} MB/s  p50 {row['latency_p50_ms']} ms",
+                      file=sys.stderr)
+        finally:
+            os.remove(path)
+    return report
+
+
+def add_suite_arguments(parser):
+    """Options for `python main.py bench`."""
+    parser.add_argument('--sizes', default='1K,64K,1M,16M,256M',
+                        help="comma-separated file sizes, e.g. 1K,1M,2G")
+    parser.add_argument('--buffers', default=f'{BUFFER_SIZE},{RECV_BUFFER_SIZE}',
+                        help="comma-separated receive buffer sizes")
+    parser.add_argument('--concurrency', default='1,4',
+                        help="comma-separated numbers of simultaneous senders")
+    parser.add_argument('--delay', type=float, default=0,
+                        help="one-way delay in ms added by the shaping proxy")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="per-connection bandwidth limit in MB/s (0 = unlimited)")
+    parser.add_argument('--bytes-per-case', default='256M',
+                        help="roughly how much data each sweep point moves")
+    parser.add_argument('--out', help="write the JSON report here instead of stdout")
+
+
+def run_suite_from_args(args):
+    split = lambda text: [s for s in text.split(',') if s]
+    report = run_suite(split(args.sizes), split(args.buffers), [int(c) for c in split(args.concurrency)],
+                       args.delay, args.rate, args.bytes_per_case)
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    what = sys.argv[1] if len(sys.argv) > 1 else 'send'
+    if what == 'receive':
+        size_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+        print(f"receive_file over loopback, {size_mb} MiB, "
+              f"buffer {RECV_BUFFER_SIZE // 1024} KiB")
+        print(f"{'mode':<10}{'MB/s':>10}{'CPU s':>10}{'peak RSS MiB':>15}")
+        for row in bench_receive(size_mb):
+            print(f"{row['mode']:<10}{row['mb_per_s']:>10.1f}"
+                  f"{row['cpu_s']:>10.3f}{row['peak_rss_mb']:>15.1f}")
+    elif what == 'framing':
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+        print(f"{count} chat messages of 64 bytes over a socketpair")
+        print(f"{'mode':<14}{'msgs/s':>12}")
+        for row in bench_framing(count):
+            print(f"{row['mode']:<14}{row['msgs_per_s']:>12.0f}")
+    elif what == 'mux':
+        size_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+        print(f"{size_mb} MiB over a multiplexed stream on a 10 MB/s, 10 ms link, pinging every 20 ms")
+        print(f"{'window KiB':<12}{'MB/s':>8}{'ping p50 ms':>13}{'ping p99 ms':>13}")
+        for row in bench_mux(size_mb):
+            print(f"{row['window_kb']:<12}{row['mb_per_s']:>8.1f}{row['ping_p50_ms']:>13.1f}"
+                  f"{row['ping_p99_ms']:>13.1f}")
+    elif what == 'verify':
+        size_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+        for rate in (None, 100e6):
+            link = f"a {rate / 1e6:.0f} MB/s link" if rate else "loopback"
+            print(f"send_file + receive_file over {link}, {size_mb} MiB, best of 3")
+            print(f"{'receive':<10}{'verify':<8}{'MB/s':>9}{'CPU s':>8}")
+            for row in bench_verify(size_mb, rate=rate):
+                print(f"{row['receive']:<10}{str(row['verify']):<8}{row['mb_per_s']:>9.1f}"
+                      f"{row['cpu_s']:>8.2f}")
+    elif what == 'startup':
+        runs = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+        print(f"time to the first prompt, no network, {runs} runs")
+        print(f"{'case':<18}{'p50 ms':>8}{'max ms':>8}")
+        for row in bench_startup(runs):
+            print(f"{row['case']:<18}{row['p50_ms']:>8.1f}{row['max_ms']:>8.1f}")
+    elif what == 'crypto':
+        size_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+        print(f"send_file + receive_file over loopback, {size_mb} MiB, best of 2")
+        print(f"{'cipher':<20}{'record KiB':>11}{'MB/s':>9}{'CPU s':>8}")
+        for row in bench_crypto(size_mb):
+            if 'ms' in row:
+                print(f"{row['cipher']:<20}{'':>11}{row['ms']:>7.1f} ms (both sides, p50)")
+                continue
+            print(f"{row['cipher']:<20}{str(row['record_kb'] or '-'):>11}{row['mb_per_s']:>9.1f}"
+                  f"{row['cpu_s']:>8.2f}")
+    elif what == 'async':
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+        print(f"{count} concurrent 512 KiB uploads into each receive engine")
+        print(f"{'engine':<10}{'ok':>6}{'MB/s':>10}{'peak RSS MiB':>15}{'threads':>9}")
+        for row in bench_engines(count):
+            print(f"{row['engine']:<10}{row['ok']:>6}{row['mb_per_s']:>10.1f}"
+                  f"{row['peak_rss_mb']:>15.1f}{row['peak_threads']:>9}")
+    elif what == 'compress':
+        size_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+        print(f"send_file goodput through a 20 MB/s link, {size_mb} MiB per corpus")
+        print(f"{'corpus':<8}{'mode':<12}{'MB/s':>8}  detail")
+        for row in bench_compression(size_mb):
+            print(f"{row['corpus']:<8}{row['mode']:<12}{row['goodput_mb_per_s']:>8.1f}  {row['detail']}")
+    elif what == 'striped':
+        size_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+        print(f"send_striped through a 25 ms one-way delay proxy, {size_mb} MiB")
+        print(f"{'streams':<10}{'MB/s':>10}  detail")
+        for row in bench_striped(size_mb):
+            print(f"{str(row['streams']):<10}{row['mb_per_s']:>10.1f}  {row['detail']}")
+    else:
+        size_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+        print(f"send_file over loopback, {size_mb} MiB, best of 3")
+        print(f"{'mode':<10}{'MB/s':>10}{'sender CPU s':>15}{'wall s':>10}")
+        for row in bench_send(size_mb):
+            print(f"{row['mode']:<10}{row['mb_per_s']:>10.1f}"
+                  f"{row['sender_cpu_s']:>15.3f}{row['wall_s']:>10.3f}")
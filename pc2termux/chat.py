@@ -0,0 +1,257 @@
+"""
+Length-prefixed binary framing for the chat channel.
+
+Every message is a 5-byte header (type, payload length) followed by the
+payload, so messages may contain newlines and a short recv() can never
+split or merge them. Chat text, the password handshake and control
+traffic all travel as frames on the same socket. The handshake is a
+SPAKE2 exchange (the password itself is never sent); everything after
+it is encrypted with the session key it yields.
+"""
+import socket
+import struct
+import threading
+from constants import FRAME_BUFFER_SIZE, FRAME_MAX_SIZE, HANDSHAKE_TIMEOUT
+from secure import Session, Spake2, available_ciphers, pick_cipher
+
+TEXT = 1        # chat message, UTF-8
+CONTROL = 2     # "verb [args]": spake2, confirm, ok, error, bye, history, since
+FILE_OFFER = 3  # "name|size" announced before a transfer starts
+ACK = 4         # echo of a PING payload
+PING = 5        # opaque token; the peer answers with an ACK
+STREAM_OPEN = 6    # stream id: the peer opened a multiplexed stream
+STREAM_DATA = 7    # stream id + bytes
+STREAM_WINDOW = 8  # stream id + credit: the receiver consumed that many bytes
+STREAM_CLOSE = 9   # stream id: the stream is finished in both directions
+HISTORY = 10       # chat log records the peer missed, replayed in bulk on reconnect
+
+_HEAD = struct.Struct('!BI')
+
+
+def encode_frame(ftype, payload=b''):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return _HEAD.pack(ftype, len(payload)) + payload
+
+
+class FrameParser:
+    """
+    Incremental frame parser over one reusable buffer. Data is received
+    straight into the buffer (recv_from) or copied in (feed), and frames()
+    yields (type, memoryview) pairs pointing into it, so payloads are not
+    copied. A yielded view is only valid until the next recv_from/feed.
+    """
+
+    def __init__(self, size=FRAME_BUFFER_SIZE, max_frame=FRAME_MAX_SIZE):
+        self.buf = bytearray(size)
+        self.start = 0
+        self.end = 0
+        self.max_frame = max_frame
+
+    def _make_room(self, need):
+        """Ensure `need` free bytes after end, compacting or growing the buffer."""
+        if len(self.buf) - self.end >= need:
+            return
+        pending = self.end - self.start
+        if pending + need > len(self.buf):
+            # never resize in place: callers may still hold views of the old buffer
+            grown = bytearray(max(len(self.buf) * 2, pending + need))
+            grown[:pending] = self.buf[self.start:self.end]
+            self.buf = grown
+        else:
+            self.buf[:pending] = self.buf[self.start:self.end]
+        self.start, self.end = 0, pending
+
+    def _wanted(self):
+        """Bytes still missing for the frame at the head of the buffer."""
+        pending = self.end - self.start
+        if pending < _HEAD.size:
+            return _HEAD.size - pending
+        return _HEAD.size + _HEAD.unpack_from(self.buf, self.start)[1] - pending
+
+    def recv_from(self, sock):
+        """One recv_into() from sock; returns the byte count (0 at EOF)."""
+        self._make_room(max(self._wanted(), 1))
+        n = sock.recv_into(memoryview(self.buf)[self.end:])
+        self.end += n
+        return n
+
+    def feed(self, data):
+        self._make_room(len(data))
+        self.buf[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def frames(self):
+        view = memoryview(self.buf)
+        while self.end - self.start >= _HEAD.size:
+            ftype, length = _HEAD.unpack_from(self.buf, self.start)
+            if length > self.max_frame:
+                raise ValueError(f"Frame of {length} bytes exceeds the limit")
+            begin = self.start + _HEAD.size
+            if self.end - begin < length:
+                return
+            self.start = begin + length
+            yield ftype, view[begin:begin + length]
+
+
+class Channel:
+    """A framed socket: thread-safe send(), blocking recv() and iteration."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.parser = FrameParser()
+        self._frames = iter(())
+        self._send_lock = threading.Lock()
+        self.session = None
+
+    def secure(self, session, initiator):
+        """Encrypt everything from here on; bytes already received are decrypted too."""
+        self.session = session
+        if not session.encrypted:
+            return  # --plaintext: frames stay as they are
+        pending = bytes(self.parser.buf[self.parser.start:self.parser.end])
+        self.parser.start = self.parser.end = 0
+        self._frames = iter(())
+        self.sock = session.wrap(self.sock, b'chat', initiator, pending)
+
+    def send(self, ftype, payload=b''):
+        data = encode_frame(ftype, payload)
+        with self._send_lock:
+            self.sock.sendall(data)
+
+    def send_parts(self, ftype, *parts):
+        """Send one frame whose payload is the concatenation of `parts`."""
+        length = sum(len(part) for part in parts)
+        data = b''.join((_HEAD.pack(ftype, length),) + parts)
+        with self._send_lock:
+            self.sock.sendall(data)
+
+    def send_text(self, text):
+        payload = text.encode()
+        data = _HEAD.pack(TEXT, len(payload)) + payload
+        with self._send_lock:
+            self.sock.sendall(data)
+
+    def recv(self):
+        """Next (type, memoryview) frame, or None once the peer has closed."""
+        while True:
+            frame = next(self._frames, None)
+            if frame is not None:
+                return frame
+            if not self.parser.recv_from(self.sock):
+                return None
+            self._frames = self.parser.frames()
+
+    def __iter__(self):
+        while True:
+            yield from self._frames
+            if not self.parser.recv_from(self.sock):
+                return
+            self._frames = self.parser.frames()
+
+
+def client_handshake(channel, password):
+    """
+    Prove we know the password without sending it and agree on a session
+    key; returns (True, features) with the space-separated features the
+    host enabled, or (False, reason). On success the channel is encrypted.
+    """
+    spake = Spake2(password, initiator=True)
+    offered = ','.join(available_ciphers())
+    channel.send(CONTROL, f"spake2 {spake.message()} {offered}")
+    frame = _recv_timed(channel)
+    if frame is None or frame[0] != CONTROL:
+        return False, "No handshake reply"
+    verb, _, arg = str(frame[1], 'utf-8', 'replace').partition(' ')
+    if verb != 'spake2':
+        return False, arg or verb
+    try:
+        message, cipher, confirm = arg.split(' ')
+        if cipher not in offered.split(','):
+            raise ValueError(cipher)
+        spake.finish(message, offered, cipher)
+    except ValueError:
+        return False, "Malformed handshake reply"
+    if not spake.check(confirm):
+        channel.send(CONTROL, "error Wrong password")
+        return False, "Wrong password (or the handshake was tampered with)"
+    channel.send(CONTROL, f"confirm {spake.confirm}")
+    ok, features = _await_verdict(channel)
+    if ok:
+        channel.secure(Session(spake.key, cipher), initiator=True)
+    return ok, features
+
+
+def server_handshake(channel, password, features=''):
+    """
+    Check that the peer knows the password and answer, announcing
+    `features`; returns (ok, reason). On success the channel is encrypted.
+    """
+    frame = _recv_timed(channel)
+    if frame is None or frame[0] != CONTROL:
+        return False, "No handshake"
+    verb, _, arg = str(frame[1], 'utf-8', 'replace').partition(' ')
+    if verb == 'auth':
+        reject(channel, "Unsupported handshake (update pc2termux)")
+        return False, "old client"
+    if verb != 'spake2':
+        return False, "No handshake"
+    message, _, offered = arg.partition(' ')
+    cipher = pick_cipher(offered.split(','))
+    if cipher is None:
+        reject(channel, "No common cipher")
+        return False, "no common cipher"
+    spake = Spake2(password, initiator=False)
+    try:
+        spake.finish(message, offered, cipher)
+    except ValueError as e:
+        reject(channel, str(e))
+        return False, str(e).lower()
+    channel.send(CONTROL, f"spake2 {spake.message()} {cipher} {spake.confirm}")
+    frame = _recv_timed(channel)
+    if frame is None or frame[0] != CONTROL:
+        return False, "No handshake"
+    verb, _, arg = str(frame[1], 'utf-8', 'replace').partition(' ')
+    if verb != 'confirm' or not spake.check(arg):
+        if verb == 'confirm':
+            reject(channel, "Wrong password")
+        return False, "wrong password"
+    channel.send(CONTROL, f"ok {features}".strip())
+    channel.secure(Session(spake.key, cipher), initiator=False)
+    return True, ''
+
+
+def reject(channel, reason):
+    channel.send(CONTROL, f"error {reason}")
+
+
+def _await_verdict(channel):
+    frame = _recv_timed(channel)
+    if frame is None or frame[0] != CONTROL:
+        return False, "No handshake reply"
+    verb, _, arg = str(frame[1], 'utf-8', 'replace').partition(' ')
+    if verb == 'ok':
+        return True, arg
+    return False, arg or verb
+
+
+def _recv_timed(channel):
+    timeout = channel.sock.gettimeout()
+    channel.sock.settimeout(HANDSHAKE_TIMEOUT)
+    try:
+        return channel.recv()
+    except (socket.timeout, ValueError):
+        return None
+    finally:
+        channel.sock.settimeout(timeout)
+
+
+async def read_frame(reader):
+    """asyncio counterpart of Channel.recv(); returns (type, bytes) or None."""
+    try:
+        ftype, length = _HEAD.unpack(await reader.readexactly(_HEAD.size))
+        if length > FRAME_MAX_SIZE:
+            raise ValueError(f"Frame of {length} bytes exceeds the limit")
+        return ftype, await reader.readexactly(length)
+    except EOFError:
+        return None
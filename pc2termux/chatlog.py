@@ -0,0 +1,292 @@
+"""
+Persistent chat history, so messages survive a disconnect.
+
+Each side keeps, per peer, two append-only logs: the messages we sent
+(numbered by us) and those we received (numbered by the peer). A log is a
+directory of segments. Each segment holds records (seq, time, length,
+UTF-8 text) and has a sparse offset index with one (seq, offset) entry
+every CHATLOG_INDEX_BYTES. A lookup bisects the segment list, then the
+index, and scans at most that many bytes.
+Full segments are compacted with zlib and the oldest are evicted once a
+log exceeds CHATLOG_MAX_BYTES, so disk use is bounded. In memory a log
+only holds its segment list and one open file.
+
+On reconnect the peers swap their node ids and last-seen numbers. Each
+then replays the missing range in HISTORY frames that carry raw records
+straight from the segments.
+"""
+import bisect
+import os
+import secrets
+import struct
+import threading
+import time
+import zlib
+from constants import (CHATLOG_DIR, CHATLOG_SEGMENT_BYTES, CHATLOG_MAX_BYTES,
+                       CHATLOG_INDEX_BYTES, CHATLOG_REPLAY_FRAME)
+
+_RECORD = struct.Struct('!QdI')  # seq, unix time, text length
+_INDEX = struct.Struct('!QQ')    # seq, offset of its record in the uncompressed segment
+
+
+def node_id(root=CHATLOG_DIR):
+    """This installation's id, created on first use; peers file our history under it."""
+    path = os.path.join(os.path.expanduser(root), 'id')
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+        if _valid_id(value):
+            return value
+    except OSError:
+        pass
+    value = secrets.token_hex(8)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(value)
+    return value
+
+
+def _valid_id(value):
+    return len(value) == 16 and all(c in '0123456789abcdef' for c in value)
+
+
+def encode_record(seq, at, text):
+    data = text.encode()
+    return _RECORD.pack(seq, at, len(data)) + data
+
+
+def parse_records(data):
+    """(seq, time, text) of every whole record in `data`; raises ValueError on garbage."""
+    view = memoryview(data)
+    pos = 0
+    while pos < len(view):
+        if pos + _RECORD.size > len(view):
+            raise ValueError("Truncated chat record")
+        seq, at, length = _RECORD.unpack_from(view, pos)
+        end = pos + _RECORD.size + length
+        if end > len(view):
+            raise ValueError("Truncated chat record")
+        yield seq, at, str(view[pos + _RECORD.size:end], 'utf-8', 'replace')
+        pos = end
+
+
+def _scan(data, pos=0):
+    """(seq, start, end) of each whole record from `pos`, stopping at a torn tail."""
+    while pos + _RECORD.size <= len(data):
+        seq, _, length = _RECORD.unpack_from(data, pos)
+        end = pos + _RECORD.size + length
+        if end > len(data):
+            return
+        yield seq, pos, end
+        pos = end
+
+
+class ChatLog:
+    """One segmented, indexed, append-only log of (seq, time, text) records."""
+
+    def __init__(self, directory, segment_bytes=CHATLOG_SEGMENT_BYTES,
+                 max_bytes=CHATLOG_MAX_BYTES, index_bytes=CHATLOG_INDEX_BYTES):
+        self.dir = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.index_bytes = index_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        names = os.listdir(directory)
+        self.segments = sorted({int(name.split('.')[0]) for name in names
+                                if name.endswith(('.log', '.logz'))})
+        for first in self.segments:
+            if f"{first:020d}.logz" in names and f"{first:020d}.log" in names:
+                os.remove(self._path(first, '.log'))  # a crash in _roll left both; the .logz is whole
+        self.last_seq = 0
+        self.active = None  # (first seq, file) of the segment being appended to
+        self.active_size = 0
+        self.indexed_at = 0  # offset of the active segment's last index entry
+        if self.segments:
+            self._recover(self.segments[-1])
+
+    def _path(self, first, ext):
+        return os.path.join(self.dir, f"{first:020d}{ext}")
+
+    def _recover(self, first):
+        """Find the last record, dropping a tail torn by a crash, and reopen for appending."""
+        if os.path.exists(self._path(first, '.logz')):
+            data = self._load(first)
+            self.last_seq = max([seq for seq, _, _ in _scan(data)], default=first - 1)
+            return
+        index = self._index(first)
+        entries = len(index)
+        while True:
+            start = index[entries - 1][1] if entries else 0
+            with open(self._path(first, '.log'), 'rb') as f:
+                f.seek(start)
+                data = f.read()
+            end, last = start, first - 1
+            for seq, _, stop in _scan(data):
+                last, end = seq, start + stop
+            if last >= first or not entries:
+                break
+            entries -= 1  # that entry was written for the torn record; scan from the one before
+        self.last_seq = last
+        f = open(self._path(first, '.log'), 'r+b')
+        f.truncate(end)
+        f.seek(end)
+        self.active = (first, f)
+        self.active_size = end
+        kept = [entry for entry in index if entry[1] < end]
+        if len(kept) != len(index):
+            with open(self._path(first, '.idx'), 'wb') as idx:
+                idx.write(b''.join(_INDEX.pack(*entry) for entry in kept))
+        self.indexed_at = kept[-1][1] if kept else -self.index_bytes
+
+    def _index(self, first):
+        try:
+            with open(self._path(first, '.idx'), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return []
+        return [_INDEX.unpack_from(data, pos)
+                for pos in range(0, len(data) - _INDEX.size + 1, _INDEX.size)]
+
+    def _load(self, first):
+        """A segment's records as bytes (decompressed if it was compacted)."""
+        try:
+            with open(self._path(first, '.logz'), 'rb') as f:
+                return zlib.decompress(f.read())
+        except FileNotFoundError:
+            with open(self._path(first, '.log'), 'rb') as f:
+                return f.read()
+
+    def append(self, text, seq=None, at=None):
+        """Add a record; seq defaults to the next number. Returns the seq, or None
+        if `seq` is not newer than the last one (already logged)."""
+        with self.lock:
+            seq = self.last_seq + 1 if seq is None else seq
+            if seq <= self.last_seq:
+                return None
+            record = encode_record(seq, time.time() if at is None else at, text)
+            if self.active is None or (self.active_size and
+                                       self.active_size + len(record) > self.segment_bytes):
+                self._roll(seq)
+            first, f = self.active
+            if self.active_size - self.indexed_at >= self.index_bytes:
+                with open(self._path(first, '.idx'), 'ab') as idx:
+                    idx.write(_INDEX.pack(seq, self.active_size))
+                self.indexed_at = self.active_size
+            f.write(record)
+            f.flush()
+            self.active_size += len(record)
+            self.last_seq = seq
+            return seq
+
+    def _roll(self, first):
+        """Seal the active segment (compacting it) and start a new one at `first`."""
+        if self.active is not None:
+            old, f = self.active
+            f.close()
+            path = self._path(old, '.log')
+            with open(path, 'rb') as src:
+                packed = zlib.compress(src.read(), 6)
+            with open(self._path(old, '.logz') + '.tmp', 'wb') as dst:
+                dst.write(packed)
+            os.replace(self._path(old, '.logz') + '.tmp', self._path(old, '.logz'))
+            os.remove(path)
+        self.active = (first, open(self._path(first, '.log'), 'ab'))
+        self.segments.append(first)
+        self.active_size = 0
+        self.indexed_at = -self.index_bytes  # index the segment's first record
+        self._evict()
+
+    def _evict(self):
+        sizes = []
+        for first in self.segments:
+            size = 0
+            for ext in ('.log', '.logz', '.idx'):
+                try:
+                    size += os.path.getsize(self._path(first, ext))
+                except OSError:
+                    pass
+            sizes.append(size)
+        total = sum(sizes)
+        while total > self.max_bytes and len(self.segments) > 1:
+            first = self.segments.pop(0)
+            total -= sizes.pop(0)
+            for ext in ('.log', '.logz', '.idx'):
+                try:
+                    os.remove(self._path(first, ext))
+                except OSError:
+                    pass
+
+    def _chunks(self, start, stop):
+        """(segment bytes, record start, record end) pieces covering start <= seq < stop."""
+        with self.lock:
+            segments = list(self.segments)
+        i = max(0, bisect.bisect_right(segments, start) - 1)
+        for first in segments[i:]:
+            if first >= stop:
+                return
+            try:
+                data = self._load(first)
+            except OSError:
+                continue  # evicted meanwhile
+            index = self._index(first)
+            pos = 0
+            j = bisect.bisect_right(index, (start, float('inf'))) - 1
+            if j >= 0:
+                pos = index[j][1]
+            for seq, begin, end in _scan(data, pos):
+                if seq >= stop:
+                    return
+                if seq >= start:
+                    yield data, begin, end
+
+    def read(self, start, stop=None):
+        """(seq, time, text) of the records with start <= seq < stop."""
+        stop = self.last_seq + 1 if stop is None else stop
+        for data, begin, end in self._chunks(start, stop):
+            yield from parse_records(memoryview(data)[begin:end])
+
+    def raw(self, start, stop, frame=CHATLOG_REPLAY_FRAME):
+        """(count, bytes) batches of whole records for start <= seq < stop, each <= frame bytes."""
+        batch, count = [], 0
+        size = 0
+        for data, begin, end in self._chunks(start, stop):
+            if batch and size + end - begin > frame:
+                yield count, b''.join(batch)
+                batch, count, size = [], 0, 0
+            batch.append(data[begin:end])
+            count += 1
+            size += end - begin
+        if batch:
+            yield count, b''.join(batch)
+
+    def tail(self, n):
+        """The last n records."""
+        return list(self.read(max(1, self.last_seq - n + 1)))[-n:]
+
+    def close(self):
+        with self.lock:
+            if self.active is not None:
+                self.active[1].close()
+                self.active = None
+
+
+class History:
+    """The chat with one peer, filed under its node id: what we sent and what we got."""
+
+    def __init__(self, remote_id, root=CHATLOG_DIR):
+        if not _valid_id(remote_id):
+            raise ValueError(f"Bad node id {remote_id!r}")
+        base = os.path.join(os.path.expanduser(root), remote_id)
+        self.sent = ChatLog(os.path.join(base, 'sent'))
+        self.received = ChatLog(os.path.join(base, 'received'))
+
+    def recent(self, n):
+        """The last n messages in both directions as (time, mine, text), oldest first."""
+        merged = [(at, True, text) for _, at, text in self.sent.tail(n)]
+        merged += [(at, False, text) for _, at, text in self.received.tail(n)]
+        return sorted(merged)[-n:]
+
+    def close(self):
+        self.sent.close()
+        self.received.close()
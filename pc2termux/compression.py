@@ -0,0 +1,203 @@
+"""
+Optional on-the-fly compression for file transfer streams.
+zlib and lzma come with Python; zstd is used when the `zstandard`
+package is installed.
+"""
+import io
+import lzma
+import os
+import queue
+import threading
+import zlib
+from constants import (COMPRESS_CODECS, COMPRESS_CHUNK, COMPRESS_SAMPLE_SIZE,
+                       COMPRESS_MIN_SAVING, COMPRESS_QUEUE_DEPTH)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# formats that are already compressed; sampling them is a waste of time
+COMPRESSED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.mp4', '.mkv', '.mov',
+    '.avi', '.webm', '.mp3', '.aac', '.ogg', '.opus', '.flac', '.m4a', '.zip',
+    '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar', '.apk', '.jar',
+    '.deb', '.whl', '.pdf',
+}
+
+
+def available_codecs():
+    """Codecs this side can speak, in order of preference."""
+    return [c for c in COMPRESS_CODECS if c != 'zstd' or zstandard is not None]
+
+
+def pick_codec(offered):
+    """Receiver side: first codec from the sender's comma-separated offer we support."""
+    ours = available_codecs()
+    for codec in (offered or '').split(','):
+        if codec in ours:
+            return codec
+    return None
+
+
+def looks_compressible(sample):
+    """True if a quick zlib pass over the sample saves at least COMPRESS_MIN_SAVING."""
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) <= len(sample) * (1 - COMPRESS_MIN_SAVING)
+
+
+def offer_codecs(paths):
+    """
+    Sender side: codecs worth offering for these files, or [] when the data
+    is already compressed. Judged from file extensions and a zlib pass over
+    the first COMPRESS_SAMPLE_SIZE bytes of the remaining files.
+    """
+    sample = bytearray()
+    skipped = kept = 0
+    for path in paths:
+        size = os.path.getsize(path)
+        if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+            skipped += size
+            continue
+        kept += size
+        if len(sample) < COMPRESS_SAMPLE_SIZE:
+            with open(path, 'rb') as f:
+                sample += f.read(COMPRESS_SAMPLE_SIZE - len(sample))
+    if skipped >= kept or not looks_compressible(bytes(sample)):
+        return []
+    return available_codecs()
+
+
+def _compressor(codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    if codec == 'lzma':
+        return lzma.LZMACompressor(preset=1)
+    return zlib.compressobj(1)
+
+
+class CompressWriter:
+    """
+    Socket stand-in for the sending side: sendall() collects data into
+    COMPRESS_CHUNK pieces and a worker thread compresses and sends them, so
+    compression overlaps with reading the next chunk. close() finishes the
+    compressed stream.
+    """
+
+    def __init__(self, sock, codec):
+        self.sock = sock
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.error = None
+        self._buffer = bytearray()
+        self._queue = queue.Queue(maxsize=COMPRESS_QUEUE_DEPTH)
+        self._worker = threading.Thread(target=self._run, args=(_compressor(codec),),
+                                        daemon=True)
+        self._worker.start()
+
+    def _run(self, comp):
+        try:
+            while True:
+                chunk = self._queue.get()
+                data = comp.compress(chunk) if chunk is not None else comp.flush()
+                if data:
+                    self.sock.sendall(data)
+                    self.wire_bytes += len(data)
+                if chunk is None:
+                    return
+        except Exception as e:
+            self.error = e
+            while self._queue.get() is not None:
+                pass  # unblock the producer until it closes
+
+    def sendall(self, data):
+        if self.error:
+            raise self.error
+        self._buffer += data
+        self.raw_bytes += len(data)
+        if len(self._buffer) >= COMPRESS_CHUNK:
+            self._queue.put(bytes(self._buffer))
+            self._buffer.clear()
+
+    def close(self):
+        """Flush and end the compressed stream; raises if the worker failed."""
+        if self._buffer:
+            self._queue.put(bytes(self._buffer))
+            self._buffer.clear()
+        self._queue.put(None)
+        self._worker.join()
+        if self.error:
+            raise self.error
+
+
+class _SocketSource:
+    """Minimal readable wrapper over a socket, for zstandard.stream_reader."""
+
+    def __init__(self, sock, initial):
+        self.sock = sock
+        self.initial = initial
+
+    def read(self, size=COMPRESS_CHUNK):
+        if self.initial:
+            data, self.initial = self.initial[:size], self.initial[size:]
+            return data
+        return self.sock.recv(size)
+
+
+class DecompressReader(io.RawIOBase):
+    """
+    Socket stand-in for the receiving side: recv/recv_into (and readinto, so
+    it can sit under io.BufferedReader) return decompressed data, never more
+    than requested, so a tiny compressed input can't balloon in memory.
+    """
+
+    def __init__(self, sock, codec, initial=b''):
+        super().__init__()
+        self.sock = sock
+        self.codec = codec
+        self._initial = bytes(initial)
+        if codec == 'zstd':
+            self._reader = zstandard.ZstdDecompressor().stream_reader(
+                _SocketSource(sock, self._initial))
+        elif codec == 'lzma':
+            self._decomp = lzma.LZMADecompressor()
+        else:
+            self._decomp = zlib.decompressobj()
+
+    def readable(self):
+        return True
+
+    def _recv_input(self):
+        if self._initial:
+            data, self._initial = self._initial, b''
+            return data
+        return self.sock.recv(COMPRESS_CHUNK)
+
+    def readinto(self, b):
+        if self.codec == 'zstd':
+            return self._reader.readinto(b)
+        view = memoryview(b).cast('B')
+        while not self._decomp.eof:
+            if self.codec == 'lzma':
+                data = b'' if not self._decomp.needs_input else self._recv_input()
+                if self._decomp.needs_input and not data:
+                    return 0  # stream cut off
+            else:
+                data = self._decomp.unconsumed_tail or self._recv_input()
+                if not data:
+                    return 0
+            out = self._decomp.decompress(data, len(view))
+            if out:
+                view[:len(out)] = out
+                return len(out)
+        return 0
+
+    def recv_into(self, buffer, nbytes=0):
+        view = memoryview(buffer)
+        return self.readinto(view[:nbytes] if nbytes else view)
+
+    def recv(self, size):
+        buf = bytearray(size)
+        n = self.readinto(buf)
+        return bytes(buf[:n])
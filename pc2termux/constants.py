@@ -1,4 +1,82 @@
 # Network settings
-DEFAULT_PORT = 5555          # port for chat
-DEFAULT_FILE_PORT = 5556     # port for file transfers
-BUFFER_SIZE = 4096           # chunk size for file transfer
+DEFAULT_PORT = 5555                     # port for chat
+DEFAULT_FILE_PORT = 5556                # port for file transfers
+BUFFER_SIZE = 64 * 1024                 # chunk size for file transfer
+SENDFILE_CHUNK = 1024 * 1024            # bytes handed to os.sendfile per call
+RECV_BUFFER_SIZE = 256 * 1024           # reusable receive buffer (independent of BUFFER_SIZE)
+MMAP_WINDOW = 64 * 1024 * 1024          # bytes mapped at once by the mmap receive path
+RESUME_BLOCK_SIZE = 4 * 1024 * 1024     # checksummed block size for resumable transfers
+TRANSFER_RETRIES = 5                    # reconnect attempts for an interrupted /sendfile
+RETRY_DELAY = 2                         # seconds; grows linearly with each attempt
+STRIPE_RANGE_SIZE = 8 * 1024 * 1024     # range size for striped transfers
+STRIPE_MAX_STREAMS = 8                  # upper bound for adaptive striping
+STRIPE_THRESHOLD = 64 * 1024 * 1024     # /sendfile stripes files at least this big
+STRIPE_IDLE_TIMEOUT = 600               # seconds before an abandoned stripe is dropped
+BATCH_INLINE_LIMIT = 1024 * 1024        # batch entries up to this size are prefetched into memory
+BATCH_COALESCE_SIZE = 256 * 1024        # small batch entries are grouped into sends of this size
+BATCH_PREFETCH_BYTES = 16 * 1024 * 1024 # read-ahead budget for small batch entries
+COMPRESS_CODECS = ('zstd', 'zlib', 'lzma')  # preference order; zstd only if installed
+COMPRESS_CHUNK = 256 * 1024             # raw bytes handed to the compressor at once
+COMPRESS_SAMPLE_SIZE = 256 * 1024       # bytes sampled to decide whether to compress
+COMPRESS_MIN_SAVING = 0.1               # compress only if the sample shrinks by 10%+
+COMPRESS_QUEUE_DEPTH = 4                # chunks buffered ahead of the compressor thread
+CAS_DIR = '.cas'                        # content store inside the receive directory
+CAS_MAX_BYTES = 2 * 1024 * 1024 * 1024  # LRU-evict the content store beyond this
+DIGEST_CACHE_ENTRIES = 4096             # whole-file digests remembered by (path, size, mtime)
+DELTA_BLOCK_SIZE = 64 * 1024            # block size for rsync-style deltas
+DELTA_MAX_SIZE = 1024 * 1024 * 1024     # larger files are sent whole instead of as a delta
+DELTA_ROLL_BUDGET = 4 * 1024 * 1024     # bytes a sender may scan byte-by-byte per delta
+ASYNC_CHUNK = 256 * 1024                # bytes read per await by the async file server
+ASYNC_MAX_TRANSFERS = 64                # incoming transfers the async engine reads at once
+ASYNC_STREAM_LIMIT = 64 * 1024          # StreamReader buffer limit (backpressure threshold)
+HUB_MAX_PEERS = 32                      # peers a hub accepts at once
+HUB_CHUNK = 1024 * 1024                 # shared read-once chunk for hub file fan-out
+HUB_WINDOW = 8                          # chunks the fan-out reader may run ahead
+FRAME_BUFFER_SIZE = 64 * 1024           # chat frame parser buffer (grows for big frames)
+FRAME_MAX_SIZE = 1024 * 1024            # reject chat frames larger than this
+HANDSHAKE_TIMEOUT = 10                  # seconds to wait for the password exchange
+MUX_WINDOW = 512 * 1024                 # unacknowledged bytes per multiplexed stream
+MUX_FRAME_SIZE = 32 * 1024              # largest data frame a stream sends at once
+METRICS_INTERVAL = 1.0                  # seconds between rate samples / progress redraws
+METRICS_EWMA_ALPHA = 0.3                # weight of the newest sample in the smoothed rate
+METRICS_KEEP_FINISHED = 20              # finished transfers kept for the metrics endpoint
+VERIFY_CHUNK = 1024 * 1024              # read size of the background integrity hasher
+SCHED_MAX_CONCURRENT = 2                # transfers running at once; the rest wait in the queue
+SCHED_RATE_LIMIT = 0                    # global upload limit in bytes/s (0 = unlimited)
+SCHED_PEER_RATE_LIMIT = 0               # per-peer upload limit in bytes/s (0 = unlimited)
+SCHED_BURST = 256 * 1024                # token bucket depth
+SCHED_QUANTUM = 64 * 1024               # bytes sent per token reservation when limited
+LINK_PROFILE = 'auto'                   # lan, wifi, tunnel, cellular, or auto (probe once connected)
+PROBE_PINGS = 5                         # empty pings sent to measure the RTT
+PROBE_BYTES = 256 * 1024                # ping payload used to estimate bandwidth
+DISCOVERY_CACHE = '~/.cache/pc2termux/discovery.json'  # public IP etc., reused across runs
+DISCOVERY_TTL = 3600                    # seconds a cached lookup stays valid
+PUBLIC_IP_TIMEOUT = 3                   # seconds before the public IP lookup gives up
+BEACON_PORT = 5557                      # UDP port hosting peers answer discovery queries on
+BEACON_GROUP = '239.255.55.55'          # multicast group for discovery queries
+BEACON_TIMEOUT = 0.5                    # seconds to collect beacon replies
+SWEEP_TIMEOUT = 1.0                     # seconds per TCP connect in the fallback subnet sweep
+SWEEP_CONCURRENCY = 256                 # connects in flight at once (a whole /24)
+LAN_PEERS_TTL = 24 * 3600               # seconds a peer found on the LAN stays in the pick list
+CRYPTO_CIPHERS = ('chacha20-poly1305', 'aes-256-gcm')  # preference order; both need cryptography
+CRYPTO_RECORD_SIZE = 256 * 1024         # plaintext bytes sealed per record
+CRYPTO_MAX_RECORD = 4 * 1024 * 1024     # reject records claiming more than this
+STREAM_CHUNK = 256 * 1024               # bytes read from a stream source per chunk
+STREAM_QUEUE_DEPTH = 4                  # chunks waiting for an in-process stream consumer
+PROVISION_PARALLEL = 4                  # package files pushed at once to an offline device
+PROVISION_DIR = 'received_files/debs'   # where pushed package files land before the install
+MIRROR_INDEX = '~/.cache/pc2termux/mirror.sqlite'  # what each /mirror last sent, kept across runs
+MIRROR_DEBOUNCE = 0.5                   # seconds without changes before a mirror syncs
+MIRROR_MAX_DELAY = 5.0                  # sync at least this often while changes keep coming
+MIRROR_POLL_INTERVAL = 2.0              # seconds between stat-diff rescans without inotify
+DAEMON_SOCKET = '~/.cache/pc2termux/daemon.sock'  # where `main.py send` finds the daemon
+DAEMON_LOG = '~/.cache/pc2termux/daemon.log'    # output of a daemon started by `send`
+DAEMON_IDLE_TIMEOUT = 900               # seconds an unused peer session stays open
+DAEMON_START_TIMEOUT = 5                # seconds `send` waits for a daemon it started
+CHATLOG_DIR = '~/.cache/pc2termux/chatlog'  # per-peer chat history, replayed on reconnect
+CHATLOG_SEGMENT_BYTES = 1024 * 1024     # bytes of records per segment before it is sealed and compacted
+CHATLOG_MAX_BYTES = 32 * 1024 * 1024    # per log; the oldest segments are evicted beyond this
+CHATLOG_INDEX_BYTES = 4096              # one offset index entry per this many bytes of records
+CHATLOG_REPLAY_FRAME = 256 * 1024       # record bytes per HISTORY frame when catching up
+CHATLOG_REPLAY_LIMIT = 10000            # most messages replayed to a peer on reconnect
+CHATLOG_SHOW = 20                       # replayed messages printed; the rest are in /history
@@ -0,0 +1,447 @@
+"""
+Headless mode for scripts (cron, CI): a long-running daemon that keeps
+authenticated sessions to hosting peers, and a thin client that hands it
+files over a local Unix socket.
+
+    python main.py daemon &
+    python main.py send --to 192.168.1.5:5555 --password abcd photo.jpg notes/
+
+The first send to a peer connects and runs the password handshake. Later
+sends, from any process, reuse that session, so a job costs one local
+round trip on top of the transfer itself. Sessions idle for
+DAEMON_IDLE_TIMEOUT are closed. `send` starts the daemon when it isn't
+running. The socket is only accessible to our own user.
+
+Requests and replies are JSON lines. A request is {"op": "send", "to":
+"host:port", "password": ..., "files": [...]}, {"op": "status"} or
+{"op": "stop"}. A send is answered with one line per file and a final
+{"done": true, ...} line.
+"""
+import getpass
+import hashlib
+import hmac
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import metrics
+import netprofile
+import secure
+from chat import Channel, TEXT, CONTROL, FILE_OFFER, ACK, PING, client_handshake
+from constants import (DEFAULT_PORT, DEFAULT_FILE_PORT, TRANSFER_RETRIES, RETRY_DELAY,
+                       STRIPE_THRESHOLD, DAEMON_SOCKET, DAEMON_LOG, DAEMON_IDLE_TIMEOUT,
+                       DAEMON_START_TIMEOUT)
+from filetransfer import FileTransfer, flat_paths
+from mux import Mux
+from scheduler import Scheduler
+
+
+def _fingerprint(password):
+    return hashlib.blake2b(password.encode(), digest_size=16).digest()
+
+
+def split_address(text):
+    """'host:port' (or just 'host') -> (host, port)."""
+    host, _, port = text.rpartition(':') if ':' in text else (text, '', '')
+    if not host:
+        raise ValueError(f"Bad address {text!r}; expected host:port")
+    return host, int(port) if port else DEFAULT_PORT
+
+
+class PooledPeer:
+    """
+    An authenticated connection to one hosting peer, shared by every job
+    sent there. Transfers take the same route as Peer's: streams on this
+    connection when the host is tunneled, else the file port.
+    """
+
+    def __init__(self, host, port, password):
+        self.host = host
+        self.port = port
+        self.secret = _fingerprint(password)
+        self.profile = netprofile.guess(host)
+        self.sock = netprofile.connect((host, port), self.profile, chat=True)
+        self.channel = Channel(self.sock)
+        ok, features = client_handshake(self.channel, password)
+        if not ok:
+            self.sock.close()
+            raise ConnectionError(f"Handshake failed: {features}")
+        self.tunnel = 'mux' in features.split()
+        self.single_files = 'single' in features.split()  # async host: no stripes or batches
+        if self.tunnel:
+            self.profile = netprofile.PROFILES['tunnel']
+            netprofile.apply(self.sock, self.profile, chat=True)
+        self.mux = Mux(self.channel, True, lambda stream: stream.close())  # we only send
+        self.alive = True
+        self.busy = 0
+        self.last_used = time.monotonic()
+        threading.Thread(target=self._receive_loop, daemon=True).start()
+
+    def _receive_loop(self):
+        try:
+            for ftype, payload in self.channel:
+                if self.mux.handle(ftype, payload):
+                    continue
+                if ftype == PING:
+                    self.mux.send(ACK, bytes(payload))
+                elif ftype == TEXT:
+                    print(f"[{self.host}] {str(payload, 'utf-8', 'replace')}")
+                elif ftype == CONTROL and bytes(payload) == b'bye':
+                    break
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.alive = False
+            self.mux.close_all()
+            self.sock.close()
+
+    def _open_transfer(self, meter, job, scheduler):
+        if self.tunnel:
+            sock = self.mux.open_stream()
+        else:
+            sock = netprofile.connect((self.host, DEFAULT_FILE_PORT), self.profile)
+        metrics.attach(sock, meter)
+        if not self.tunnel:
+            try:
+                sock = self.channel.session.secure_outgoing(sock)
+            except OSError:
+                sock.close()
+                raise
+        job.meter = meter
+        return scheduler.wrap(sock, job)
+
+    def send(self, path, job, scheduler):
+        """Send a file (or a directory/glob as one batch); returns (success, message)."""
+        if not self.alive:
+            return False, "Connection to the peer was lost"
+        name = os.path.basename(os.path.normpath(path))
+        single = os.path.isfile(path)
+        if not single and self.single_files:
+            return self._send_each(path, job, scheduler)
+        self.mux.send(FILE_OFFER, f"{name}|{os.path.getsize(path) if single else '?'}")
+        meter = metrics.track('send', name=name, total=os.path.getsize(path) if single else None)
+        connect = lambda: self._open_transfer(meter, job, scheduler)
+        success, msg = False, "Not sent"
+        for attempt in range(1, TRANSFER_RETRIES + 1):
+            try:
+                if (single and os.path.getsize(path) >= STRIPE_THRESHOLD and not self.tunnel
+                        and not self.single_files):
+                    success, msg = FileTransfer.send_striped(connect, path)
+                else:
+                    sock = connect()
+                    try:
+                        if single:
+                            success, msg = FileTransfer.send_file(sock, path, resume=True,
+                                                                  compress=True, verify=True)
+                        else:
+                            success, msg = FileTransfer.send_batch(sock, path, compress=True)
+                    finally:
+                        sock.close()
+            except Exception as e:
+                success, msg = False, str(e)
+            if success or job.cancelled or not self.alive or not single:
+                break
+            time.sleep(RETRY_DELAY * attempt)
+        meter.finish(success)
+        return success, msg
+
+    def _send_each(self, spec, job, scheduler):
+        """A directory or glob sent file by file, for a host that refuses batches."""
+        try:
+            paths = flat_paths(spec)
+        except ValueError as e:
+            return False, str(e)
+        if not paths:
+            return False, f"Nothing to send: {spec}"
+        for path in paths:
+            if job.cancelled:
+                return False, "Cancelled"
+            success, msg = self.send(path, job, scheduler)
+            if not success:
+                return False, f"{os.path.basename(path)}: {msg}"
+        return True, f"Sent {len(paths)} files one by one"
+
+    def close(self):
+        try:
+            self.mux.send(CONTROL, "bye")
+        except OSError:
+            pass
+        self.alive = False
+        self.sock.close()
+
+
+class Daemon:
+    """Serves requests on the Unix socket at `path` until a stop request."""
+
+    def __init__(self, path=DAEMON_SOCKET, idle_timeout=DAEMON_IDLE_TIMEOUT):
+        self.path = os.path.expanduser(path)
+        self.idle_timeout = idle_timeout
+        self.pool = {}  # (host, port) -> PooledPeer
+        self.lock = threading.Lock()
+        self.connecting = {}  # (host, port) -> lock: a host takes one connection, so one handshake
+        self.scheduler = Scheduler()
+        self.server = None
+        self.running = False
+
+    def serve(self):
+        if _reachable(self.path):
+            raise OSError(f"A daemon is already listening on {self.path}")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        try:
+            os.remove(self.path)  # left behind by a daemon that died
+        except FileNotFoundError:
+            pass
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)  # the socket hands out our sessions: owner only
+        try:
+            self.server.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.server.listen(16)
+        self.running = True
+        print(f"pc2termux daemon listening on {self.path}")
+        threading.Thread(target=self._reap_idle, daemon=True).start()
+        try:
+            while self.running:
+                try:
+                    conn, _ = self.server.accept()
+                except OSError:
+                    break  # closed by a stop request
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            self.running = False
+            self.server.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            with self.lock:
+                peers = list(self.pool.values())
+                self.pool.clear()
+            for peer in peers:
+                peer.close()
+
+    def _reap_idle(self):
+        while self.running:
+            time.sleep(min(self.idle_timeout, 30))
+            now = time.monotonic()
+            with self.lock:
+                idle = [key for key, peer in self.pool.items()
+                        if not peer.alive or (not peer.busy and
+                                              now - peer.last_used > self.idle_timeout)]
+                peers = [self.pool.pop(key) for key in idle]
+            for peer in peers:
+                if peer.alive:
+                    print(f"Closing idle session to {peer.host}:{peer.port}")
+                peer.close()
+
+    def session(self, host, port, password):
+        """(PooledPeer, reused) for host:port, connecting and authenticating if needed."""
+        key = (host, port)
+        with self.lock:
+            gate = self.connecting.setdefault(key, threading.Lock())
+        with gate:
+            with self.lock:
+                peer = self.pool.get(key)
+            if peer is not None and peer.alive:
+                # a host takes a single connection, so a wrong password must not cost us this one
+                if password and not hmac.compare_digest(peer.secret, _fingerprint(password)):
+                    raise ValueError(f"Wrong password for the session to {host}:{port}")
+                return peer, True
+            if not password:
+                raise ValueError(f"No session to {host}:{port} yet; a password is needed")
+            peer = PooledPeer(host, port, password)
+            print(f"Connected to {host}:{port}" + (" (tunneled)" if peer.tunnel else ''))
+            with self.lock:
+                self.pool[key] = peer
+            return peer, False
+
+    def _handle(self, conn):
+        with conn:
+            try:
+                line = conn.makefile('rb').readline()
+                request = json.loads(line)
+                op = request.get('op')
+                if op == 'send':
+                    self._send(conn, request)
+                elif op == 'status':
+                    _reply(conn, {'sessions': self.status()})
+                elif op == 'stop':
+                    _reply(conn, {'ok': True})
+                    self.running = False
+                    self.server.shutdown(socket.SHUT_RDWR)  # wakes the accept() in serve
+                else:
+                    _reply(conn, {'ok': False, 'message': f"Unknown request {op!r}"})
+            except (OSError, ValueError, AttributeError) as e:
+                try:
+                    _reply(conn, {'done': True, 'ok': False, 'message': str(e)})
+                except OSError:
+                    pass
+
+    def _send(self, conn, request):
+        t0 = time.perf_counter()
+        host, port = split_address(str(request.get('to', '')))
+        try:
+            peer, reused = self.session(host, port, request.get('password') or '')
+        except (OSError, ValueError) as e:
+            _reply(conn, {'done': True, 'ok': False, 'message': str(e)})
+            return
+        setup = time.perf_counter() - t0
+        with self.lock:
+            peer.busy += 1
+        try:
+            jobs = []
+            for path in request.get('files', []):
+                run = lambda job, path=path: peer.send(path, job, self.scheduler)
+                jobs.append((path, self.scheduler.submit(path, run, request.get('priority', 0),
+                                                         peer=host)))
+            ok = True
+            for path, job in jobs:
+                job.wait()
+                ok = ok and job.state == 'done'
+                _reply(conn, {'file': path, 'ok': job.state == 'done', 'message': job.message})
+        finally:
+            with self.lock:
+                peer.busy -= 1
+                peer.last_used = time.monotonic()
+        _reply(conn, {'done': True, 'ok': ok, 'reused': reused, 'setup_ms': round(setup * 1000, 1),
+                      'elapsed_ms': round((time.perf_counter() - t0) * 1000, 1)})
+
+    def status(self):
+        now = time.monotonic()
+        with self.lock:
+            return [{'to': f"{peer.host}:{peer.port}", 'tunnel': peer.tunnel, 'busy': peer.busy,
+                     'idle_s': round(now - peer.last_used)}
+                    for peer in self.pool.values() if peer.alive]
+
+
+def _reply(conn, message):
+    conn.sendall(json.dumps(message).encode() + b'\n')
+
+
+def _reachable(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def request(message, path=DAEMON_SOCKET, autostart=False):
+    """Send one request to the daemon and yield its replies; can start the daemon first."""
+    path = os.path.expanduser(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if not autostart:
+                raise
+            _start_daemon(path)
+            sock.connect(path)
+        sock.sendall(json.dumps(message).encode() + b'\n')
+        for line in sock.makefile('rb'):
+            yield json.loads(line)
+    finally:
+        sock.close()
+
+
+def _start_daemon(path):
+    """Start `main.py daemon` in the background and wait until it listens."""
+    log_path = os.path.expanduser(DAEMON_LOG)
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    main = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    options = ['--plaintext'] if secure.plaintext_allowed() else []
+    with open(log_path, 'ab') as log:
+        subprocess.Popen([sys.executable, '-u', main] + options + ['daemon', '--socket', path],
+                         stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                         start_new_session=True)
+    print(f"Started the pc2termux daemon (log: {log_path})", file=sys.stderr)
+    deadline = time.monotonic() + DAEMON_START_TIMEOUT
+    while not _reachable(path):
+        if time.monotonic() > deadline:
+            raise ConnectionError(f"The daemon did not start; see {log_path}")
+        time.sleep(0.05)
+
+
+def add_daemon_arguments(parser):
+    parser.add_argument('--socket', default=DAEMON_SOCKET, help="Unix socket to listen on")
+    parser.add_argument('--idle', type=int, default=DAEMON_IDLE_TIMEOUT, metavar='SECONDS',
+                        help="close peer sessions unused for this long")
+    parser.add_argument('--status', action='store_true', help="list the running daemon's sessions")
+    parser.add_argument('--stop', action='store_true', help="stop the running daemon")
+
+
+def add_send_arguments(parser):
+    parser.add_argument('--to', required=True, metavar='HOST:PORT', help="a hosting peer")
+    parser.add_argument('--password', help="the host's password (default: $PC2TERMUX_PASSWORD; "
+                                           "not needed while the daemon has a session)")
+    parser.add_argument('-p', '--priority', type=int, default=0)
+    parser.add_argument('--socket', default=DAEMON_SOCKET, help="the daemon's Unix socket")
+    parser.add_argument('files', nargs='+', help="files, directories or globs")
+
+
+def run_daemon_from_args(args):
+    if not hasattr(socket, 'AF_UNIX'):
+        print("The daemon needs Unix sockets, which this platform lacks.")
+        return 1
+    if args.status or args.stop:
+        try:
+            for reply in request({'op': 'stop' if args.stop else 'status'}, args.socket):
+                for session in reply.get('sessions', []):
+                    print(f"  {session['to']}  idle {session['idle_s']}s"
+                          + (f", {session['busy']} running" if session['busy'] else '')
+                          + (" (tunneled)" if session['tunnel'] else ''))
+                if args.stop:
+                    print("Daemon stopped")
+                elif not reply.get('sessions'):
+                    print("  (no sessions)")
+        except OSError:
+            print("The daemon is not running")
+            return 1
+        return 0
+    try:
+        Daemon(args.socket, args.idle).serve()
+    except OSError as e:
+        print(e)
+        return 1
+    return 0
+
+
+def _submit(args, files, password):
+    """One send request; returns (every file arrived, the daemon wants a password)."""
+    message = {'op': 'send', 'to': args.to, 'password': password, 'files': files,
+               'priority': args.priority}
+    try:
+        for reply in request(message, args.socket, autostart=True):
+            if 'file' in reply:
+                status = 'ok' if reply['ok'] else 'FAILED'
+                print(f"{status}  {reply['file']}: {reply['message']}")
+            elif reply.get('done'):
+                if 'reused' not in reply:
+                    print(reply['message'], file=sys.stderr)
+                    return False, 'password is needed' in reply['message']
+                print(f"{'reused session' if reply['reused'] else 'new session'}, "
+                      f"setup {reply['setup_ms']} ms, total {reply['elapsed_ms']} ms",
+                      file=sys.stderr)
+                return reply['ok'], False
+    except OSError as e:
+        print(f"Daemon error: {e}", file=sys.stderr)
+    return False, False
+
+
+def run_send_from_args(args):
+    """The client: exit status 0 only if every file arrived."""
+    # the daemon has its own working directory
+    files = [os.path.abspath(os.path.expanduser(f)) for f in args.files]
+    password = args.password or os.environ.get('PC2TERMUX_PASSWORD')
+    ok, needs_password = _submit(args, files, password)
+    if needs_password and sys.stdin.isatty():
+        ok, _ = _submit(args, files, getpass.getpass("Password: "))
+    return 0 if ok else 1
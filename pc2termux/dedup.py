@@ -0,0 +1,271 @@
+"""
+Content-addressed receive cache and rsync-style block deltas.
+
+The receiver keeps every completed file in a size-bounded LRU store keyed
+by its BLAKE2b digest, so a file it already has costs one round trip.
+When only an older version exists, the receiver sends per-block
+signatures (adler32 + short BLAKE2b) and the sender answers with copy
+instructions for unchanged blocks and literal bytes for the rest.
+"""
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from constants import (CAS_DIR, CAS_MAX_BYTES, DELTA_BLOCK_SIZE, DELTA_ROLL_BUDGET,
+                       DIGEST_CACHE_ENTRIES)
+
+_SIG = struct.Struct('!I8s')   # adler32, truncated blake2b
+_OP_HEAD = struct.Struct('!cI')
+
+_digest_cache = OrderedDict()  # (path, size, mtime_ns) -> hex digest, least recently used first
+_digest_lock = threading.Lock()
+_stores = {}  # real path of a receive directory -> its shared ContentStore
+_stores_lock = threading.Lock()
+
+
+def file_digest(path):
+    """Strong hash of a whole file, cached while size and mtime are unchanged."""
+    st = os.stat(path)
+    key = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+    with _digest_lock:
+        if key in _digest_cache:
+            _digest_cache.move_to_end(key)
+            return _digest_cache[key]
+    h = hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    with _digest_lock:
+        _digest_cache[key] = h.hexdigest()
+        while len(_digest_cache) > DIGEST_CACHE_ENTRIES:
+            _digest_cache.popitem(last=False)
+    return h.hexdigest()
+
+
+def content_store(save_dir):
+    """
+    The ContentStore of a receive directory. Concurrent receives share one
+    instance, and so its lock, so they can't overwrite each other's index.
+    """
+    key = os.path.realpath(save_dir)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = ContentStore(save_dir)
+        return store
+
+
+def _strong(data):
+    return hashlib.blake2b(data, digest_size=8).digest()
+
+
+class ContentStore:
+    """
+    Size-bounded LRU store of received files, keyed by file_digest(). Get
+    one through content_store() so a directory has a single index writer.
+    """
+
+    def __init__(self, save_dir, max_bytes=CAS_MAX_BYTES):
+        self.root = os.path.join(save_dir, CAS_DIR)
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(self.root, 'index.json')
+        self.lock = threading.Lock()
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {'objects': {}, 'names': {}}
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _save(self):
+        os.makedirs(self.root, exist_ok=True)
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.index_path)
+
+    def _valid(self, digest):
+        """An object is usable only if nobody changed it since we stored it."""
+        entry = self.index['objects'].get(digest)
+        if not entry:
+            return False
+        try:
+            st = os.stat(self._object_path(digest))
+        except OSError:
+            return False
+        return st.st_size == entry['size'] and st.st_mtime_ns == entry['mtime_ns']
+
+    def has(self, digest):
+        with self.lock:
+            return self._valid(digest)
+
+    def materialize(self, digest, dest):
+        """Copy a stored object to `dest`; returns False if it is gone or stale."""
+        with self.lock:
+            if not self._valid(digest):
+                self.index['objects'].pop(digest, None)
+                return False
+            obj = self._object_path(digest)
+            if not (os.path.exists(dest) and os.path.samefile(obj, dest)):
+                # copy beside and swap in: dest may be a hard link to another object
+                shutil.copyfile(obj, dest + '.cas-tmp')
+                os.replace(dest + '.cas-tmp', dest)
+            self.index['objects'][digest]['used'] = time.time()
+            self._save()
+        return True
+
+    def put(self, path, digest, name):
+        """Add a received file (hard-linked when possible) and evict to fit."""
+        with self.lock:
+            obj = self._object_path(digest)
+            if not self._valid(digest):
+                os.makedirs(os.path.dirname(obj), exist_ok=True)
+                tmp = obj + '.tmp'
+                try:
+                    os.link(path, tmp)
+                except OSError:
+                    shutil.copyfile(path, tmp)
+                os.replace(tmp, obj)
+            st = os.stat(obj)
+            self.index['objects'][digest] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                                             'used': time.time()}
+            self.index['names'][name] = digest
+            self._evict()
+            self._save()
+
+    def basis_for(self, name, filepath):
+        """The best old version to delta against: the file itself, else the last stored one."""
+        if os.path.isfile(filepath):
+            return filepath
+        with self.lock:
+            digest = self.index['names'].get(name)
+            if digest and self._valid(digest):
+                return self._object_path(digest)
+        return None
+
+    def _evict(self):
+        objects = self.index['objects']
+        total = sum(e['size'] for e in objects.values())
+        for digest in sorted(objects, key=lambda d: objects[d]['used']):
+            if total <= self.max_bytes:
+                break
+            total -= objects.pop(digest)['size']
+            try:
+                os.remove(self._object_path(digest))
+            except OSError:
+                pass
+        live = set(objects)
+        self.index['names'] = {n: d for n, d in self.index['names'].items() if d in live}
+
+
+def block_signatures(path, block=DELTA_BLOCK_SIZE):
+    """Receiver side: packed (weak, strong) signature per block of the basis file."""
+    out = bytearray()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(block), b''):
+            out += _SIG.pack(zlib.adler32(chunk), _strong(chunk))
+    return bytes(out)
+
+
+def delta_ops(path, signatures, block=DELTA_BLOCK_SIZE):
+    """
+    Sender side: yield encoded delta instructions that rebuild `path` from
+    the basis described by `signatures`. Aligned blocks are matched by
+    strong hash at C speed; after a miss an adler32 window is rolled up to
+    one block ahead to catch insertions and deletions, within an overall
+    DELTA_ROLL_BUDGET so wholly new files don't crawl through Python.
+    """
+    strong_index = {}
+    weak_index = set()
+    for i in range(len(signatures) // _SIG.size):
+        weak, strong = _SIG.unpack_from(signatures, i * _SIG.size)
+        strong_index.setdefault(strong, i)
+        weak_index.add(weak)
+    size = os.path.getsize(path)
+    if size == 0:
+        yield b'E'
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        pos = literal = 0
+        rolled = 0
+        while pos + block <= size:
+            idx = strong_index.get(_strong(m[pos:pos + block]))
+            if idx is None and rolled < DELTA_ROLL_BUDGET:
+                hit, stop = _roll(m, pos, min(size - block, pos + block), block,
+                                  weak_index, strong_index)
+                rolled += stop - pos
+                if hit is not None:
+                    pos, idx = hit
+            if idx is None:
+                pos += block
+                continue
+            yield from _literal(m, literal, pos)
+            yield _OP_HEAD.pack(b'C', idx)
+            pos += block
+            literal = pos
+        tail = m[literal:size]
+        idx = strong_index.get(_strong(tail)) if 0 < size - literal <= block else None
+        if idx is not None:
+            yield _OP_HEAD.pack(b'C', idx)
+        else:
+            yield from _literal(m, literal, size)
+    yield b'E'
+
+
+def _roll(m, pos, limit, block, weak_index, strong_index):
+    """Slide an adler32 window from pos+1 to limit; returns ((pos, idx) or None, stop)."""
+    weak = zlib.adler32(m[pos:pos + block])
+    a, b = weak & 0xffff, weak >> 16
+    q = pos
+    while q < limit:
+        out, new = m[q], m[q + block]
+        a = (a - out + new) % 65521
+        b = (b - block * out + a - 1) % 65521
+        q += 1
+        if (b << 16 | a) in weak_index:
+            idx = strong_index.get(_strong(m[q:q + block]))
+            if idx is not None:
+                return (q, idx), q
+    return None, q
+
+
+def _literal(m, start, end, piece=1024 * 1024):
+    while start < end:
+        n = min(piece, end - start)
+        yield _OP_HEAD.pack(b'D', n) + m[start:start + n]
+        start += n
+
+
+def _read_exact(stream, n):
+    data = stream.read(n)
+    if data is None or len(data) < n:
+        raise ConnectionError("Delta stream cut off")
+    return data
+
+
+def apply_delta(stream, basis_path, out, block=DELTA_BLOCK_SIZE):
+    """Receiver side: rebuild a file into `out` from `basis_path` and the op stream."""
+    written = 0
+    with open(basis_path, 'rb') as basis:
+        while True:
+            op = _read_exact(stream, 1)
+            if op == b'E':
+                return written
+            (n,) = struct.unpack('!I', _read_exact(stream, 4))
+            if op == b'C':
+                basis.seek(n * block)
+                data = basis.read(block)
+            elif op == b'D':
+                data = _read_exact(stream, n)
+            else:
+                raise ValueError(f"Bad delta op {op!r}")
+            out.write(data)
+            written += len(data)
@@ -0,0 +1,260 @@
+"""
+Slow network lookups kept off the startup path: the public IP and the
+peers hosting on the LAN. Each lookup runs in a background thread with a
+strict timeout. A successful result is cached on disk with a TTL, so the
+next start has it at once, even offline.
+
+LAN peers answer a UDP query (broadcast and multicast) on BEACON_PORT
+with their ports while they host. When nobody answers (broadcast
+filtered, an older peer), a concurrent TCP connect sweep of the /24
+finds anything listening on the chat port.
+"""
+import json
+import os
+import secrets
+import socket
+import threading
+import time
+from constants import (DISCOVERY_CACHE, DISCOVERY_TTL, PUBLIC_IP_TIMEOUT, DEFAULT_PORT,
+                       DEFAULT_FILE_PORT, BEACON_PORT, BEACON_GROUP, BEACON_TIMEOUT,
+                       SWEEP_TIMEOUT, SWEEP_CONCURRENCY, LAN_PEERS_TTL)
+from utils import get_public_ip
+
+_QUERY = b'pc2termux-discover 1'
+
+
+class Cache:
+    """A small JSON file of key -> value, each stamped with when it was stored."""
+
+    def __init__(self, path=DISCOVERY_CACHE):
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+
+    def get(self, key, ttl=DISCOVERY_TTL):
+        """The stored value, or None if it is missing or older than `ttl` seconds."""
+        with self.lock:
+            entry = self.data.get(key)
+        if isinstance(entry, dict) and time.time() - entry.get('at', 0) < ttl:
+            return entry.get('value')
+        return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = {'value': value, 'at': time.time()}
+            snapshot = json.dumps(self.data)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp, 'w') as f:
+                f.write(snapshot)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass  # a read-only home just means no cache
+
+
+class Discovery:
+    """Background lookups whose results are read later with result()."""
+
+    def __init__(self, cache=None):
+        self.cache = cache or Cache()
+        self.results = {}
+        self.events = {}
+        self._public_key = None
+        self._lan = None
+
+    def start(self, key, lookup, ttl=DISCOVERY_TTL):
+        """
+        Run lookup() in a thread unless the cache has a fresh value for
+        `key`. With ttl=None the cache is neither read nor written.
+        """
+        done = self.events[key] = threading.Event()
+        cached = self.cache.get(key, ttl) if ttl is not None else None
+        if cached is not None:
+            self.results[key] = cached
+            done.set()
+            return
+
+        def run():
+            try:
+                value = lookup()
+            except Exception:
+                value = None
+            if value is not None:
+                self.results[key] = value
+                if ttl is not None:
+                    self.cache.put(key, value)
+            done.set()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def result(self, key, wait=0):
+        """The value found for `key`, waiting up to `wait` seconds; None if not (yet) known."""
+        done = self.events.get(key)
+        if done is not None and wait:
+            done.wait(wait)
+        return self.results.get(key)
+
+    def find_public_ip(self, local_ip):
+        # keyed by the local address: a different network likely means a different public IP
+        def lookup():
+            ip = get_public_ip(PUBLIC_IP_TIMEOUT)
+            return None if ip == 'Unknown' else ip
+        self._public_key = f"public_ip@{local_ip}"
+        self.start(self._public_key, lookup)
+
+    def public_ip(self, wait=0):
+        return self.result(self._public_key, wait)
+
+    def find_lan_peers(self, local_ip, exclude=None):
+        """Start asking the LAN who is hosting (our own responder's id is `exclude`)."""
+        self._lan = (local_ip, exclude)
+        self.start('lan_beacon', lambda: query_beacons(local_ip, exclude=exclude), ttl=None)
+
+    def lan_peers(self, sweep_if_silent=True):
+        """
+        Hosting peers as [{'ip', 'port', 'via', ...}], newest first: the
+        beacon replies, or the sweep's finds when there were none, followed
+        by peers remembered from earlier runs (via 'cached'). Empty until
+        find_lan_peers() has started a lookup.
+        """
+        if self._lan is None:
+            return []
+        local_ip, _ = self._lan
+        fresh = self.result('lan_beacon', wait=BEACON_TIMEOUT + 1) or []
+        if not fresh and sweep_if_silent:
+            fresh = sweep(local_ip)
+        now = time.time()
+        known = {}
+        for peer in self.cache.get('lan_peers', LAN_PEERS_TTL) or []:
+            if now - peer.get('seen', 0) < LAN_PEERS_TTL:
+                known[f"{peer['ip']}:{peer['port']}"] = dict(peer, via='cached')
+        for peer in fresh:
+            known[f"{peer['ip']}:{peer['port']}"] = dict(peer, seen=now)
+        peers = sorted(known.values(), key=lambda peer: -peer['seen'])
+        if fresh:
+            self.cache.put('lan_peers', peers)
+        return peers
+
+
+def describe(peer):
+    """One pick-list line for a peer from lan_peers()."""
+    name = f"  {peer['name']}" if peer.get('name') else ''
+    hub = "  (hub)" if peer.get('hub') else ''
+    return f"{peer['ip']}:{peer['port']}{name}{hub}  [{peer['via']}]"
+
+
+def _subnet_hosts(local_ip):
+    """The other addresses of local_ip's /24, the range find_ip.sh pings."""
+    base = local_ip.rsplit('.', 1)[0]
+    return [f"{base}.{i}" for i in range(1, 255) if f"{base}.{i}" != local_ip]
+
+
+class BeaconResponder:
+    """
+    Answers discovery queries on BEACON_PORT with the dict info()
+    returns (our ports while hosting), or stays silent when it returns
+    None. Several instances on one machine can share the port.
+    """
+
+    def __init__(self, info, port=BEACON_PORT):
+        self.info = info
+        self.id = secrets.token_hex(4)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        try:
+            self.sock.bind(('', port))
+        except OSError:
+            self.sock.close()
+            raise
+        try:
+            membership = socket.inet_aton(BEACON_GROUP) + socket.inet_aton('0.0.0.0')
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except OSError:
+            pass  # no multicast route (offline); broadcast still works
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(512)
+            except OSError:
+                return
+            if not data.startswith(_QUERY):
+                continue
+            info = self.info()
+            if info is None:
+                continue
+            reply = json.dumps(dict(info, service='pc2termux', id=self.id)).encode()
+            try:
+                self.sock.sendto(reply, addr)
+            except OSError:
+                pass
+
+    def close(self):
+        self.sock.close()
+
+
+def query_beacons(local_ip, timeout=BEACON_TIMEOUT, exclude=None, port=BEACON_PORT):
+    """Ask the LAN who is hosting; collects replies for `timeout` seconds."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    found = {}
+    try:
+        subnet_broadcast = local_ip.rsplit('.', 1)[0] + '.255'
+        for target in (BEACON_GROUP, '255.255.255.255', subnet_broadcast):
+            try:
+                sock.sendto(_QUERY, (target, port))
+            except OSError:
+                pass  # e.g. no route for multicast
+        deadline = time.monotonic() + timeout
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            sock.settimeout(left)
+            try:
+                data, addr = sock.recvfrom(2048)
+                info = json.loads(data)
+            except (socket.timeout, ValueError):
+                continue
+            except OSError:
+                break
+            if not isinstance(info, dict) or info.get('service') != 'pc2termux':
+                continue
+            if info.get('id') == exclude:
+                continue
+            # the same instance may answer the broadcast and the multicast query
+            found[info.get('id')] = {'ip': addr[0], 'port': int(info.get('port', DEFAULT_PORT)),
+                                     'file_port': int(info.get('file_port', DEFAULT_FILE_PORT)),
+                                     'name': str(info.get('name', '')),
+                                     'hub': bool(info.get('hub')), 'via': 'beacon'}
+    finally:
+        sock.close()
+    return list(found.values())
+
+
+def sweep(local_ip, port=DEFAULT_PORT, timeout=SWEEP_TIMEOUT, concurrency=SWEEP_CONCURRENCY):
+    """TCP-connect to `port` on every other host of the /24 at once; returns those that accept."""
+    import asyncio  # slow to import; only needed when no beacon answered
+
+    async def probe(ip, gate):
+        async with gate:
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+            except (OSError, asyncio.TimeoutError):
+                return None
+            writer.close()
+            return ip
+
+    async def run():
+        gate = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(*(probe(ip, gate) for ip in _subnet_hosts(local_ip)))
+
+    return [{'ip': ip, 'port': port, 'via': 'scan'} for ip in asyncio.run(run()) if ip]
@@ -1,53 +1,1343 @@
+import errno
+import glob
+import hashlib
+import io
+import json
+import mmap
 import os
-from constants import BUFFER_SIZE
+import queue
+import secrets
+import select
+import struct
+import threading
+import time
+from metrics import meter_for
+from netprofile import chunk_for
+from compression import (CompressWriter, DecompressReader, available_codecs, offer_codecs,
+                         pick_codec)
+from dedup import (apply_delta, block_signatures, content_store, delta_ops,
+                   file_digest)
+from constants import (BUFFER_SIZE, RECV_BUFFER_SIZE, MMAP_WINDOW,
+                       RESUME_BLOCK_SIZE, STRIPE_RANGE_SIZE, STRIPE_MAX_STREAMS,
+                       STRIPE_IDLE_TIMEOUT, TRANSFER_RETRIES, BATCH_INLINE_LIMIT,
+                       BATCH_COALESCE_SIZE, BATCH_PREFETCH_BYTES, DELTA_BLOCK_SIZE,
+                       DELTA_MAX_SIZE, VERIFY_CHUNK, STREAM_CHUNK)
+
+_CHUNK_HEAD = struct.Struct('!I')  # length of each chunk of a stream transfer; 0 ends it
+
+# errors meaning "sendfile can't be used here", as opposed to a broken connection
+_SENDFILE_UNSUPPORTED = {errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+                         errno.EOPNOTSUPP, errno.EBADF, errno.ESPIPE}
+
+
+def _sendfile_chunk(sock, f, offset, count):
+    """One os.sendfile call; waits for writability on sockets with a timeout."""
+    while True:
+        try:
+            return os.sendfile(sock.fileno(), f.fileno(), offset, count)
+        except BlockingIOError:
+            # a socket timeout makes the fd non-blocking underneath
+            if not select.select([], [sock], [], sock.gettimeout())[1]:
+                raise TimeoutError("send timed out")
+
+
+def _record_size(sock):
+    """The record size of an encrypting layer under `sock`, else BUFFER_SIZE."""
+    for _ in range(4):
+        size = getattr(sock, 'record_size', None)
+        if size:
+            return size
+        sock = getattr(sock, 'sock', None)
+        if sock is None:
+            break
+    return BUFFER_SIZE
+
+
+def _copy_loop(sock, f, offset, end):
+    """
+    Portable fallback: readinto a reused buffer and sendall it. An
+    encrypted socket gets whole records, one per sendall.
+    """
+    buf = bytearray(_record_size(sock))
+    view = memoryview(buf)
+    meter = meter_for(sock)
+    f.seek(offset)
+    clock = time.perf_counter
+    while offset < end:
+        t0 = clock()
+        n = f.readinto(view[:min(len(buf), end - offset)])
+        if not n:
+            break
+        t1 = clock()
+        sock.sendall(view[:n])
+        meter.disk(t1 - t0)
+        meter.net(n, clock() - t1)
+        offset += n
+    return offset
+
+
+def _read_line(sock, data=b''):
+    """Read up to the next newline, starting from any bytes already read off
+    the socket; returns (line, bytes read past it)."""
+    while b'\n' not in data:
+        if len(data) > BUFFER_SIZE:
+            raise ValueError("Header too long")
+        chunk = sock.recv(BUFFER_SIZE)
+        if not chunk:
+            return None, b''
+        data += chunk
+    line, rest = data.split(b'\n', 1)
+    return line.decode(), rest
+
+
+def _read_exact(sock, n, data=b''):
+    """Read exactly n bytes, starting from any already read off the socket."""
+    data = bytearray(data)
+    while len(data) < n:
+        chunk = sock.recv(min(RECV_BUFFER_SIZE, n - len(data)))
+        if not chunk:
+            raise ConnectionError("Connection closed mid-message")
+        data += chunk
+    return bytes(data)
+
+
+def _format_options(options):
+    return ';'.join(f"{k}={v}" for k, v in options.items())
+
+
+def _parse_options(text):
+    options = {}
+    for item in text.split(';'):
+        if '=' in item:
+            key, value = item.split('=', 1)
+            options[key] = value
+    return options
+
+
+def _format_header(filename, filesize, options=None):
+    """
+    Header line: "filename|filesize" plus an optional "|k=v;k=v" field.
+    A header carrying options tells the receiver to answer with a line.
+    """
+    header = f"{filename}|{filesize}"
+    if options:
+        header += '|' + _format_options(options)
+    return (header + '\n').encode()
+
+
+def _send_reply(sock, options):
+    sock.sendall((_format_options(options) + '\n').encode())
+
+
+def _parse_header(line):
+    fields = line.split('|', 2)
+    options = _parse_options(fields[2]) if len(fields) > 2 else {}
+    return os.path.basename(fields[0]), int(fields[1]), options
+
+
+def _preallocate(f, size):
+    """Reserve `size` bytes on disk up front so writes never extend the file."""
+    f.flush()
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except (AttributeError, OSError):
+        f.truncate(size)  # no fallocate here, or the filesystem refuses it
+
+
+def _recv_buffered(sock, f, received, filesize, buffer_size, on_data=None):
+    """Fill f from the socket through one reused buffer."""
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    meter = meter_for(sock)
+    clock = time.perf_counter
+    while received < filesize:
+        t0 = clock()
+        n = sock.recv_into(view, min(buffer_size, filesize - received))
+        if not n:
+            break
+        t1 = clock()
+        f.write(view[:n])
+        meter.net(n, t1 - t0)
+        meter.disk(clock() - t1)
+        if on_data:
+            on_data(view[:n])
+        received += n
+    return received
+
+
+def _recv_mmap(sock, f, received, filesize, on_data=None):
+    """recv_into a sliding writable mmap window of the preallocated file."""
+    f.flush()
+    meter = meter_for(sock)
+    clock = time.perf_counter
+    while received < filesize:
+        # window offsets must be aligned to the allocation granularity
+        base = received - received % mmap.ALLOCATIONGRANULARITY
+        length = min(MMAP_WINDOW, filesize - base)
+        with mmap.mmap(f.fileno(), length, offset=base) as m:
+            view = memoryview(m)
+            try:
+                pos = received - base
+                while pos < length:
+                    t0 = clock()
+                    n = sock.recv_into(view[pos:])  # page faults count as network time
+                    if not n:
+                        return base + pos
+                    meter.net(n, clock() - t0)
+                    if on_data:
+                        on_data(view[pos:pos + n])
+                    pos += n
+            finally:
+                view.release()
+        received = base + length
+    return received
+
+
+class _Prepend(io.RawIOBase):
+    """Raw stream that yields some already-read bytes before the socket's."""
+
+    def __init__(self, sock, data):
+        super().__init__()
+        self.sock = sock
+        self.data = data
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.data:
+            n = min(len(b), len(self.data))
+            b[:n] = self.data[:n]
+            self.data = self.data[n:]
+            return n
+        return self.sock.recv_into(b)
+
+
+def _block_digest(data):
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+class _Checkpoint:
+    """
+    Sidecar for a .part file: the announced size/mtime plus one hash per
+    completed RESUME_BLOCK_SIZE block, so a reconnecting receiver knows
+    exactly which prefix of the .part file it can still trust.
+    """
+
+    def __init__(self, path, filesize, mtime):
+        self.path = path
+        self.filesize = filesize
+        self.mtime = mtime
+        self.hashes = []
+        self._hasher = hashlib.blake2b(digest_size=8)
+        self._filled = 0
+
+    @classmethod
+    def load(cls, path, filesize, mtime):
+        """Load the checkpoint if it describes the same file, else start empty."""
+        ckpt = cls(path, filesize, mtime)
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            if (state['size'] == filesize and state['mtime'] == mtime
+                    and state['block'] == RESUME_BLOCK_SIZE):
+                ckpt.hashes = state['hashes']
+        except (OSError, ValueError, KeyError):
+            pass
+        return ckpt
+
+    def verify(self, f):
+        """Re-hash the .part blocks on disk and drop everything from the first mismatch."""
+        good = 0
+        for index, expected in enumerate(self.hashes):
+            f.seek(index * RESUME_BLOCK_SIZE)
+            length = min(RESUME_BLOCK_SIZE, self.filesize - index * RESUME_BLOCK_SIZE)
+            if _block_digest(f.read(length)) != expected:
+                break
+            good += 1
+        self.hashes = self.hashes[:good]
+
+    @property
+    def offset(self):
+        return min(len(self.hashes) * RESUME_BLOCK_SIZE, self.filesize)
+
+    def rewind(self, offset):
+        """Forget blocks at or past `offset` (always a block boundary)."""
+        self.hashes = self.hashes[:offset // RESUME_BLOCK_SIZE]
+        self._hasher = hashlib.blake2b(digest_size=8)
+        self._filled = 0
+
+    def feed(self, data):
+        """Hash freshly received bytes, saving whenever a block completes."""
+        data = memoryview(data)
+        while data:
+            block_len = min(RESUME_BLOCK_SIZE, self.filesize - self.offset)
+            if block_len <= 0:
+                break
+            take = min(len(data), block_len - self._filled)
+            self._hasher.update(data[:take])
+            self._filled += take
+            data = data[take:]
+            if self._filled == block_len:
+                self.hashes.append(self._hasher.hexdigest())
+                self._hasher = hashlib.blake2b(digest_size=8)
+                self._filled = 0
+                self.save()
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'size': self.filesize, 'mtime': self.mtime,
+                       'block': RESUME_BLOCK_SIZE, 'hashes': self.hashes}, f)
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class _HashStage:
+    """
+    BLAKE2b of a file computed on its own thread, trailing behind whoever
+    streams the file: it re-reads bytes up to the `limit` watermark with
+    os.pread (page cache hits), and hashlib drops the GIL while hashing,
+    so verification overlaps the network I/O instead of following it.
+    """
+
+    def __init__(self, fd, limit=0):
+        self.fd = fd
+        self.limit = limit
+        self.pos = 0
+        self.final = None
+        self.error = None
+        self.hasher = hashlib.blake2b(digest_size=32)
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                with self.cond:
+                    while self.pos >= self.limit and self.final is None:
+                        self.cond.wait()
+                    end = self.limit if self.final is None else self.final
+                    if self.pos >= end:
+                        return
+                while self.pos < end:
+                    data = os.pread(self.fd, min(VERIFY_CHUNK, end - self.pos), self.pos)
+                    if not data:
+                        raise ValueError("File shorter than expected while hashing")
+                    self.hasher.update(data)
+                    self.pos += len(data)
+        except (OSError, ValueError) as e:
+            self.error = e
+
+    def advance(self, n):
+        with self.cond:
+            self.limit += n
+            self.cond.notify()
+
+    def follow(self, f, then=None):
+        """on_data callback for the receive loops: flush f, then let the hasher catch up."""
+        def on_data(view):
+            if then:
+                then(view)
+            f.flush()
+            self.advance(len(view))
+        return on_data
+
+    def hexdigest(self, total):
+        """Hash through byte `total` and return the hex digest."""
+        with self.cond:
+            self.final = total
+            self.cond.notify()
+        self.thread.join()
+        if self.error:
+            raise OSError(f"Hashing failed: {self.error}")
+        return self.hasher.hexdigest()
+
+
+def _matching_offset(f, filesize, blocks):
+    """Sender side: how much of the receiver's block list matches our file."""
+    offset = 0
+    for expected in blocks:
+        f.seek(offset)
+        length = min(RESUME_BLOCK_SIZE, filesize - offset)
+        if length <= 0 or _block_digest(f.read(length)) != expected:
+            break
+        offset += length
+    return offset
+
+
+class _StripedFile:
+    """Receiver-side state of one striped transfer, shared by its connections."""
+
+    def __init__(self, filepath, filesize):
+        self.filepath = filepath
+        self.filesize = filesize
+        self.part = filepath + '.part'
+        self.fd = os.open(self.part, os.O_RDWR | os.O_CREAT, 0o644)
+        with open(self.fd, 'r+b', closefd=False) as f:
+            _preallocate(f, filesize)
+        self.done = {}  # range offset -> length, so resent ranges count once
+        self.lock = threading.Lock()
+        self.touched = time.monotonic()
+
+    def complete(self):
+        return sum(self.done.values()) == self.filesize
+
+    def discard(self):
+        """Drop an abandoned transfer: close the file and delete the partial data."""
+        os.close(self.fd)
+        try:
+            os.remove(self.part)
+        except FileNotFoundError:
+            pass
+
+
+class _RangeSender:
+    """
+    Sender side of a striped transfer: a queue of fixed-size ranges drained by
+    worker connections, plus the byte counters the stream controller and the
+    final check watch. The receiver acknowledges every range it has written,
+    so a failed connection only hands back the ranges still unacknowledged.
+    """
+
+    def __init__(self, connect, filepath, zero_copy):
+        self.connect = connect
+        self.filepath = filepath
+        self.filename = os.path.basename(filepath)
+        self.filesize = os.path.getsize(filepath)
+        self.zero_copy = zero_copy
+        self.stripe_id = secrets.token_hex(8)
+        self.ranges = queue.Queue()
+        for offset in range(0, self.filesize, STRIPE_RANGE_SIZE):
+            self.ranges.put((offset, min(STRIPE_RANGE_SIZE, self.filesize - offset)))
+        self.sent = 0  # bytes put on the wire, resent ranges included
+        self.acked = 0  # bytes the receiver confirmed writing
+        self.complete = False  # the receiver reported the whole file done
+        self.error = None
+        self.cond = threading.Condition()
+
+    def worker(self):
+        failures = 0
+        while failures < TRANSFER_RETRIES:
+            pending = {}  # offset -> length sent on this connection, not yet acknowledged
+            try:
+                sock = self.connect()
+                try:
+                    self._drain(sock, pending)
+                finally:
+                    sock.close()
+                return
+            except (OSError, ValueError) as e:
+                failures += 1
+                with self.cond:
+                    unacked = list(pending.items())
+                    pending.clear()  # acks still trickling in from the dead connection don't count
+                    self.error = str(e)
+                for r in unacked:
+                    self.ranges.put(r)  # write-at-offset makes resending safe
+        with self.cond:
+            self.cond.notify_all()
+
+    def _drain(self, sock, pending):
+        options = {'stripe': self.stripe_id}
+        sock.sendall(_format_header(self.filename, self.filesize, options))
+        reply, rest = _read_line(sock)
+        if reply == 'done':
+            with self.cond:
+                self.complete = True  # the other connections finished the file first
+                self.cond.notify_all()
+            return
+        if reply != 'ready':
+            raise ConnectionError(f"Receiver refused stripe: {reply}")
+        status = []
+        acks = threading.Thread(target=self._read_acks, args=(sock, rest, pending, status),
+                                daemon=True)
+        acks.start()
+        with open(self.filepath, 'rb') as f:
+            while True:
+                try:
+                    offset, length = self.ranges.get_nowait()
+                except queue.Empty:
+                    break
+                with self.cond:
+                    pending[offset] = length
+                sock.sendall(f"{offset}|{length}\n".encode())
+                if FileTransfer.send_range(sock, f, offset, length, self.zero_copy) < length:
+                    raise ConnectionError("File shrank during transfer")
+                with self.cond:
+                    self.sent += length
+                    self.cond.notify_all()
+        sock.sendall(b"end\n")
+        acks.join()
+        if status != ['ok'] or pending:
+            raise ConnectionError("Receiver did not confirm the ranges")
+        with self.cond:
+            self.cond.notify_all()
+
+    def _read_acks(self, sock, rest, pending, status):
+        """Collect the receiver's "ack=offset" lines until its final status line."""
+        try:
+            while True:
+                line, rest = _read_line(sock, rest)
+                if line is None or not line.startswith('ack='):
+                    status.append(line)
+                    return
+                offset = int(line[len('ack='):])
+                with self.cond:
+                    length = pending.pop(offset, None)
+                    if length is not None:
+                        self.acked += length
+        except (OSError, ValueError) as e:
+            status.append(str(e))
+
+
+def expand_paths(spec):
+    """
+    Turn a /sendfile argument (file, directory or glob) into a sorted list
+    of (path, relative name) pairs. Directories keep their own name as the
+    top-level folder on the receiving side.
+    """
+    matches = glob.glob(os.path.expanduser(spec), recursive=True) or [spec]
+    entries = []
+    for match in matches:
+        if os.path.isdir(match):
+            root = os.path.dirname(os.path.abspath(match))
+            for dirpath, _, files in os.walk(match):
+                for name in files:
+                    path = os.path.join(dirpath, name)
+                    entries.append((path, os.path.relpath(os.path.abspath(path), root)))
+        elif os.path.isfile(match):
+            entries.append((match, os.path.basename(match)))
+    return sorted(entries, key=lambda e: e[1])
+
+
+def flat_paths(spec):
+    """
+    The files expand_paths finds for `spec`, for a host that takes single
+    files only and saves each under its base name. Raises ValueError when
+    two of them would land on the same name.
+    """
+    paths = [path for path, _ in expand_paths(spec)]
+    names = [os.path.basename(path) for path in paths]
+    if len(set(names)) < len(names):
+        raise ValueError("Files in different folders share a name; the host "
+                         "(async engine) saves every file flat")
+    return paths
+
+
+def _safe_join(save_dir, relpath):
+    """Join a sender-supplied relative path, refusing anything that escapes save_dir."""
+    relpath = relpath.replace('\\', '/')
+    parts = [p for p in relpath.split('/') if p not in ('', '.')]
+    if not parts or '..' in parts or os.path.isabs(relpath):
+        raise ValueError(f"Unsafe path in batch: {relpath}")
+    return os.path.join(save_dir, *parts)
+
+
+def _remove_entry(save_dir, path):
+    """Delete a file removed on the sender, then any directories that left empty."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    parent = os.path.dirname(path)
+    while os.path.abspath(parent) != os.path.abspath(save_dir):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break  # not empty (or gone)
+        parent = os.path.dirname(parent)
+
+
+class _Prefetcher:
+    """
+    Reads small batch entries into memory on a background thread while the
+    socket is busy with earlier (possibly large) entries, so the link does
+    not idle on open/read/close between small files. Large entries are
+    passed through unread and later go out via send_range.
+    """
+
+    def __init__(self, entries):
+        self.items = queue.Queue()
+        self.buffered = 0  # bytes read ahead but not yet handed out
+        self.cond = threading.Condition()
+        threading.Thread(target=self._run, args=(entries,), daemon=True).start()
+
+    def _run(self, entries):
+        for path, relpath in entries:
+            try:
+                st = os.stat(path)
+                data = None
+                if st.st_size <= BATCH_INLINE_LIMIT:
+                    with self.cond:
+                        while self.buffered and self.buffered + st.st_size > BATCH_PREFETCH_BYTES:
+                            self.cond.wait()
+                        self.buffered += st.st_size
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                self.items.put((path, relpath, st.st_mode & 0o777, st.st_size, data))
+            except OSError:
+                continue  # vanished or unreadable; skip it
+        self.items.put(None)
+
+    def __iter__(self):
+        while True:
+            item = self.items.get()
+            if item is None:
+                return
+            yield item
+            if item[4] is not None:
+                with self.cond:
+                    self.buffered -= item[3]
+                    self.cond.notify()
+
+
+def _check_trailer(data_src, reply_sock, digest, data=b''):
+    """
+    Read the sender's "verify=<hex>" trailer (starting with any bytes of
+    it already read) and compare it with ours. With reply_sock set, also
+    answer ok/mismatch on it.
+    """
+    line, _ = _read_line(data_src, data)
+    ok = line is not None and _parse_options(line).get('verify') == digest
+    if reply_sock is not None:
+        reply_sock.sendall(b"ok\n" if ok else b"mismatch\n")
+    return ok
+
 
 class FileTransfer:
+    _stripes = {}  # (path, size, stripe id) -> _StripedFile, for transfers still in progress
+    _stripes_ended = {}  # (path, size, stripe id) -> (time, 'done' or 'abandoned')
+    _stripes_lock = threading.Lock()
+
     @staticmethod
-    def send_file(sock, filepath):
+    def send_file(sock, filepath, zero_copy=True, resume=False, compress=False,
+                  dedup=False, verify=False):
+        """
+        Send a file over a connected socket. With resume=True the receiver
+        reports the blocks it already holds, we check them against our copy
+        and only stream from the first block that differs. With compress=True
+        compressible files are offered compressed and the receiver picks the
+        codec. With dedup=True we offer the file's hash first: a receiver that
+        already has the content just copies it, and one holding an older
+        version gets a block delta. With verify=True both sides hash the
+        file alongside the transfer and the receiver checks our digest from
+        a trailer line. Returns (success, message).
+        """
         if not os.path.isfile(filepath):
             return False, "File not found"
         filename = os.path.basename(filepath)
         filesize = os.path.getsize(filepath)
-        header = f"{filename}|{filesize}\n"
-        sock.send(header.encode())
-        with open(filepath, 'rb') as f:
+        options = {}
+        if verify:
+            options['verify'] = 1
+        if resume or dedup:
+            options.update(resume=1, mtime=int(os.path.getmtime(filepath)))
+        if dedup:
+            options['hash'] = file_digest(filepath)
+            if filesize <= DELTA_MAX_SIZE:
+                options['delta'] = DELTA_BLOCK_SIZE
+        codecs = offer_codecs([filepath]) if compress else []
+        if codecs:
+            options['compress'] = ','.join(codecs)
+        start = 0
+        codec = None
+        delta = False
+        reply = {}
+        meter = meter_for(sock)
+        meter.begin(filename, filesize)
+        try:
+            sock.sendall(_format_header(filename, filesize, options))
+            with open(filepath, 'rb') as f:
+                if options:
+                    reply, rest = _read_line(sock)
+                    if reply is None:
+                        return False, "Receiver closed the connection"
+                    reply = _parse_options(reply)
+                    if reply.get('have') == '1':
+                        return True, f"File '{filename}' already on receiver (cached copy used)"
+                    if reply.get('codec') in codecs:
+                        codec = reply['codec']
+                verified = reply.get('verify') == '1' and 'sigs' not in reply
+                stage = _HashStage(f.fileno(), filesize) if verified else None
+                if 'sigs' in reply:
+                    signatures = _read_exact(sock, int(reply['sigs']), rest)
+                    delta = True
+                    sock.sendall(b"delta=1\n")
+                elif 'resume' in options:
+                    blocks = reply.get('blocks', '')
+                    start = _matching_offset(f, filesize, blocks.split(',') if blocks else [])
+                    sock.sendall(f"start={start}\n".encode())
+                    meter.begin(filename, filesize, start)
+                out = CompressWriter(sock, codec) if codec else sock
+                if codec:
+                    meter.watch_queue('compress', out._queue.qsize)
+                if delta:
+                    delta_bytes = 0
+                    for op in delta_ops(filepath, signatures):
+                        t0 = time.perf_counter()
+                        out.sendall(op)
+                        meter.net(len(op), time.perf_counter() - t0)
+                        delta_bytes += len(op)
+                    sent = filesize
+                else:
+                    sent = FileTransfer.send_range(out, f, start, filesize - start, zero_copy)
+                if stage and start + sent == filesize:
+                    out.sendall(f"verify={stage.hexdigest(filesize)}\n".encode())
+                if codec:
+                    out.close()
+            if start + sent < filesize:
+                return False, "File shrank during transfer"
+            if 'resume' in options or stage:
+                status, _ = _read_line(sock)
+                if status == 'mismatch' and stage:
+                    return False, "Integrity check failed: receiver's copy did not hash to ours"
+                if status == 'mismatch':
+                    return False, "Delta mismatch: receiver's copy did not hash to ours"
+                if status != 'ok':
+                    return False, "Receiver did not confirm the transfer"
+        except OSError as e:
+            return False, str(e)
+        note = []
+        if start:
+            note.append(f"resumed at byte {start}")
+        if delta:
+            note.append(f"delta of {delta_bytes} bytes against the receiver's old copy")
+        if codec:
+            note.append(f"{codec}, {out.wire_bytes} bytes on the wire")
+        if stage:
+            note.append("verified")
+        return True, f"File '{filename}' sent" + (f" ({'; '.join(note)})" if note else '')
+
+    @staticmethod
+    def send_range(sock, f, offset, count, zero_copy=True):
+        """
+        Send `count` bytes of the open file `f` starting at `offset`.
+        Uses the kernel's zero-copy os.sendfile when the socket and platform
+        allow it, and a read + sendall loop otherwise (or for whatever is left
+        if sendfile gives up part-way). Returns the number of bytes sent.
+        """
+        start = offset
+        end = offset + count
+        if zero_copy and hasattr(os, 'sendfile'):
+            try:
+                # probe first: a throttle() charge must be followed by this send,
+                # not by _copy_loop charging the same bytes again
+                sock.fileno(), f.fileno()
+            except (AttributeError, io.UnsupportedOperation):
+                zero_copy = False  # not a real socket/file (e.g. an encrypted or mux stream)
+        if zero_copy and hasattr(os, 'sendfile'):
+            meter = meter_for(sock)
+            clock = time.perf_counter
+            # a rate-limited socket wants to be asked before each (smaller) chunk
+            throttle = getattr(sock, 'throttle', None)
+            step = sock.quantum() if throttle else chunk_for(sock)
+            try:
+                while offset < end:
+                    if throttle:
+                        throttle(min(step, end - offset))
+                    t0 = clock()
+                    n = _sendfile_chunk(sock, f, offset, min(step, end - offset))
+                    if n == 0:
+                        return offset - start  # file shrank under us
+                    meter.net(n, clock() - t0)  # disk reads happen inside sendfile too
+                    offset += n
+            except OSError as e:
+                if e.errno not in _SENDFILE_UNSUPPORTED:
+                    raise
+        if offset < end:
+            offset = _copy_loop(sock, f, offset, end)
+        return offset - start
+
+    @staticmethod
+    def send_striped(connect, filepath, streams=None, max_streams=STRIPE_MAX_STREAMS,
+                     zero_copy=True):
+        """
+        Send a file as STRIPE_RANGE_SIZE ranges over several connections made
+        by calling `connect()`. With streams=None the stream count adapts:
+        start with one and keep adding connections while each addition lifts
+        the measured throughput by more than 10%. Returns (success, message).
+        """
+        if not os.path.isfile(filepath):
+            return False, "File not found"
+        sender = _RangeSender(connect, filepath, zero_copy)
+        threads = []
+
+        def add_stream():
+            t = threading.Thread(target=sender.worker, daemon=True)
+            t.start()
+            threads.append(t)
+
+        for _ in range(streams or 1):
+            add_stream()
+        growing = streams is None
+        best_rate = 0.0
+        level_start, level_bytes = time.monotonic(), 0
+        with sender.cond:
+            while any(t.is_alive() for t in threads):
+                sender.cond.wait(0.5)
+                if not growing or sender.ranges.empty():
+                    continue
+                # judge a level once every stream has moved a range
+                if sender.sent - level_bytes < len(threads) * STRIPE_RANGE_SIZE:
+                    continue
+                now = time.monotonic()
+                rate = (sender.sent - level_bytes) / (now - level_start)
+                if rate > best_rate * 1.1 and len(threads) < max_streams:
+                    best_rate = rate
+                    add_stream()
+                    level_start, level_bytes = now, sender.sent
+                else:
+                    growing = False
+        for t in threads:
+            t.join()
+        if not sender.complete and sender.acked < sender.filesize:
+            return False, sender.error or "Striped transfer incomplete"
+        return True, f"File '{sender.filename}' sent over {len(threads)} streams"
+
+    @staticmethod
+    def send_batch(sock, spec, zero_copy=True, compress=False, entries=None, deleted=()):
+        """
+        Send every file matched by `spec` (file, directory or glob) over one
+        connection as a sequence of "relpath|mode|size" entries. Small files
+        are prefetched and coalesced into few sends; large ones use
+        send_range. With compress=True the whole entry stream may be
+        compressed. `entries` ((path, relpath) pairs) replaces the match,
+        and each relpath in `deleted` becomes a "relpath|-|0" entry that
+        removes the receiver's copy. Returns (success, message).
+        """
+        if entries is None:
+            entries = expand_paths(spec)
+        if not entries and not deleted:
+            return False, "Nothing matched"
+        label = os.path.basename(os.path.normpath(spec)) or 'batch'
+        total = sum(os.path.getsize(p) for p, _ in entries)
+        options = {'batch': len(entries) + len(deleted)}
+        codecs = offer_codecs([p for p, _ in entries]) if compress else []
+        if codecs:
+            options['compress'] = ','.join(codecs)
+        meter = meter_for(sock)
+        meter.begin(label, total)
+        try:
+            sock.sendall(_format_header(label, total, options))
+            reply, _ = _read_line(sock)
+            if reply is None or reply.split(';')[0] != 'ready':
+                return False, f"Receiver refused batch: {reply}"
+            codec = _parse_options(reply).get('codec')
+            out = CompressWriter(sock, codec) if codec in codecs else sock
+            if out is not sock:
+                meter.watch_queue('compress', out._queue.qsize)
+            prefetch = _Prefetcher(entries)
+            meter.watch_queue('prefetch', prefetch.items.qsize)
+            pending = bytearray()
             sent = 0
-            while sent < filesize:
-                data = f.read(BUFFER_SIZE)
-                if not data:
+
+            def flush():
+                t0 = time.perf_counter()
+                out.sendall(pending)
+                meter.net(len(pending), time.perf_counter() - t0)
+                pending.clear()
+
+            for path, relpath, mode, size, data in prefetch:
+                pending += f"{relpath}|{mode:o}|{size}\n".encode()
+                if data is not None:
+                    pending += data[:size]
+                    if len(data) < size:  # shrank after stat: pad to announced size
+                        pending += bytes(size - len(data))
+                    if len(pending) >= BATCH_COALESCE_SIZE:
+                        flush()
+                else:
+                    flush()
+                    with open(path, 'rb') as f:
+                        n = FileTransfer.send_range(out, f, 0, size, zero_copy)
+                    if n < size:
+                        out.sendall(bytes(size - n))
+                sent += 1
+            for relpath in deleted:
+                pending += f"{relpath}|-|0\n".encode()
+                sent += 1
+            pending += b"end\n"
+            flush()
+            if out is not sock:
+                out.close()
+            status, _ = _read_line(sock)
+        except OSError as e:
+            return False, str(e)
+        if status != f"ok|{sent}":
+            return False, f"Receiver reported {status}"
+        if deleted:
+            return True, (f"Sent {sent - len(deleted)} files ({total} bytes) from '{label}', "
+                          f"deleted {len(deleted)}")
+        return True, f"Sent {sent} files ({total} bytes) from '{label}'"
+
+    @staticmethod
+    def send_stream(sock, source, compress=False, verify=False):
+        """
+        Send everything `source` (see streams) produces, of unknown length,
+        as length-prefixed chunks read into one reused buffer. A trailer
+        line follows the last chunk: the digest with verify=True, and the
+        source's error if it failed, so the receiver can discard the data.
+        The receiver reports whether its sink took it all.
+        Returns (success, message).
+        """
+        options = {'stream': 1}
+        if verify:
+            options['verify'] = 1
+        codecs = available_codecs() if compress else []
+        if codecs:
+            options['compress'] = ','.join(codecs)
+        meter = meter_for(sock)
+        meter.begin(source.name, 0)
+        buf = bytearray(_CHUNK_HEAD.size + STREAM_CHUNK)
+        view = memoryview(buf)
+        hasher = hashlib.blake2b(digest_size=32) if verify else None
+        clock = time.perf_counter
+        total = 0
+        try:
+            sock.sendall(_format_header(source.name, 0, options))
+            reply, _ = _read_line(sock)
+            reply = _parse_options(reply or '')
+            if 'refused' in reply or 'codec' not in reply:
+                source.close()
+                return False, f"Receiver refused the stream: {reply.get('refused', 'no reply')}"
+            codec = reply['codec'] if reply['codec'] in codecs else None
+            out = CompressWriter(sock, codec) if codec else sock
+            while True:
+                t0 = clock()
+                n = source.readinto(view[_CHUNK_HEAD.size:])
+                t1 = clock()
+                meter.disk(t1 - t0)
+                if not n:
                     break
-                sock.send(data)
-                sent += len(data)
-        return True, f"File '{filename}' sent"
+                _CHUNK_HEAD.pack_into(buf, 0, n)
+                out.sendall(view[:_CHUNK_HEAD.size + n])  # header and data in one send
+                meter.net(n, clock() - t1)
+                if hasher:
+                    hasher.update(view[_CHUNK_HEAD.size:_CHUNK_HEAD.size + n])
+                total += n
+            error = source.close()
+            trailer = {}
+            if hasher and reply.get('verify') == '1':
+                trailer['verify'] = hasher.hexdigest()
+            if error:
+                trailer['error'] = error.replace(';', ',').replace('\n', ' ')
+            out.sendall(_CHUNK_HEAD.pack(0) + (_format_options(trailer) + '\n').encode())
+            if codec:
+                out.close()
+            status, _ = _read_line(sock)
+        except OSError as e:
+            source.close()
+            return False, str(e)
+        if error:
+            return False, f"{error} (after sending {total} bytes)"
+        if status != 'ok':
+            return False, f"Receiver reported {status}"
+        return True, f"Stream '{source.name}' sent ({total} bytes" + (
+            f", {codec}" if codec else '') + (", verified" if hasher else '') + ")"
 
     @staticmethod
-    def receive_file(sock, save_dir='received_files'):
+    def receive_file(sock, save_dir='received_files', buffer_size=RECV_BUFFER_SIZE,
+                     use_mmap=False, sink=None):
+        """
+        Receive one file from a connected socket into `save_dir`.
+        The target is preallocated to the announced size and filled with
+        recv_into, either through a reused buffer or straight into a
+        writable mmap window. With a sink (see streams) the data goes there
+        instead of a file; streams of unknown length go to a FileSink in
+        `save_dir` when no sink is given. Returns (success, message).
+        """
         try:
-            data = sock.recv(BUFFER_SIZE)
-            if not data:
+            header_line, remaining = _read_line(sock)
+            if header_line is None:
                 return False, "No data"
-            header_data = data.split(b'\n', 1)
-            header_line = header_data[0].decode()
-            remaining = header_data[1] if len(header_data) > 1 else b''
-            filename, filesize = header_line.split('|')
-            filesize = int(filesize)
+            filename, filesize, options = _parse_header(header_line)
+            meter_for(sock).begin(filename, filesize)
+            if options.get('stream') or sink is not None:
+                return FileTransfer._receive_to_sink(sock, sink, save_dir, filename, filesize,
+                                                     options, remaining, buffer_size)
 
             os.makedirs(save_dir, exist_ok=True)
             filepath = os.path.join(save_dir, filename)
+            codec = pick_codec(options.get('compress'))
+            if options.get('batch'):
+                return FileTransfer._receive_batch(sock, save_dir, buffer_size, codec)
+            if options.get('stripe'):
+                return FileTransfer._receive_stripe(
+                    sock, filepath, filesize, options['stripe'], remaining, buffer_size)
+            if options.get('hash'):
+                store = content_store(save_dir)
+                if store.materialize(options['hash'], filepath):
+                    _send_reply(sock, {'have': 1})
+                    return True, f"File received: {filename} (cached copy, nothing sent)"
+            if options.get('resume'):
+                return FileTransfer._receive_resumable(
+                    sock, filepath, filesize, options, buffer_size, use_mmap, codec)
+            verify = bool(options.get('verify'))
+            if options:
+                _send_reply(sock, {'codec': codec or 'none', **({'verify': 1} if verify else {})})
+            data_src = sock
+            if codec:
+                data_src = DecompressReader(sock, codec, remaining)
+                remaining = b''
 
-            with open(filepath, 'wb') as f:
+            # a small file can arrive in the same read as its header, trailer and all
+            remaining, extra = remaining[:filesize], remaining[filesize:]
+            # a verified file only replaces an existing copy once it has checked out
+            target = filepath + '.incoming' if verify else filepath
+            stage = hasher = None
+            with open(target, 'w+b') as f:
+                _preallocate(f, filesize)
                 f.write(remaining)
                 received = len(remaining)
-                while received < filesize:
-                    data = sock.recv(min(BUFFER_SIZE, filesize - received))
-                    if not data:
-                        break
-                    f.write(data)
-                    received += len(data)
+                on_data = None
+                if verify and use_mmap:
+                    # hash each slice as it lands in the mapping, while it is still in cache
+                    hasher = hashlib.blake2b(remaining, digest_size=32)
+                    on_data = hasher.update
+                elif verify:
+                    stage = _HashStage(f.fileno())
+                    on_data = stage.follow(f)
+                    if remaining:
+                        f.flush()
+                        stage.advance(received)
+                if use_mmap and received < filesize:
+                    received = _recv_mmap(data_src, f, received, filesize, on_data)
+                elif received < filesize:
+                    received = _recv_buffered(data_src, f, received, filesize, buffer_size, on_data)
+                if received != filesize:
+                    f.truncate(received)
+                digest = stage.hexdigest(received) if stage else hasher and hasher.hexdigest()
 
-            if received == filesize:
-                return True, f"File received: {filename}"
-            else:
+            if received != filesize:
+                if verify:
+                    os.remove(target)
                 return False, "File transfer incomplete"
+            if verify:
+                if not _check_trailer(data_src, sock, digest, extra):
+                    os.remove(target)
+                    return False, f"Integrity check failed for {filename}; discarded"
+                os.replace(target, filepath)
+            return True, f"File received: {filename}" + (" (verified)" if verify else "")
         except Exception as e:
             return False, str(e)
+
+    @staticmethod
+    def _receive_resumable(sock, filepath, filesize, options, buffer_size, use_mmap, codec):
+        """
+        Receive into `<name>.part` next to a checkpoint of per-block hashes.
+        An interrupted transfer leaves both behind; the next attempt offers
+        the verified blocks to the sender and continues after them. When the
+        sender offered a content hash and we hold an older version of the
+        file, block signatures go along so it can answer with a delta.
+        """
+        filename = os.path.basename(filepath)
+        part = filepath + '.part'
+        digest = options.get('hash')
+        store = content_store(os.path.dirname(filepath)) if digest else None
+        basis = store.basis_for(filename, filepath) if store and options.get('delta') else None
+        ckpt = _Checkpoint.load(part + '.ckpt', filesize, int(options.get('mtime', 0)))
+        with open(part, 'r+b' if os.path.exists(part) else 'w+b') as f:
+            _preallocate(f, filesize)
+            ckpt.verify(f)
+            reply = {'offset': ckpt.offset, 'blocks': ','.join(ckpt.hashes),
+                     'codec': codec or 'none'}
+            signatures = b''
+            if basis and not ckpt.offset:
+                signatures = block_signatures(basis, int(options['delta']))
+                reply['sigs'] = len(signatures)
+            verify = options.get('verify') and 'sigs' not in reply
+            if verify:
+                reply['verify'] = 1
+            _send_reply(sock, reply)
+            sock.sendall(signatures)
+            line, remaining = _read_line(sock)
+            if line is None:
+                return False, "Sender closed the connection"
+            line = _parse_options(line)
+            data_src = sock
+            if codec:
+                data_src = DecompressReader(sock, codec, remaining)
+                remaining = b''
+            stage = None
+            extra = b''
+            if 'delta' in line:
+                if not basis:
+                    return False, "Sender sent a delta we did not ask for"
+                raw = data_src if codec else _Prepend(sock, remaining)
+                f.seek(0)
+                start = 0
+                received = apply_delta(io.BufferedReader(raw, buffer_size), basis, f,
+                                       int(options['delta']))
+                f.truncate(received)
+                ckpt.remove()
+            else:
+                start = int(line['start'])
+                if start % RESUME_BLOCK_SIZE or start > ckpt.offset:
+                    return False, f"Bad resume offset {start}"
+                ckpt.rewind(start)
+                meter_for(sock).begin(filename, filesize, start)
+                remaining, extra = remaining[:filesize - start], remaining[filesize - start:]
+                f.seek(start)
+                f.write(remaining)
+                ckpt.feed(remaining)
+                received = start + len(remaining)
+                on_data = ckpt.feed
+                if verify:
+                    f.flush()
+                    stage = _HashStage(f.fileno(), received)  # re-reads the kept prefix too
+                    on_data = stage.follow(f, ckpt.feed)
+                if use_mmap and received < filesize:
+                    received = _recv_mmap(data_src, f, received, filesize, on_data)
+                elif received < filesize:
+                    received = _recv_buffered(data_src, f, received, filesize, buffer_size,
+                                              on_data)
+                ours = stage.hexdigest(received) if stage and received == filesize else None
+
+        if received != filesize:
+            return False, f"File transfer incomplete ({received}/{filesize} bytes kept for resume)"
+        if stage and not _check_trailer(data_src, None, ours, extra):
+            os.remove(part)
+            ckpt.remove()
+            sock.sendall(b"mismatch\n")
+            return False, f"Integrity check failed for {filename}; discarded"
+        if digest and file_digest(part) != digest:
+            os.remove(part)
+            ckpt.remove()
+            sock.sendall(b"mismatch\n")
+            return False, f"Content hash mismatch for {filename}; discarded"
+        os.replace(part, filepath)
+        ckpt.remove()
+        if store:
+            store.put(filepath, digest, filename)
+        sock.sendall(b"ok\n")
+        note = [] if not stage else ["verified"]
+        if 'delta' in line:
+            note.insert(0, "rebuilt from a delta")
+        elif start:
+            note.insert(0, f"resumed at byte {start}")
+        return True, f"File received: {filename}" + (f" ({'; '.join(note)})" if note else '')
+
+    @staticmethod
+    def _receive_stripe(sock, filepath, filesize, stripe_id, remaining, buffer_size):
+        """
+        Handle one connection of a striped transfer: a run of "offset|length"
+        range headers, each followed by its bytes, written with os.pwrite into
+        the shared preallocated .part file and acknowledged with an
+        "ack=offset" line. Only the connection that completes the file
+        reports it; the others return an empty message.
+        A stripe arriving after its transfer finished is answered "done"
+        and never reopens the file.
+        """
+        key = (filepath, filesize, stripe_id)
+        with FileTransfer._stripes_lock:
+            now = time.monotonic()
+            for old, stale in list(FileTransfer._stripes.items()):
+                if now - stale.touched > STRIPE_IDLE_TIMEOUT:
+                    del FileTransfer._stripes[old]
+                    stale.discard()
+                    FileTransfer._stripes_ended[old] = (now, 'abandoned')
+            for old, (ended_at, _) in list(FileTransfer._stripes_ended.items()):
+                if now - ended_at > STRIPE_IDLE_TIMEOUT:
+                    del FileTransfer._stripes_ended[old]
+            ended = FileTransfer._stripes_ended.get(key)
+            state = FileTransfer._stripes.get(key)
+            if ended is None and state is None:
+                state = FileTransfer._stripes[key] = _StripedFile(filepath, filesize)
+        if ended and ended[1] == 'done':
+            sock.sendall(b"done\n")
+            return True, ''
+        if ended:
+            sock.sendall(b"refused=transfer abandoned\n")
+            return False, f"Late stripe for abandoned transfer of {os.path.basename(filepath)}"
+        sock.sendall(b"ready\n")
+        buf = bytearray(buffer_size)
+        view = memoryview(buf)
+        meter = meter_for(sock)
+        clock = time.perf_counter
+        while True:
+            line, remaining = _read_line(sock, remaining)
+            if line is None:
+                return False, "Stripe connection closed early"
+            if line == 'end':
+                break
+            offset, length = (int(x) for x in line.split('|'))
+            if offset < 0 or offset + length > filesize:
+                return False, f"Bad stripe range {line}"
+            pos = offset
+            end = offset + length
+            if remaining:
+                chunk = remaining[:length]
+                os.pwrite(state.fd, chunk, pos)
+                pos += len(chunk)
+                remaining = remaining[len(chunk):]
+            while pos < end:
+                t0 = clock()
+                n = sock.recv_into(view, min(buffer_size, end - pos))
+                if not n:
+                    return False, "Stripe connection closed early"
+                t1 = clock()
+                os.pwrite(state.fd, view[:n], pos)
+                meter.net(n, t1 - t0)
+                meter.disk(clock() - t1)
+                pos += n
+            with state.lock:
+                state.done[offset] = length
+                state.touched = time.monotonic()
+            sock.sendall(f"ack={offset}\n".encode())
+        with FileTransfer._stripes_lock:
+            finished = state.complete() and FileTransfer._stripes.pop(key, None)
+            if finished:
+                FileTransfer._stripes_ended[key] = (time.monotonic(), 'done')
+        if finished:
+            os.close(state.fd)
+            os.replace(state.part, filepath)
+        sock.sendall(b"ok\n")
+        if finished:
+            return True, f"File received: {os.path.basename(filepath)}"
+        return True, ''
+
+    @staticmethod
+    def _receive_to_sink(sock, sink, save_dir, filename, filesize, options, remaining,
+                         buffer_size):
+        """
+        Feed a stream, or a plain file transfer, to a sink through one reused
+        buffer. Resumes start from zero and cached copies are never used,
+        since a sink keeps nothing to check against. Batches and stripes
+        need real files and are refused.
+        """
+        from streams import FileSink  # only needed once something is piped
+        sink = sink or FileSink(save_dir)
+        stream = bool(options.get('stream'))
+        if options.get('batch') or options.get('stripe'):
+            sock.sendall(f"refused: no batches or stripes into {sink.target}\n".encode())
+            return False, f"Refused a batch/striped transfer (receiving into {sink.target})"
+        codec = pick_codec(options.get('compress'))
+        verify = bool(options.get('verify'))
+        reply = {'codec': codec or 'none'}
+        if verify:
+            reply['verify'] = 1
+        if options.get('resume') and not stream:
+            reply.update(offset=0, blocks='')
+        if options:
+            _send_reply(sock, reply)
+        if options.get('resume') and not stream:
+            line, remaining = _read_line(sock, remaining)
+            if line is None or _parse_options(line).get('start') != '0':
+                return False, "Sender did not restart from zero"
+        raw = DecompressReader(sock, codec, remaining) if codec else _Prepend(sock, remaining)
+        reader = io.BufferedReader(raw, buffer_size)
+        view = memoryview(bytearray(buffer_size))
+        hasher = hashlib.blake2b(digest_size=32) if verify else None
+        meter = meter_for(sock)
+        clock = time.perf_counter
+        received = 0
+        sink.open(filename, None if stream else filesize)
+        ok = False
+        try:
+            left = filesize
+            while stream or left:
+                if stream and not left:
+                    head = reader.read(_CHUNK_HEAD.size)
+                    if len(head) < _CHUNK_HEAD.size:
+                        return False, f"Stream {filename} cut off after {received} bytes"
+                    (left,) = _CHUNK_HEAD.unpack(head)
+                    if not left:
+                        break
+                t0 = clock()
+                n = reader.readinto1(view[:min(buffer_size, left)])
+                if not n:
+                    return False, f"Transfer of {filename} cut off after {received} bytes"
+                t1 = clock()
+                try:
+                    sink.write(view[:n])
+                except BrokenPipeError:
+                    return False, f"{sink.target} stopped reading after {received} bytes"
+                meter.net(n, t1 - t0)
+                meter.disk(clock() - t1)
+                if hasher:
+                    hasher.update(view[:n])
+                received += n
+                left -= n
+            trailer = {}
+            if stream or hasher:
+                trailer = _parse_options(reader.readline().decode().rstrip('\n'))
+            if 'error' in trailer:
+                sock.sendall(b"error: source failed\n")
+                return False, f"Sender's source failed: {trailer['error']}"
+            if hasher and trailer.get('verify') != hasher.hexdigest():
+                sock.sendall(b"mismatch\n")
+                return False, f"Integrity check failed for {filename}"
+            ok = True
+        finally:
+            error = sink.close(ok)
+            reader.close()
+        if error:
+            sock.sendall(f"error: {error}\n".encode())
+            return False, error
+        if stream or options.get('resume') or verify:
+            sock.sendall(b"ok\n")
+        return True, f"Received {filename} ({received} bytes) into {sink.target}" + (
+            " (verified)" if hasher else '')
+
+    @staticmethod
+    def _receive_batch(sock, save_dir, buffer_size, codec):
+        """Unpack a batch of entries sent by send_batch into `save_dir`."""
+        if codec:
+            sock.sendall(f"ready;codec={codec}\n".encode())
+            stream = io.BufferedReader(DecompressReader(sock, codec), buffer_size)
+        else:
+            sock.sendall(b"ready\n")
+            stream = io.BufferedReader(_Prepend(sock, b''), buffer_size)
+        buf = bytearray(buffer_size)
+        view = memoryview(buf)
+        meter = meter_for(sock)
+        clock = time.perf_counter
+        count = 0
+        try:
+            while True:
+                line = stream.readline()
+                if not line:
+                    return False, f"Batch cut off after {count} files"
+                line = line.rstrip(b'\n').decode()
+                if line == 'end':
+                    break
+                try:
+                    relpath, mode, size = line.rsplit('|', 2)
+                    size = int(size)
+                    path = _safe_join(save_dir, relpath)
+                    if mode != '-':
+                        if not mode or mode.strip('01234567') or size < 0:
+                            raise ValueError("bad mode or size")
+                        mode = int(mode, 8) & 0o777  # no setuid, setgid or sticky bits
+                except ValueError as e:
+                    sock.sendall(f"error: bad batch entry after {count} files\n".encode())
+                    return False, f"Bad batch entry {line!r}: {e}"
+                if mode == '-':
+                    _remove_entry(save_dir, path)
+                    count += 1
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    left = size
+                    while left:
+                        t0 = clock()
+                        n = stream.readinto(view[:min(buffer_size, left)])
+                        if not n:
+                            return False, f"Batch cut off in {relpath}"
+                        t1 = clock()
+                        f.write(view[:n])
+                        meter.net(n, t1 - t0)
+                        meter.disk(clock() - t1)
+                        left -= n
+                os.chmod(path, mode)
+                count += 1
+        finally:
+            stream.close()
+        sock.sendall(f"ok|{count}\n".encode())
+        return True, f"Received {count} files into {save_dir}"
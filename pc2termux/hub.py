@@ -0,0 +1,302 @@
+"""
+Hub mode: one host, many authenticated peers. Chat lines are relayed to
+everyone (or to a named subset) and files are fanned out to each peer's
+file server, reading the file from disk only once for all of them. The
+fan-out runs as a scheduler job, and each push is encrypted with the
+session key of that peer's chat connection and checked against a digest
+taken by the single reader.
+Peers send files to the hub's file server the same way; the hub matches
+each connection to the member session that opened it.
+"""
+import hashlib
+import os
+import socket
+import threading
+import netprofile
+from constants import HUB_MAX_PEERS, HUB_CHUNK, HUB_WINDOW
+from chat import Channel, TEXT, ACK, PING, FILE_OFFER, reject, server_handshake
+from filetransfer import _format_header, _parse_options, _read_line
+from secure import plaintext_note
+
+
+class FanoutReader:
+    """
+    Reads a file once, in HUB_CHUNK pieces shared by several consumers.
+    Every consumer sends the same bytes objects, and a chunk is dropped
+    as soon as the slowest live consumer has sent it; the reader stays at
+    most HUB_WINDOW chunks ahead of that consumer. The reader also hashes
+    what it reads, for the verify trailer each consumer sends at the end.
+    """
+
+    def __init__(self, path, consumers, chunk=HUB_CHUNK, window=HUB_WINDOW):
+        self.chunk = chunk
+        self.window = window
+        self.chunks = {}
+        self.cursors = {c: 0 for c in range(consumers)}
+        self.end = None
+        self.error = None
+        self.hasher = hashlib.blake2b(digest_size=32)
+        self.cond = threading.Condition()
+        threading.Thread(target=self._read, args=(path,), daemon=True).start()
+
+    def _slowest(self):
+        return min(self.cursors.values()) if self.cursors else float('inf')
+
+    def _read(self, path):
+        index = 0
+        try:
+            with open(path, 'rb') as f:
+                while True:
+                    with self.cond:
+                        while index - self._slowest() >= self.window:
+                            self.cond.wait()
+                        if not self.cursors:
+                            return  # everyone gave up
+                    data = f.read(self.chunk)
+                    self.hasher.update(data)
+                    with self.cond:
+                        if not data:
+                            break
+                        self.chunks[index] = data
+                        index += 1
+                        self.cond.notify_all()
+        except OSError as e:
+            self.error = e
+        with self.cond:
+            self.end = index
+            self.cond.notify_all()
+
+    def chunks_for(self, consumer):
+        """Yield the shared chunks in order for one consumer."""
+        index = 0
+        while True:
+            with self.cond:
+                while index not in self.chunks and (self.end is None or index < self.end):
+                    self.cond.wait()
+                if self.error:
+                    raise self.error
+                if index not in self.chunks:
+                    return
+                data = self.chunks[index]
+            yield data
+            index += 1
+            with self.cond:
+                self.cursors[consumer] = index
+                self._trim()
+
+    def hexdigest(self):
+        """Digest of the whole file, once chunks_for has run to the end."""
+        return self.hasher.hexdigest()
+
+    def drop(self, consumer):
+        """Stop waiting for a consumer whose connection failed."""
+        with self.cond:
+            self.cursors.pop(consumer, None)
+            self._trim()
+
+    def _trim(self):
+        low = self._slowest()
+        for index in [i for i in self.chunks if i < low]:
+            del self.chunks[index]
+        self.cond.notify_all()
+
+
+class Hub:
+    """Chat relay and file fan-out for a Peer acting as a hub."""
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.peers = {}  # name -> (Channel, ip)
+        self.lock = threading.Lock()
+        self.running = True
+        self._counter = 0
+
+    def run(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            server.bind((self.peer.ip, self.peer.port))
+            server.listen(HUB_MAX_PEERS)
+        except OSError as e:
+            print(f"Hub error: {e}")
+            return
+        print(f"Hub listening on {self.peer.ip}:{self.peer.port}")
+        print(f"Password: {self.peer.password}")
+        self.peer.hosting = 'hub'
+        threading.Thread(target=self._accept_loop, args=(server,), daemon=True).start()
+        try:
+            self._input_loop()
+        finally:
+            self.peer.hosting = None
+            self.running = False
+            server.close()
+            with self.lock:
+                for channel, _ in self.peers.values():
+                    channel.sock.close()
+
+    def _accept_loop(self, server):
+        while self.running:
+            try:
+                conn, addr = server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handshake, args=(conn, addr[0]), daemon=True).start()
+
+    def _handshake(self, conn, ip):
+        netprofile.apply(conn, netprofile.guess(ip), chat=True)
+        channel = Channel(conn)
+        try:
+            with self.lock:
+                full = len(self.peers) >= HUB_MAX_PEERS
+            if full:
+                reject(channel, "Hub is full")
+                conn.close()
+                return
+            ok, _ = server_handshake(channel, self.peer.password)
+            if not ok:
+                conn.close()
+                return
+            with self.lock:
+                self._counter += 1
+                name = f"peer{self._counter}"
+                self.peers[name] = (channel, ip)
+        except OSError:
+            conn.close()
+            return
+        print(f"\n[Hub] {name} joined from {ip}{plaintext_note(channel.session)}")
+        self._receive_loop(name, channel)
+
+    def _receive_loop(self, name, channel):
+        try:
+            for ftype, payload in channel:
+                if ftype == PING:
+                    channel.send(ACK, payload)
+                    continue
+                if ftype not in (TEXT, FILE_OFFER):
+                    continue
+                text = str(payload, 'utf-8', 'replace')
+                if ftype == FILE_OFFER:
+                    text = f"is sending {text.replace('|', ' (')} bytes) to the hub"
+                print(f"\n[{name}]: {text}")
+                self._relay(f"[{name}] {text}", exclude=name)
+        except (OSError, ValueError):
+            pass
+        with self.lock:
+            self.peers.pop(name, None)
+        print(f"\n[Hub] {name} left")
+
+    def sessions(self):
+        """The session of every member; their file connections are accepted."""
+        with self.lock:
+            return [channel.session for channel, _ in self.peers.values()]
+
+    def _targets(self, spec, exclude=None):
+        """Resolve '@a,b' (or None for everyone) to {name: (Channel, ip)}."""
+        with self.lock:
+            if spec is None:
+                chosen = dict(self.peers)
+            else:
+                chosen = {n: self.peers[n] for n in spec.split(',') if n in self.peers}
+        chosen.pop(exclude, None)
+        return chosen
+
+    def _relay(self, text, spec=None, exclude=None):
+        for name, (channel, _) in self._targets(spec, exclude).items():
+            try:
+                channel.send_text(text)
+            except OSError:
+                print(f"\n[Hub] could not reach {name}")
+
+    @staticmethod
+    def _split_targets(text):
+        """'@a,b rest' -> ('a,b', 'rest'); anything else -> (None, text)."""
+        if text.startswith('@') and ' ' in text:
+            spec, rest = text[1:].split(' ', 1)
+            return spec, rest
+        return None, text
+
+    def _input_loop(self):
+        print("\n--- Hub ready ---")
+        print("Commands: [@peer1,peer2] <message>  |  /sendfile [@peer1,peer2] <path>  "
+              "|  /peers  |  /quit")
+        while self.running:
+            try:
+                msg = input()
+            except (KeyboardInterrupt, EOFError):
+                break
+            if msg == "/quit":
+                break
+            elif msg == "/peers":
+                with self.lock:
+                    for name, (_, ip) in self.peers.items():
+                        print(f"  {name}  {ip}")
+                    if not self.peers:
+                        print("  (no peers connected)")
+            elif msg.startswith("/sendfile"):
+                spec, path = self._split_targets(msg[len("/sendfile"):].strip())
+                if path:
+                    self.send_file(path.strip(), spec)
+                else:
+                    print("Usage: /sendfile [@peer1,peer2] <path>")
+            else:
+                spec, text = self._split_targets(msg)
+                self._relay(f"[hub] {text}", spec)
+
+    def send_file(self, filepath, spec=None):
+        """
+        Queue a fan-out of a file to every (or each named) peer's file server
+        on the scheduler, so the input loop stays free; returns the job.
+        """
+        if not os.path.isfile(filepath):
+            print("Failed: File not found")
+            return None
+        targets = self._targets(spec)
+        if not targets:
+            print("No matching peers.")
+            return None
+        label = f"{os.path.basename(filepath)} -> {', '.join(targets)}"
+        job = self.peer.scheduler.submit(label, lambda job: self._fan_out(filepath, targets, job))
+        if job.state == 'queued':
+            print(f"Queued #{job.id}: {label}")
+        return job
+
+    def _fan_out(self, filepath, targets, job):
+        """Push one read of the file to each target; returns (success, message)."""
+        filename = os.path.basename(filepath)
+        header = _format_header(filename, os.path.getsize(filepath), {'verify': 1})
+        fanout = FanoutReader(filepath, len(targets))
+        results = {}
+
+        def push(consumer, name, channel, ip):
+            try:
+                with netprofile.connect((ip, self.peer.file_port), netprofile.guess(ip)) as raw:
+                    sock = self.peer.scheduler.wrap(channel.session.secure_outgoing(raw), job)
+                    sock.sendall(header)
+                    reply, _ = _read_line(sock)
+                    if reply is None:
+                        raise ConnectionError("Receiver closed the connection")
+                    verified = _parse_options(reply).get('verify') == '1'
+                    for data in fanout.chunks_for(consumer):
+                        sock.sendall(data)
+                    if verified:
+                        sock.sendall(f"verify={fanout.hexdigest()}\n".encode())
+                        status, _ = _read_line(sock)
+                        if status != 'ok':
+                            raise ConnectionError("integrity check failed on the peer")
+                results[name] = "sent (verified)" if verified else "sent"
+            except (OSError, ValueError) as e:
+                fanout.drop(consumer)
+                results[name] = f"failed ({e})"
+
+        threads = [threading.Thread(target=push, args=(i, name, channel, ip), daemon=True)
+                   for i, (name, (channel, ip)) in enumerate(targets.items())]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for name, result in results.items():
+            print(f"  {filename} -> {name}: {result}")
+        failed = [name for name, result in results.items() if not result.startswith('sent')]
+        if failed:
+            return False, f"{filename} did not reach {', '.join(failed)}"
+        return True, f"{filename} sent to {len(results)} peers"
@@ -1,5 +1,80 @@
-from peer import Peer
+import argparse
+import sys
 
 if __name__ == "__main__":
-    peer = Peer()
-    peer.start()
+    parser = argparse.ArgumentParser(description="P2P chat and file transfer")
+    parser.add_argument('--engine', choices=('threaded', 'async'), default='threaded',
+                        help="threaded: one thread per connection; async: one asyncio event loop")
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve transfer metrics on 127.0.0.1:PORT (/metrics, /metrics.json)")
+    parser.add_argument('--limit', type=int, metavar='KBPS',
+                        help="cap total upload rate for queued transfers, in KB/s")
+    parser.add_argument('--peer-limit', type=int, metavar='KBPS',
+                        help="cap upload rate per peer, in KB/s")
+    parser.add_argument('--max-transfers', type=int, metavar='N',
+                        help="transfers running at once; the rest wait in the queue")
+    parser.add_argument('--link', choices=('auto', 'lan', 'wifi', 'tunnel', 'cellular'),
+                        help="socket tuning profile; auto measures the link once connected")
+    parser.add_argument('--plaintext', action='store_true',
+                        help="also accept unencrypted sessions, for peers without the cryptography "
+                             "package (the password is still checked; the data is not protected)")
+    commands = parser.add_subparsers(dest='command')
+    bench_parser = commands.add_parser('bench', help="loopback transfer benchmark, JSON report")
+    commands.add_parser('scan', help="list peers hosting on the local network")
+    provision_parser = commands.add_parser(
+        'provision', help="install the packages of a dpkg -l snapshot, or push them to a device")
+    if 'bench' in sys.argv[1:]:
+        import bench  # heavy; keep it off the chat start-up path
+        bench.add_suite_arguments(bench_parser)
+    daemon_parser = commands.add_parser('daemon', help="keep authenticated sessions for `send`")
+    send_parser = commands.add_parser('send', help="send files through the daemon, non-interactively")
+    if 'daemon' in sys.argv[1:] or 'send' in sys.argv[1:]:
+        import daemon
+        daemon.add_daemon_arguments(daemon_parser)
+        daemon.add_send_arguments(send_parser)
+    if 'provision' in sys.argv[1:]:
+        import provision
+        provision.add_arguments(provision_parser)
+    args = parser.parse_args()
+    if args.command not in ('bench', 'scan'):
+        import secure
+        if args.plaintext:
+            secure.allow_plaintext()
+        ok, msg = secure.check_ciphers()
+        if msg:
+            print(msg, file=sys.stderr)
+        if not ok:
+            sys.exit(1)
+    if args.metrics_port:
+        import metrics
+        metrics.serve(args.metrics_port)
+    if args.command == 'bench':
+        bench.run_suite_from_args(args)
+    elif args.command == 'provision':
+        provision.run_from_args(args)
+    elif args.command == 'daemon':
+        sys.exit(daemon.run_daemon_from_args(args))
+    elif args.command == 'send':
+        sys.exit(daemon.run_send_from_args(args))
+    elif args.command == 'scan':
+        from discovery import Discovery, describe
+        from utils import get_local_ip
+        discovery = Discovery()
+        discovery.find_lan_peers(get_local_ip())
+        peers = discovery.lan_peers()
+        for peer in peers:
+            print(describe(peer))
+        if not peers:
+            print("No peers found on the local network")
+    elif args.engine == 'async':
+        from async_peer import AsyncPeer
+        AsyncPeer().start()
+    else:
+        from peer import Peer
+        peer = Peer()
+        peer.scheduler.set_limits(rate=args.limit and args.limit * 1000,
+                                  peer_rate=args.peer_limit and args.peer_limit * 1000,
+                                  max_concurrent=args.max_transfers)
+        if args.link:
+            peer.link = args.link
+        peer.start()
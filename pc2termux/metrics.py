@@ -0,0 +1,338 @@
+"""
+Transfer metrics: progress, rates and where the time goes.
+
+A Meter is attached to the socket (or stream) a transfer runs over; the
+send and receive loops in filetransfer look it up once per call with
+meter_for() and report bytes moved, time blocked in the network and
+time spent on disk. A background sampler turns the counters into
+instantaneous and EWMA rates and probes how many bytes sit in the
+socket queues. snapshot() returns everything as a dict, which the chat
+progress line and the local HTTP endpoint (JSON or Prometheus text) read.
+"""
+import json
+import sys
+import threading
+import time
+import weakref
+from constants import METRICS_INTERVAL, METRICS_EWMA_ALPHA, METRICS_KEEP_FINISHED
+
+try:
+    import fcntl
+    import termios
+except ImportError:  # not available on Windows
+    fcntl = termios = None
+
+
+class _NullMeter:
+    """Stand-in when nothing is being measured, so the hooks need no checks."""
+
+    def begin(self, name, total, base=0):
+        pass
+
+    def net(self, n, seconds):
+        pass
+
+    def disk(self, seconds):
+        pass
+
+    def watch_queue(self, name, depth):
+        pass
+
+
+NULL = _NullMeter()
+
+
+class Meter:
+    """Counters for one transfer. The transfer loops write, everyone else reads."""
+
+    def __init__(self, direction, name='?', total=0):
+        self.direction = direction
+        self.name = name
+        self.total = total
+        self.base = 0           # bytes that were already there (resume)
+        self.done = 0           # payload bytes moved by this transfer
+        self.net_s = 0.0        # blocked in send/recv/sendfile
+        self.disk_s = 0.0       # reading or writing the file
+        self.started = time.monotonic()
+        self.finished = None
+        self.ok = None
+        self.rate = 0.0
+        self.ewma = 0.0
+        self.in_flight = 0
+        self.queues = {}
+        self.sock = None
+        self._last = (self.started, 0)
+
+    def begin(self, name, total, base=0):
+        self.name = name
+        self.total = total
+        self.base = base
+
+    def net(self, n, seconds):
+        self.done += n
+        self.net_s += seconds
+
+    def disk(self, seconds):
+        self.disk_s += seconds
+
+    def watch_queue(self, name, depth):
+        """Report `depth()` (e.g. a Queue's qsize) as a queue depth while active."""
+        self.queues[name] = depth
+
+    def sample(self, now):
+        last_t, last_done = self._last
+        if now > last_t:
+            self.rate = (self.done - last_done) / (now - last_t)
+            self.ewma = (self.rate if last_done == 0 and self.ewma == 0 else
+                         METRICS_EWMA_ALPHA * self.rate + (1 - METRICS_EWMA_ALPHA) * self.ewma)
+        self._last = (now, self.done)
+        self.in_flight = _queued_bytes(self.sock, self.direction)
+
+    def finish(self, ok):
+        self.ok = ok
+        self.finished = time.monotonic()
+        self.sock = None
+        self.queues = {}
+        _retire(self)
+
+    def as_dict(self):
+        elapsed = (self.finished or time.monotonic()) - self.started
+        progress = self.base + self.done
+        return {
+            'name': self.name, 'direction': self.direction, 'total_bytes': self.total,
+            'bytes': progress, 'percent': round(100 * progress / self.total, 1) if self.total else None,
+            'elapsed_s': round(elapsed, 3),
+            'rate_bps': round(self.rate), 'ewma_bps': round(self.ewma),
+            'avg_bps': round(self.done / elapsed) if elapsed else 0,
+            'eta_s': round((self.total - progress) / self.ewma, 1)
+                     if self.ewma and self.finished is None and self.total else None,
+            'net_s': round(self.net_s, 3), 'disk_s': round(self.disk_s, 3),
+            'in_flight_bytes': self.in_flight,
+            'queues': {k: _safe_call(v) for k, v in self.queues.items()},
+            'ok': self.ok,
+        }
+
+
+_lock = threading.Lock()
+_by_sock = weakref.WeakKeyDictionary()
+_active = []
+_finished = []
+_totals = {}  # (direction, outcome) -> [transfers, bytes]
+_sampler = None
+
+
+def track(direction, sock=None, name='?', total=0):
+    """Start measuring a transfer; attach it to `sock` if given."""
+    meter = Meter(direction, name, total)
+    with _lock:
+        _active.append(meter)
+    if sock is not None:
+        attach(sock, meter)
+    _start_sampler()
+    return meter
+
+
+def attach(sock, meter):
+    """Route the hooks of transfers on `sock` to `meter` (one meter may span retries)."""
+    with _lock:
+        _by_sock[sock] = meter
+    meter.sock = sock
+
+
+def meter_for(sock):
+    """The meter for a socket, or for the socket under its wrappers (compression, throttling)."""
+    for _ in range(4):
+        try:
+            meter = _by_sock.get(sock)
+        except TypeError:  # not weak-referenceable
+            meter = None
+        if meter is not None:
+            return meter
+        sock = getattr(sock, 'sock', None)
+        if sock is None:
+            break
+    return NULL
+
+
+def _retire(meter):
+    key = (meter.direction, 'ok' if meter.ok else 'failed')
+    with _lock:
+        if meter in _active:
+            _active.remove(meter)
+        _finished.append(meter)
+        del _finished[:-METRICS_KEEP_FINISHED]
+        count = _totals.setdefault(key, [0, 0])
+        count[0] += 1
+        count[1] += meter.done
+
+
+def _safe_call(fn):
+    try:
+        return fn()
+    except Exception:
+        return None
+
+
+def _queued_bytes(sock, direction):
+    """Bytes still in our send queue (sending) or unread in the receive queue."""
+    while sock is not None and not hasattr(sock, 'fileno') and hasattr(sock, 'sock'):
+        sock = sock.sock  # e.g. an encrypting layer, which hides its fileno
+    if sock is None:
+        return 0
+    if hasattr(sock, 'queued'):
+        return sock.queued(direction)
+    if fcntl is None:
+        return 0
+    try:
+        request = termios.TIOCOUTQ if direction == 'send' else termios.FIONREAD
+        return int.from_bytes(fcntl.ioctl(sock.fileno(), request, b'\0' * 4), 'little')
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def _start_sampler():
+    global _sampler
+    with _lock:
+        if _sampler is not None:
+            return
+        _sampler = threading.Thread(target=_sample_loop, daemon=True)
+    _sampler.start()
+
+
+def _sample_loop():
+    while True:
+        time.sleep(METRICS_INTERVAL)
+        now = time.monotonic()
+        with _lock:
+            meters = list(_active)
+        for meter in meters:
+            meter.sample(now)
+
+
+def snapshot():
+    """Active and recently finished transfers plus running totals, as a dict."""
+    with _lock:
+        active, finished = list(_active), list(_finished)
+        totals = {f"{d}_{o}": {'transfers': c[0], 'bytes': c[1]} for (d, o), c in _totals.items()}
+    return {'active': [m.as_dict() for m in active],
+            'finished': [m.as_dict() for m in finished],
+            'totals': totals}
+
+
+def prometheus_text():
+    """snapshot() in the Prometheus text exposition format."""
+    snap = snapshot()
+    lines = []
+
+    def metric(name, kind, helptext, samples):
+        lines.append(f"# HELP pc2termux_{name} {helptext}")
+        lines.append(f"# TYPE pc2termux_{name} {kind}")
+        for labels, value in samples:
+            label = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+            lines.append(f"pc2termux_{name}{{{label}}} {value}" if label else
+                         f"pc2termux_{name} {value}")
+
+    totals = [(key.rsplit('_', 1), v) for key, v in snap['totals'].items()]
+    metric('transfers_total', 'counter', "Finished transfers.",
+           [({'direction': d, 'result': o}, v['transfers']) for (d, o), v in totals])
+    metric('transfer_bytes_total', 'counter', "Payload bytes moved by finished transfers.",
+           [({'direction': d, 'result': o}, v['bytes']) for (d, o), v in totals])
+    active = snap['active']
+    metric('active_transfers', 'gauge', "Transfers in progress.", [({}, len(active))])
+    per = lambda key: [({'name': t['name'], 'direction': t['direction']}, t[key]) for t in active]
+    metric('transfer_bytes', 'gauge', "Bytes done per active transfer.", per('bytes'))
+    metric('transfer_size_bytes', 'gauge', "Announced size per active transfer.", per('total_bytes'))
+    metric('transfer_rate_bps', 'gauge', "Instantaneous rate.", per('rate_bps'))
+    metric('transfer_ewma_bps', 'gauge', "Smoothed rate.", per('ewma_bps'))
+    metric('transfer_in_flight_bytes', 'gauge', "Bytes queued in the socket.", per('in_flight_bytes'))
+    metric('transfer_net_seconds', 'counter', "Time blocked in send/recv.", per('net_s'))
+    metric('transfer_disk_seconds', 'counter', "Time spent on disk I/O.", per('disk_s'))
+    metric('transfer_queue_depth', 'gauge', "Items waiting in internal queues.",
+           [({'name': t['name'], 'queue': q}, d) for t in active
+            for q, d in t['queues'].items() if d is not None])
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _handler():
+    """The request handler, built on first use: http.server is slow to import."""
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith('/metrics.json'):
+                body, kind = json.dumps(snapshot()).encode(), 'application/json'
+            elif self.path.startswith('/metrics'):
+                body, kind = prometheus_text().encode(), 'text/plain; version=0.0.4'
+            else:
+                self.send_error(404, "Try /metrics or /metrics.json")
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', kind)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # keep the chat screen clean
+
+    return Handler
+
+
+def serve(port, host='127.0.0.1'):
+    """Serve /metrics (Prometheus text) and /metrics.json on a local port."""
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer((host, port), _handler())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _human(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(n) < 1000:
+            return f"{n:.1f} {unit}"
+        n /= 1000
+    return f"{n:.1f} TB"
+
+
+def progress_line(snap=None):
+    """One line summarising the active transfers, or '' when there are none."""
+    parts = []
+    for t in (snap or snapshot())['active']:
+        busy = t['net_s'] + t['disk_s']
+        where = f"net {100 * t['net_s'] / busy:.0f}%" if busy else ""
+        percent = f"{t['percent']:.0f}%" if t['percent'] is not None else _human(t['bytes'])
+        eta = f" eta {t['eta_s']:.0f}s" if t['eta_s'] is not None else ""
+        arrow = '>' if t['direction'] == 'send' else '<'
+        parts.append(f"{arrow} {t['name']} {percent} {_human(t['ewma_bps'])}/s{eta} {where}".rstrip())
+    return ' | '.join(parts)
+
+
+class ProgressPrinter:
+    """Redraws a progress line on the terminal while transfers are active."""
+
+    def __init__(self, stream=None, interval=METRICS_INTERVAL):
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.running = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        shown = False
+        while self.running:
+            time.sleep(self.interval)
+            line = progress_line()
+            if line:
+                self.stream.write(f"\r\x1b[K[xfer] {line}")
+                self.stream.flush()
+                shown = True
+            elif shown:
+                self.stream.write("\r\x1b[K")
+                self.stream.flush()
+                shown = False
+
+    def stop(self):
+        self.running = False
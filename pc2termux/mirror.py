@@ -0,0 +1,328 @@
+"""
+Keep a local directory mirrored on the peer.
+
+A sqlite index remembers (path, size, mtime, hash) of every file that
+was last sent, per mirror, so a restart only ships what changed while we
+were away. Changes are noticed through inotify (via ctypes, no extra
+package). Where inotify is unavailable or runs out of watches, the tree
+is rescanned with a cheap stat-diff every MIRROR_POLL_INTERVAL. Events are
+coalesced until the tree has been quiet for MIRROR_DEBOUNCE seconds.
+Only the changed paths are then stat'ed and hashed. Files with new content go
+out as one batch, together with delete entries for the files that are
+gone. A file that was touched without changing is not resent.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import sqlite3
+import stat
+import struct
+import threading
+import time
+from constants import MIRROR_INDEX, MIRROR_DEBOUNCE, MIRROR_MAX_DELAY, MIRROR_POLL_INTERVAL
+from dedup import file_digest
+
+
+class MirrorIndex:
+    """sqlite table of what each mirror last sent: (mirror, path) -> size, mtime, hash."""
+
+    def __init__(self, path=MIRROR_INDEX):
+        path = os.path.expanduser(path)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS files (mirror TEXT, path TEXT, "
+                            "size INTEGER, mtime_ns INTEGER, hash TEXT, "
+                            "PRIMARY KEY (mirror, path)) WITHOUT ROWID")
+
+    def get(self, mirror, paths):
+        """{path: (size, mtime_ns, hash)} for those of `paths` that are indexed."""
+        found = {}
+        with self.lock:
+            for path in paths:
+                row = self.db.execute("SELECT size, mtime_ns, hash FROM files "
+                                      "WHERE mirror = ? AND path = ?", (mirror, path)).fetchone()
+                if row:
+                    found[path] = row
+        return found
+
+    def under(self, mirror, directory):
+        """Indexed paths below `directory` ('' for all of them)."""
+        if not directory:
+            query, args = "SELECT path FROM files WHERE mirror = ?", (mirror,)
+        else:
+            # '0' sorts right after '/', so this is the range of "directory/..."
+            query = "SELECT path FROM files WHERE mirror = ? AND path > ? AND path < ?"
+            args = (mirror, directory + '/', directory + '0')
+        with self.lock:
+            return [row[0] for row in self.db.execute(query, args)]
+
+    def update(self, mirror, files, deleted=()):
+        """Record `files` ({path: (size, mtime_ns, hash)}) and drop `deleted`, atomically."""
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                                [(mirror, path) + tuple(row) for path, row in files.items()])
+            self.db.executemany("DELETE FROM files WHERE mirror = ? AND path = ?",
+                                [(mirror, path) for path in deleted])
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def scan(root):
+    """{relpath: (size, mtime_ns)} of every regular file under root."""
+    found = {}
+    stack = ['']
+    while stack:
+        rel = stack.pop()
+        try:
+            entries = list(os.scandir(os.path.join(root, rel)))
+        except OSError:
+            continue
+        for entry in entries:
+            path = f"{rel}/{entry.name}" if rel else entry.name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(path)
+                elif entry.is_file():
+                    st = entry.stat()
+                    found[path] = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                continue
+    return found
+
+
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, name length
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+_WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+               IN_ONLYDIR)
+
+
+class Inotify:
+    """
+    inotify watches on every directory of a tree. changes() returns the
+    relative paths that something happened to, or None when events were
+    lost and the caller has to rescan. Raises OSError where inotify
+    can't be used.
+    """
+
+    def __init__(self, root):
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self.libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+            fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        except (AttributeError, OSError, TypeError):
+            raise OSError("inotify is not available")
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.fd = fd
+        self.root = root
+        self.dirs = {}  # wd -> directory relative to root
+        try:
+            self.add_tree('')
+        except OSError:
+            self.close()
+            raise
+
+    def add_tree(self, rel):
+        """Watch `rel` and every directory below it (a moved-in tree keeps the same wds)."""
+        stack = [rel]
+        while stack:
+            rel = stack.pop()
+            path = os.path.join(self.root, rel)
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), _WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == 28:  # ENOSPC: out of watches (fs.inotify.max_user_watches)
+                    raise OSError(err, "inotify watch limit reached")
+                continue  # vanished already
+            self.dirs[wd] = rel
+            try:
+                stack.extend(os.path.join(rel, e.name) if rel else e.name
+                             for e in os.scandir(path) if e.is_dir(follow_symlinks=False))
+            except OSError:
+                pass
+
+    def changes(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        pos = 0
+        while pos + _EVENT.size <= len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, pos)
+            name = os.fsdecode(data[pos + _EVENT.size:pos + _EVENT.size + length].rstrip(b'\0'))
+            pos += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            parent = self.dirs.get(wd)
+            if parent is None or not name:
+                continue
+            rel = f"{parent}/{name}" if parent else name
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(rel)
+            changed.add(rel)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Poller:
+    """The fallback: a stat-diff of the whole tree every `interval` seconds."""
+
+    def __init__(self, root, interval=MIRROR_POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self.last = scan(root)
+        self.next = time.monotonic() + interval
+
+    def changes(self, timeout):
+        wait = self.next - time.monotonic()
+        if timeout is not None and timeout < wait:
+            time.sleep(max(0, timeout))
+            return set()
+        time.sleep(max(0, wait))
+        self.next = time.monotonic() + self.interval
+        current = scan(self.root)
+        changed = {path for path, st in current.items() if self.last.get(path) != st}
+        changed.update(path for path in self.last if path not in current)
+        self.last = current
+        return changed
+
+    def close(self):
+        pass
+
+
+class Mirror:
+    """
+    Mirror `root` through send(entries, deleted) -> (success, message), where
+    entries are (path, relpath) pairs and deleted are relpaths, both under
+    the directory's own name (like a /sendfile of the directory). `key`
+    names this mirror in the index, e.g. the peer's address plus the path.
+    """
+
+    def __init__(self, root, key, send, index=None, debounce=MIRROR_DEBOUNCE,
+                 max_delay=MIRROR_MAX_DELAY):
+        self.root = os.path.abspath(root)
+        self.label = os.path.basename(self.root)
+        self.key = key
+        self.send = send
+        self.index = index or MirrorIndex()
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.watcher = None
+        self.running = False
+        self.synced = 0  # files sent or deleted so far
+        self.thread = None
+
+    @property
+    def mode(self):
+        return 'inotify' if isinstance(self.watcher, Inotify) else 'polling'
+
+    def start(self):
+        try:
+            self.watcher = Inotify(self.root)
+        except OSError:
+            self.watcher = Poller(self.root)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def _run(self):
+        # the first pass compares the whole tree with what we sent last time
+        dirty = set(scan(self.root)) | set(self.index.under(self.key, ''))
+        first = time.monotonic()
+        quiet = first
+        try:
+            while self.running:
+                if dirty:
+                    now = time.monotonic()
+                    wait = min(quiet + self.debounce, first + self.max_delay) - now
+                    if wait <= 0:
+                        if not self.sync(dirty):
+                            time.sleep(self.max_delay)  # leave them dirty and try again
+                        else:
+                            dirty = set()
+                        continue
+                else:
+                    wait = 1.0  # wake up now and then to notice stop()
+                try:
+                    changed = self.watcher.changes(min(wait, 1.0))
+                except OSError:  # out of watches for a new subtree
+                    self.watcher.close()
+                    self.watcher = Poller(self.root)
+                    changed = None
+                if changed is None:  # the kernel dropped events
+                    changed = set(scan(self.root)) | set(self.index.under(self.key, ''))
+                if changed:
+                    quiet = time.monotonic()
+                    if not dirty:
+                        first = quiet
+                    dirty |= changed
+        finally:
+            self.watcher.close()
+
+    def sync(self, dirty):
+        """Send what changed among the `dirty` relpaths; returns True unless sending failed."""
+        paths = set()
+        for rel in dirty:
+            full = os.path.join(self.root, rel)
+            if os.path.isdir(full):
+                paths.update(f"{rel}/{sub}" for sub in scan(full))
+            paths.update(self.index.under(self.key, rel))  # a directory's former contents
+            paths.add(rel)
+        known = self.index.get(self.key, paths)
+        changed, touched, deleted = {}, {}, []
+        for rel in sorted(paths):
+            full = os.path.join(self.root, rel)
+            try:
+                st = os.stat(full)
+            except OSError:
+                st = None
+            if st is None or not stat.S_ISREG(st.st_mode):
+                if rel in known:
+                    deleted.append(rel)
+                continue
+            old = known.get(rel)
+            if old and old[:2] == (st.st_size, st.st_mtime_ns):
+                continue
+            try:
+                digest = file_digest(full)
+            except OSError:
+                continue  # vanished meanwhile; the next event says so
+            row = (st.st_size, st.st_mtime_ns, digest)
+            if old and (old[0], old[2]) == (st.st_size, digest):
+                touched[rel] = row  # same content, only the mtime moved
+            else:
+                changed[rel] = row
+        if changed or deleted:
+            entries = [(os.path.join(self.root, rel), f"{self.label}/{rel}") for rel in changed]
+            success, _ = self.send(entries, [f"{self.label}/{rel}" for rel in deleted])
+            if not success:
+                return False
+            self.synced += len(changed) + len(deleted)
+        else:
+            deleted = []
+        self.index.update(self.key, {**touched, **changed}, deleted)
+        return True
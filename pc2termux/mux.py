@@ -0,0 +1,200 @@
+"""
+Stream multiplexing over the framed chat connection.
+
+File transfers open logical streams on the already authenticated chat
+socket instead of new TCP connections to the file port, so a tunnel only
+has to forward one port. Each stream has a credit window of MUX_WINDOW
+bytes: the sender stops until the receiver has consumed data and handed
+credit back, which keeps bulk data from piling up in front of chat.
+Chat and control frames also jump ahead of waiting data frames.
+"""
+import itertools
+import struct
+import threading
+from chat import STREAM_OPEN, STREAM_DATA, STREAM_WINDOW, STREAM_CLOSE
+from constants import MUX_WINDOW, MUX_FRAME_SIZE
+
+_ID = struct.Struct('!I')
+_GRANT = struct.Struct('!II')
+
+
+class MuxStream:
+    """
+    One logical byte stream. Offers the socket methods FileTransfer uses
+    (sendall, recv, recv_into, settimeout, close), so it can stand in for
+    a TCP connection. No fileno(), so sendfile falls back to copying.
+    """
+
+    def __init__(self, mux, sid):
+        self.mux = mux
+        self.sid = sid
+        self.cond = threading.Condition()
+        self.inbox = bytearray()
+        self.credit = MUX_WINDOW
+        self.consumed = 0       # read by us but not yet credited back
+        self.remote_closed = False
+        self.closed = False
+        self.timeout = None
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def sendall(self, data):
+        view = memoryview(data).cast('B')
+        while view:
+            with self.cond:
+                if not self.cond.wait_for(lambda: self.credit > 0 or self.remote_closed,
+                                          self.timeout):
+                    raise TimeoutError("send timed out")
+                if self.remote_closed or self.closed:
+                    raise BrokenPipeError("Stream closed")
+                n = min(len(view), self.credit, MUX_FRAME_SIZE)
+                self.credit -= n
+            self.mux._send_data(self.sid, view[:n])
+            view = view[n:]
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def recv_into(self, buffer, nbytes=0):
+        view = memoryview(buffer).cast('B')
+        if nbytes:
+            view = view[:nbytes]
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.inbox or self.remote_closed, self.timeout):
+                raise TimeoutError("timed out")
+            n = min(len(view), len(self.inbox))
+            view[:n] = self.inbox[:n]
+            del self.inbox[:n]
+            self.consumed += n
+            grant = 0
+            if self.consumed >= MUX_WINDOW // 2 and not self.remote_closed:
+                grant, self.consumed = self.consumed, 0
+        if grant:
+            self.mux.send_parts(STREAM_WINDOW, _GRANT.pack(self.sid, grant))
+        return n
+
+    def queued(self, direction):
+        """Bytes in flight: sent but not yet credited back, or received but unread."""
+        if direction == 'send':
+            return MUX_WINDOW - self.credit
+        return len(self.inbox)
+
+    def recv(self, size):
+        buf = bytearray(size)
+        n = self.recv_into(buf)
+        return bytes(buf[:n])
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        try:
+            self.mux.send_parts(STREAM_CLOSE, _ID.pack(self.sid))
+        except OSError:
+            pass
+        self.mux._forget(self)
+
+    def _feed(self, data):
+        with self.cond:
+            if len(self.inbox) + len(data) > MUX_WINDOW:
+                raise ValueError(f"Stream {self.sid} overran its window")
+            self.inbox += data
+            self.cond.notify_all()
+
+    def _grant(self, credit):
+        with self.cond:
+            self.credit += credit
+            self.cond.notify_all()
+
+    def _finish(self):
+        with self.cond:
+            self.remote_closed = True
+            self.cond.notify_all()
+
+
+class Mux:
+    """
+    Stream table for one Channel. The side that connected uses odd stream
+    ids and the host even ones, so both may open streams at once. The
+    chat receive loop passes every frame to handle(); `on_stream` runs in
+    a new thread for each stream the peer opens.
+    """
+
+    def __init__(self, channel, initiator, on_stream):
+        self.channel = channel
+        self.on_stream = on_stream
+        self.streams = {}
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1 if initiator else 2, 2)
+        self._urgent = 0
+        self._urgent_cond = threading.Condition()
+
+    def open_stream(self):
+        with self.lock:
+            stream = MuxStream(self, next(self._ids))
+            self.streams[stream.sid] = stream
+        self.send_parts(STREAM_OPEN, _ID.pack(stream.sid))
+        return stream
+
+    def send(self, ftype, payload=b''):
+        """Send a chat or control frame ahead of any waiting stream data."""
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.send_parts(ftype, payload)
+
+    def send_parts(self, ftype, *parts):
+        with self._urgent_cond:
+            self._urgent += 1
+        try:
+            self.channel.send_parts(ftype, *parts)
+        finally:
+            with self._urgent_cond:
+                self._urgent -= 1
+                self._urgent_cond.notify_all()
+
+    def _send_data(self, sid, view):
+        with self._urgent_cond:
+            self._urgent_cond.wait_for(lambda: self._urgent == 0)
+        self.channel.send_parts(STREAM_DATA, _ID.pack(sid), view)
+
+    def _forget(self, stream):
+        with self.lock:
+            if stream.remote_closed and self.streams.get(stream.sid) is stream:
+                del self.streams[stream.sid]
+
+    def handle(self, ftype, payload):
+        """Consume a stream frame; returns False for frames that aren't ours."""
+        if ftype not in (STREAM_OPEN, STREAM_DATA, STREAM_WINDOW, STREAM_CLOSE):
+            return False
+        (sid,) = _ID.unpack_from(payload)
+        with self.lock:
+            stream = self.streams.get(sid)
+            if ftype == STREAM_OPEN and stream is None:
+                stream = self.streams[sid] = MuxStream(self, sid)
+                threading.Thread(target=self.on_stream, args=(stream,), daemon=True).start()
+        if stream is None:
+            return True  # late frame for a stream we already dropped
+        if ftype == STREAM_DATA:
+            stream._feed(bytes(payload[_ID.size:]))
+        elif ftype == STREAM_WINDOW:
+            stream._grant(_GRANT.unpack_from(payload)[1])
+        elif ftype == STREAM_CLOSE:
+            stream._finish()
+            if stream.closed:
+                self._forget(stream)
+        return True
+
+    def close_all(self):
+        """The connection is gone: wake every stream with end-of-stream."""
+        with self.lock:
+            streams = list(self.streams.values())
+            self.streams.clear()
+        for stream in streams:
+            stream._finish()
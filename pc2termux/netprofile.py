@@ -0,0 +1,191 @@
+"""
+Socket tuning per link type.
+
+A Profile sets the kernel socket buffer sizes, how much unsent data a
+socket may queue (TCP_NOTSENT_LOWAT, so chat and stream control frames
+don't wait behind megabytes of file data), how much send_range hands to
+sendfile at once, and the keepalive timing. There is a named profile
+for each common link; 'auto' measures RTT and bandwidth over the chat
+connection once connected and sizes everything from the bandwidth-delay
+product.
+"""
+import ipaddress
+import os
+import socket
+import sys
+import threading
+import time
+import weakref
+from constants import SENDFILE_CHUNK, HANDSHAKE_TIMEOUT, PROBE_PINGS, PROBE_BYTES
+
+KB = 1024
+MB = 1024 * 1024
+
+# the Linux value; Python only exports the name from 3.12 on
+_NOTSENT_LOWAT = getattr(socket, 'TCP_NOTSENT_LOWAT',
+                         25 if sys.platform.startswith('linux') else None)
+
+
+class Profile:
+    """Socket settings for one kind of link. keepalive is (idle s, interval s, probes)."""
+
+    def __init__(self, name, buffer, lowat, chunk, keepalive):
+        self.name = name
+        self.buffer = buffer
+        self.lowat = lowat
+        self.chunk = chunk
+        self.keepalive = keepalive
+
+    @classmethod
+    def for_link(cls, rtt, bandwidth):
+        """Size a profile from a measured RTT (seconds) and bandwidth (bytes/s)."""
+        bdp = rtt * bandwidth
+        keepalive = PROFILES['tunnel' if rtt > 0.02 else 'lan'].keepalive
+        return cls(f"auto ({rtt * 1000:.1f} ms, {bandwidth / MB:.1f} MB/s)",
+                   buffer=_fit(2 * bdp, 256 * KB, 16 * MB),
+                   lowat=_fit(bdp / 4, 16 * KB, MB),
+                   chunk=_fit(bdp, 64 * KB, SENDFILE_CHUNK),
+                   keepalive=keepalive)
+
+
+PROFILES = {
+    'lan': Profile('lan', 4 * MB, 256 * KB, MB, (60, 10, 5)),
+    'wifi': Profile('wifi', 2 * MB, 128 * KB, 512 * KB, (60, 10, 5)),
+    'tunnel': Profile('tunnel', MB, 64 * KB, 256 * KB, (30, 10, 3)),
+    'cellular': Profile('cellular', 512 * KB, 32 * KB, 128 * KB, (25, 5, 4)),
+}
+
+
+def _fit(n, low, high):
+    """The next power of two >= n, clamped to [low, high]."""
+    return max(low, min(high, 1 << max(0, int(n) - 1).bit_length()))
+
+
+def guess(host, tunnel=False):
+    """A starting profile before anything has been measured."""
+    if tunnel:
+        return PROFILES['tunnel']
+    try:
+        addr = ipaddress.ip_address(socket.gethostbyname(host))
+    except (OSError, ValueError):
+        return PROFILES['tunnel']
+    if addr.is_loopback:
+        return PROFILES['lan']
+    # a private address is most likely a phone on the same Wi-Fi
+    return PROFILES['wifi' if addr.is_private else 'tunnel']
+
+
+def resolve(name, host, tunnel=False):
+    """The profile called `name`, or a guess for `host` when name is 'auto'."""
+    if name in PROFILES:
+        return PROFILES[name]
+    return guess(host, tunnel)
+
+
+_chunks = weakref.WeakKeyDictionary()
+
+
+def apply(sock, profile, chat=False):
+    """
+    Set the profile's options on a TCP socket (a listening socket passes
+    them on to the connections it accepts). Chat sockets also get
+    TCP_NODELAY. Options the platform lacks are skipped, and objects
+    that aren't sockets (mux streams) are left alone.
+    """
+    if profile is None or not hasattr(sock, 'setsockopt'):
+        return
+    options = [(socket.SOL_SOCKET, socket.SO_SNDBUF, profile.buffer),
+               (socket.SOL_SOCKET, socket.SO_RCVBUF, profile.buffer),
+               (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    idle, interval, count = profile.keepalive
+    for name, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval),
+                        ('TCP_KEEPCNT', count)):
+        if hasattr(socket, name):
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    if _NOTSENT_LOWAT is not None:
+        options.append((socket.IPPROTO_TCP, _NOTSENT_LOWAT, profile.lowat))
+    if chat:
+        options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+    for level, option, value in options:
+        try:
+            sock.setsockopt(level, option, value)
+        except OSError:
+            pass
+    _chunks[sock] = profile.chunk
+
+
+def connect(address, profile, chat=False):
+    """Like socket.create_connection, with the profile applied before connecting."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    apply(sock, profile, chat)
+    try:
+        sock.connect(address)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def chunk_for(sock):
+    """Bytes send_range should hand to sendfile at once on this socket (or its wrappers)."""
+    for _ in range(4):
+        try:
+            chunk = _chunks.get(sock)
+        except TypeError:  # not weak-referenceable
+            chunk = None
+        if chunk is not None:
+            return chunk
+        sock = getattr(sock, 'sock', None)
+        if sock is None:
+            break
+    return SENDFILE_CHUNK
+
+
+class LinkProbe:
+    """
+    Measures a connection with PING frames that the peer echoes back as
+    ACKs. The fastest of PROBE_PINGS empty pings gives the RTT. One ping
+    carrying PROBE_BYTES, which crosses the link twice, gives a rough
+    bandwidth. That figure is a lower bound, since TCP may still be in
+    slow start.
+    """
+
+    def __init__(self, send):
+        self.send = send  # send(payload) transmits one PING frame
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def on_ack(self, payload):
+        """Feed an ACK payload; returns False if it isn't one of ours."""
+        with self.lock:
+            event = self.pending.get(bytes(payload[:8]))
+        if event is None:
+            return False
+        event.set()
+        return True
+
+    def _ping(self, size, timeout):
+        token = b'probe' + os.urandom(3)
+        event = threading.Event()
+        with self.lock:
+            self.pending[token] = event
+        start = time.perf_counter()
+        try:
+            self.send(token + bytes(size))
+            if not event.wait(timeout):
+                return None
+            return time.perf_counter() - start
+        finally:
+            with self.lock:
+                self.pending.pop(token, None)
+
+    def run(self, timeout=HANDSHAKE_TIMEOUT):
+        """Returns (rtt seconds, bandwidth bytes/s), or None if the peer didn't answer."""
+        rtts = [t for t in (self._ping(0, timeout) for _ in range(PROBE_PINGS)) if t is not None]
+        if not rtts:
+            return None
+        rtt = min(rtts)
+        bulk = self._ping(PROBE_BYTES, timeout)
+        if bulk is None:
+            return None
+        return rtt, 2 * PROBE_BYTES / max(bulk - rtt, 1e-6)
@@ -1,13 +1,29 @@
 import socket
 import threading
 import os
-from utils import get_local_ip, generate_password, get_public_ip, get_serveo_command
-from constants import DEFAULT_PORT, DEFAULT_FILE_PORT
-from filetransfer import FileTransfer
+import time
+import metrics
+import netprofile
+from utils import get_local_ip, generate_password, get_serveo_command
+from constants import (DEFAULT_PORT, DEFAULT_FILE_PORT, TRANSFER_RETRIES, RETRY_DELAY,
+                       STRIPE_THRESHOLD, LINK_PROFILE, PUBLIC_IP_TIMEOUT, CHATLOG_REPLAY_LIMIT,
+                       CHATLOG_SHOW)
+from filetransfer import FileTransfer, flat_paths
+from chat import (Channel, TEXT, CONTROL, FILE_OFFER, ACK, PING, HISTORY, client_handshake,
+                  server_handshake)
+from mux import Mux
+from secure import plaintext_note, secure_incoming
+from scheduler import Scheduler
+from discovery import Discovery, BeaconResponder, describe
+from streams import CommandSink, CommandSource, PipeSink
+from mirror import Mirror, MirrorIndex
+from chatlog import History, node_id, parse_records
 
 class Peer:
     def __init__(self):
         self.ip = get_local_ip()
+        self.discovery = Discovery()
+        self.discovery.find_public_ip(self.ip)
         self.port = DEFAULT_PORT
         self.file_port = DEFAULT_FILE_PORT
         self.password = generate_password(4)
@@ -15,9 +31,36 @@ class Peer:
         self.running = True
         self.remote_ip = None
         self.chat_socket = None
-        self.chat_reader = None
+        self.channel = None
+        self.mux = None
+        self.tunnel = False  # files go over the chat connection instead of the file port
+        self.single_files = False  # the host (async engine) takes one plain file per connection
+        self.link = LINK_PROFILE
+        self.profile = None
+        self.probe = None
+        self._ping_sent = {}
+        self.progress = None
+        self.sink = None  # makes the sink for each incoming transfer; None saves files
+        self.remote_sink = False  # the peer pipes what we send, so no striping or batches
+        self.scheduler = Scheduler(on_done=self._transfer_done)
+        self.mirrors = {}  # absolute directory -> Mirror
+        self.mirror_index = None  # opened with the first /mirror
+        self.history = None  # chat log with this peer, once it has told us its node id
+        self.history_lock = threading.Lock()  # logging a message and sending it go together
+        self._announced = None  # our first live seq this session; older ones are replayed
+        self._incoming_seq = None  # seq of the peer's next live message
+        self._catching_up = []  # live messages held back until the peer's replay is logged
+        self._replayed = []  # the last of the peer's replayed messages, shown once it is done
+        self._replay_count = 0
         self.file_server_thread = None
         self._start_file_server()
+        self.hosting = None  # 'peer' or 'hub' while we accept connections
+        self.hub = None
+        try:
+            self.beacon = BeaconResponder(self._beacon_info)
+        except OSError:
+            self.beacon = None  # another program holds the port; we just can't be found
+        self.discovery.find_lan_peers(self.ip, exclude=self.beacon and self.beacon.id)
 
     def _start_file_server(self):
         def server_loop():
@@ -28,7 +71,8 @@ class Peer:
                 file_server.listen(5)
                 while self.running:
                     conn, addr = file_server.accept()
-                    threading.Thread(target=self._handle_file_receive,
+                    netprofile.apply(conn, self.profile)
+                    threading.Thread(target=self._handle_file_connection,
                                      args=(conn,), daemon=True).start()
             except Exception as e:
                 if self.running:
@@ -39,34 +83,94 @@ class Peer:
         self.file_server_thread = threading.Thread(target=server_loop, daemon=True)
         self.file_server_thread.start()
 
+    def sessions(self):
+        """The sessions whose peers may open file connections to us."""
+        if self.hub:
+            return self.hub.sessions()
+        return [self.channel.session] if self.channel and self.channel.session else []
+
+    def _handle_file_connection(self, conn):
+        """A connection to the file port: only encrypted transfers from connected peers are accepted."""
+        sessions = self.sessions()
+        try:
+            if not sessions:
+                raise ConnectionError("Transfer refused: not connected")
+            sock = secure_incoming(conn, sessions)
+        except OSError as e:
+            print(f"\n[File error] {e}")
+            conn.close()
+            return
+        self._handle_file_receive(sock)
+
     def _handle_file_receive(self, conn_socket):
-        success, msg = FileTransfer.receive_file(conn_socket)
+        meter = metrics.track('recv', conn_socket)
+        success, msg = FileTransfer.receive_file(conn_socket, sink=self.sink and self.sink())
+        meter.finish(success)
         if success:
-            print(f"\n[File] {msg}")
+            if msg:  # extra stripes of a parallel transfer report nothing
+                print(f"\n[File] {msg}")
         else:
             print(f"\n[File error] {msg}")
         conn_socket.close()
 
     def start(self):
         print(f"Your local IP: {self.ip}")
-        print(f"Your public IP: {get_public_ip()} (if behind NAT, this may not be reachable directly)")
-        choice = input("Host (h) or Connect (c)? ").strip().lower()
+        self._print_public_ip()
+        choice = input("Host (h), Connect (c) or Hub for many peers (u)? ").strip().lower()
         if choice == 'h':
             self._host()
+        elif choice == 'u':
+            from hub import Hub
+            self.hub = Hub(self)
+            try:
+                self.hub.run()
+            finally:
+                self.hub = None
         elif choice == 'c':
-            remote_ip = input("Enter remote IP or hostname: ").strip()
-            remote_port_input = input(f"Enter remote port (default {DEFAULT_PORT}): ").strip()
-            remote_port = int(remote_port_input) if remote_port_input else DEFAULT_PORT
+            peers = self._list_lan_peers()
+            remote_ip = input("Enter remote IP or hostname" +
+                              (" (or a number from the list): " if peers else ": ")).strip()
+            if remote_ip.isdigit() and 1 <= int(remote_ip) <= len(peers):
+                picked = peers[int(remote_ip) - 1]
+                remote_ip, remote_port = picked['ip'], picked['port']
+            else:
+                remote_port_input = input(f"Enter remote port (default {DEFAULT_PORT}): ").strip()
+                remote_port = int(remote_port_input) if remote_port_input else DEFAULT_PORT
             remote_password = input("Enter remote password: ").strip()
             self._connect(remote_ip, remote_port, remote_password)
         else:
             print("Invalid choice")
 
+    def _beacon_info(self):
+        """What the beacon answers while we host; None keeps it quiet."""
+        if not self.hosting:
+            return None
+        return {'name': socket.gethostname(), 'port': self.port, 'file_port': self.file_port,
+                'hub': self.hosting == 'hub'}
+
+    def _list_lan_peers(self):
+        print("Looking for peers on the local network...")
+        peers = self.discovery.lan_peers()
+        for i, peer in enumerate(peers, 1):
+            print(f"  {i}) {describe(peer)}")
+        if not peers:
+            print("  (none found)")
+        return peers
+
+    def _print_public_ip(self, wait=0):
+        public_ip = self.discovery.public_ip(wait)
+        if public_ip:
+            print(f"Your public IP: {public_ip} (if behind NAT, this may not be reachable directly)")
+        elif not wait:
+            print("Your public IP: looking it up in the background")
+        return public_ip
+
     def _host(self):
         # Ask if user wants to use serveo tunnel
         use_serveo = input("Use serveo.net tunnel for easy internet access? (y/n): ").strip().lower()
         if use_serveo == 'y':
-            cmd = get_serveo_command(self.port, self.file_port)
+            self.tunnel = True
+            cmd = get_serveo_command(self.port)
             print("\n" + "="*60)
             print("Run this command in another terminal (SSH must be installed):")
             print(cmd)
@@ -74,12 +178,10 @@ class Peer:
             print("Give that hostname to the remote peer.")
             input("Press Enter after the tunnel is established...")
         else:
-            # Optional UPnP attempt (if miniupnpc installed)
-            try:
-                import miniupnpc
-                self._try_upnp()
-            except ImportError:
-                pass
+            if not self.discovery.public_ip():
+                self._print_public_ip(wait=PUBLIC_IP_TIMEOUT)
+            # Optional UPnP attempt (if miniupnpc installed), without holding up the prompt
+            threading.Thread(target=self._try_upnp, daemon=True).start()
 
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -89,38 +191,46 @@ class Peer:
             print(f"Hosting on {self.ip}:{self.port}")
             print(f"Password: {self.password}")
             print("Waiting for connection...")
-            self.chat_socket, addr = server.accept()
-            self.remote_ip = addr[0]
-            print(f"Connected by {self.remote_ip}")
+            self.hosting = 'peer'
+            # keep waiting past failed handshakes (wrong password, LAN scans)
+            while not self.connected:
+                self.chat_socket, addr = server.accept()
+                self.remote_ip = addr[0]
+                self.profile = netprofile.resolve(self.link, self.remote_ip, self.tunnel)
+                netprofile.apply(self.chat_socket, self.profile, chat=True)
 
-            data = self.chat_socket.recv(1024).decode().strip()
-            if data == self.password:
-                self.chat_socket.send(b"OK")
-                self.connected = True
-                print("Handshake successful")
-                self._start_chat()
-            else:
-                self.chat_socket.send(b"ERROR: Wrong password")
-                self.chat_socket.close()
-                print("Handshake failed: wrong password")
+                self.channel = Channel(self.chat_socket)
+                ok, reason = server_handshake(self.channel, self.password,
+                                              'mux' if self.tunnel else '')
+                if ok:
+                    self.connected = True
+                else:
+                    self.chat_socket.close()
+                    if reason != "No handshake":
+                        print(f"Handshake from {self.remote_ip} failed: {reason}")
+            self.hosting = None
+            server.close()
+            print(f"Connected by {self.remote_ip}")
+            print("Handshake successful" + plaintext_note(self.channel.session))
+            self._start_chat(initiator=False)
         except Exception as e:
             print(f"Host error: {e}")
         finally:
+            self.hosting = None
             server.close()
 
     def _try_upnp(self):
         """Attempt UPnP port forwarding (if miniupnpc is available)."""
-        import miniupnpc
+        try:
+            import miniupnpc
+        except ImportError:
+            return
         try:
             upnp = miniupnpc.UPnP()
             upnp.discoverdelay = 200
             upnp.discover()
             upnp.selectigd()
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(('8.8.8.8', 80))
-            local_ip = s.getsockname()[0]
-            s.close()
-            result = upnp.addportmapping(self.port, 'TCP', local_ip, self.port, 'P2PChat', '')
+            result = upnp.addportmapping(self.port, 'TCP', self.ip, self.port, 'P2PChat', '')
             if result:
                 ext_ip = upnp.externalipaddress()
                 print(f"✅ UPnP opened port {self.port}. Public IP: {ext_ip}")
@@ -130,57 +240,142 @@ class Peer:
             print(f"UPnP error: {e}")
 
     def _connect(self, remote_ip, remote_port, password):
-        self.chat_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            self.chat_socket.connect((remote_ip, remote_port))
+            self.profile = netprofile.resolve(self.link, remote_ip)
+            self.chat_socket = netprofile.connect((remote_ip, remote_port), self.profile, chat=True)
             self.remote_ip = remote_ip
-            self.chat_socket.send(password.encode())
-            response = self.chat_socket.recv(1024).decode().strip()
-            if response == "OK":
+            self.channel = Channel(self.chat_socket)
+            ok, reason = client_handshake(self.channel, password)
+            if ok:
+                self.tunnel = 'mux' in reason.split()
+                self.single_files = 'single' in reason.split()
+                if self.tunnel and self.link == 'auto':
+                    self.profile = netprofile.PROFILES['tunnel']
+                    netprofile.apply(self.chat_socket, self.profile, chat=True)
                 self.connected = True
-                print("Handshake successful")
-                self._start_chat()
+                print("Handshake successful" + (" (files share this connection)" if self.tunnel else "")
+                      + plaintext_note(self.channel.session))
+                self._start_chat(initiator=True)
             else:
-                print(f"Handshake failed: {response}")
+                print(f"Handshake failed: {reason}")
                 self.chat_socket.close()
         except Exception as e:
             print(f"Connection error: {e}")
+            if self.chat_socket:
+                self.chat_socket.close()
 
-    def _start_chat(self):
-        self.chat_reader = self.chat_socket.makefile('r')
+    def _start_chat(self, initiator):
+        self.mux = Mux(self.channel, initiator, self._handle_file_receive)
+        self.progress = metrics.ProgressPrinter()
+        self.mux.send(CONTROL, f"history {node_id()}")
         receiver = threading.Thread(target=self._receive_loop, daemon=True)
         receiver.start()
+        if initiator and self.link == 'auto':
+            threading.Thread(target=self._probe_link, daemon=True).start()
         self._input_loop()
 
+    def _probe_link(self):
+        """Measure the link, tune for it and tell the host what we found."""
+        self.probe = netprofile.LinkProbe(lambda payload: self.mux.send(PING, payload))
+        try:
+            result = self.probe.run()
+            if result:
+                self._adopt_link(*result)
+                self.mux.send(CONTROL, f"link {result[0]:.6f} {result[1]:.0f}")
+        except OSError:
+            pass
+        finally:
+            self.probe = None
+
+    def _adopt_link(self, rtt, bandwidth):
+        self.profile = netprofile.Profile.for_link(rtt, bandwidth)
+        netprofile.apply(self.chat_socket, self.profile, chat=True)
+        print(f"\n[Link] {self.profile.name}")
+
     def _receive_loop(self):
         try:
-            for line in self.chat_reader:
+            for ftype, payload in self.channel:
                 if not self.connected:
                     break
-                print(f"\n[Remote]: {line.strip()}")
-        except:
+                if self.mux.handle(ftype, payload):
+                    continue
+                if ftype == TEXT:
+                    text = str(payload, 'utf-8', 'replace')
+                    print(f"\n[Remote]: {text}")
+                    self._log_incoming(text)
+                elif ftype == HISTORY:
+                    self._store_replay(payload)
+                elif ftype == PING:
+                    self.mux.send(ACK, bytes(payload))
+                elif ftype == ACK:
+                    probe = self.probe
+                    if probe and probe.on_ack(payload):
+                        continue
+                    sent = self._ping_sent.pop(bytes(payload), None)
+                    if sent is not None:
+                        print(f"\n[Ping] {(time.perf_counter() - sent) * 1000:.1f} ms")
+                elif ftype == FILE_OFFER:
+                    name, _, size = str(payload, 'utf-8', 'replace').partition('|')
+                    print(f"\n[Remote] is sending {name} ({size} bytes)")
+                elif ftype == CONTROL and bytes(payload) == b'bye':
+                    break
+                elif ftype == CONTROL and bytes(payload[:5]) == b'link ' and self.link == 'auto':
+                    try:
+                        rtt, bandwidth = map(float, bytes(payload[5:]).split())
+                    except ValueError:
+                        continue
+                    self._adopt_link(rtt, bandwidth)
+                elif ftype == CONTROL and bytes(payload[:5]) == b'sink ':
+                    self.remote_sink = bytes(payload[5:]) == b'1'
+                elif ftype == CONTROL and bytes(payload[:8]) == b'history ':
+                    self._open_history(str(payload[8:], 'ascii', 'replace'))
+                elif ftype == CONTROL and bytes(payload[:6]) == b'since ':
+                    self._catch_up(*bytes(payload[6:]).split())
+                elif ftype == CONTROL and bytes(payload) == b'replayed':
+                    self._replay_done()
+        except (OSError, ValueError):
             pass
         finally:
             self.connected = False
+            self._stop_mirrors()
+            if self.history:
+                self.history.close()
+            self.mux.close_all()
             print("\nDisconnected from remote peer.")
 
     def _input_loop(self):
         print("\n--- Chat ready ---")
-        print("Commands: /sendfile <path>  |  /quit")
+        print("Commands: /sendfile [-p N] <file|directory|glob>  |  /sendstream <name> <command>  |  "
+              "/sink file|stdout|run <command>  |  /mirror [stop] <directory>  |  /history [n]  |  /queue  |  /pause, /resume, /cancel <id|all>  |  "
+              "/limit total|peer <KB/s> or transfers <n>  |  /ping  |  /quit")
         while self.connected and self.running:
             try:
                 msg = input()
                 if msg.startswith("/sendfile"):
-                    parts = msg.split(maxsplit=1)
-                    if len(parts) == 2:
-                        self._send_file(parts[1])
-                    else:
-                        print("Usage: /sendfile <filepath>")
+                    self._queue_send(msg[len("/sendfile"):].strip())
+                elif msg.startswith("/sendstream"):
+                    self._queue_stream(msg[len("/sendstream"):].split(maxsplit=1))
+                elif msg.startswith("/sink"):
+                    self._set_sink(msg[len("/sink"):].split(maxsplit=1))
+                elif msg.startswith("/mirror"):
+                    self._mirror(msg[len("/mirror"):].strip())
+                elif msg.split(' ', 1)[0] == "/history":
+                    self._show_history(msg[len("/history"):].strip())
+                elif msg == "/queue":
+                    self._show_queue()
+                elif msg.split(' ', 1)[0] in ("/pause", "/resume", "/cancel"):
+                    self._control_jobs(*msg[1:].split(maxsplit=1))
+                elif msg.startswith("/limit"):
+                    self._set_limit(msg.split()[1:])
+                elif msg == "/ping":
+                    token = os.urandom(4)
+                    self._ping_sent[token] = time.perf_counter()
+                    self.mux.send(PING, token)
                 elif msg == "/quit":
                     self._disconnect()
                     break
                 else:
-                    self.chat_socket.send((msg + "\n").encode())
+                    self._send_text(msg)
             except (KeyboardInterrupt, EOFError):
                 self._disconnect()
                 break
@@ -188,22 +383,363 @@ class Peer:
                 print(f"Send error: {e}")
                 break
 
-    def _send_file(self, filepath):
+    def _queue_send(self, args):
+        """'/sendfile [-p N] <path>': queue the transfer, higher N starts first."""
+        priority = 0
+        if args.startswith("-p "):
+            option, _, args = args[3:].lstrip().partition(' ')
+            try:
+                priority = int(option)
+            except ValueError:
+                args = ''
+        path = args.strip()
+        if not path:
+            print("Usage: /sendfile [-p N] <file|directory|glob>")
+            return
+        job = self.scheduler.submit(path, lambda job: self._send_file(path, job),
+                                    priority, peer=self.remote_ip)
+        if job.state == 'queued':
+            print(f"Queued #{job.id}: {path}")
+
+    def _queue_stream(self, args):
+        """'/sendstream <name> <command>': send the command's output, however long."""
+        if len(args) != 2:
+            print("Usage: /sendstream <name> <command>   e.g. /sendstream photos.tar tar c DCIM")
+            return
+        name, command = args
+        job = self.scheduler.submit(name, lambda job: self._send_stream(name, command, job),
+                                    peer=self.remote_ip)
+        if job.state == 'queued':
+            print(f"Queued #{job.id}: {name}")
+
+    def _set_sink(self, args):
+        """/sink file|stdout|run <command>: where incoming transfers go from now on."""
+        if args == ['file']:
+            self.sink = None
+        elif args == ['stdout']:
+            self.sink = PipeSink
+        elif len(args) == 2 and args[0] == 'run':
+            command = args[1]
+            self.sink = lambda: CommandSink(command)
+        else:
+            print("Usage: /sink file  |  /sink stdout  |  /sink run <command>   "
+                  "(the command reads the data on stdin, the name is in $PC2TERMUX_NAME)")
+            return
+        self.mux.send(CONTROL, f"sink {0 if self.sink is None else 1}")
+        print("Incoming transfers go to " + ' '.join(args))
+
+    def _mirror(self, args):
+        """'/mirror <dir>' keeps dir in sync on the peer; '/mirror stop <dir|all>'; '/mirror' lists."""
+        if not args:
+            if not self.mirrors:
+                print("Usage: /mirror <directory>  |  /mirror stop <directory|all>")
+            for root, mirror in self.mirrors.items():
+                print(f"  {root}  ({mirror.mode}, {mirror.synced} files synced)")
+            return
+        if args.split(' ', 1)[0] == 'stop':
+            target = args[len('stop'):].strip()
+            roots = list(self.mirrors) if target == 'all' else [
+                os.path.abspath(os.path.expanduser(target))]
+            for root in roots:
+                mirror = self.mirrors.pop(root, None)
+                if mirror:
+                    mirror.stop()
+                    print(f"Stopped mirroring {root}")
+            return
+        root = os.path.abspath(os.path.expanduser(args))
+        if not os.path.isdir(root):
+            print(f"Not a directory: {args}")
+            return
+        if root in self.mirrors:
+            print(f"Already mirroring {root}")
+            return
+        if self.single_files:
+            print("The host runs the async engine, which can't apply a mirror's batches")
+            return
+        if self.mirror_index is None:
+            self.mirror_index = MirrorIndex()
+        send = lambda entries, deleted: self._sync_mirror(root, entries, deleted)
+        mirror = Mirror(root, f"{self.remote_ip}:{root}", send, self.mirror_index)
+        self.mirrors[root] = mirror
+        mirror.start()
+        print(f"Mirroring {root} ({mirror.mode}); changes are sent as they settle")
+
+    def _stop_mirrors(self):
+        for mirror in self.mirrors.values():
+            mirror.running = False  # their threads see it within a second
+        self.mirrors.clear()
+
+    def _sync_mirror(self, root, entries, deleted):
+        """Queue one mirror batch and wait for it, so the mirror only records what arrived."""
         if not self.connected:
-            print("Not connected.")
+            return False, "Not connected."
+        label = os.path.basename(root)
+        run = lambda job: self._send_batch(root, job, entries, deleted)
+        job = self.scheduler.submit(f"mirror {label}", run, peer=self.remote_ip)
+        job.wait()
+        return job.state == 'done', job.message
+
+    def _send_text(self, msg):
+        """Log a chat message, then send it; one that doesn't arrive is replayed on reconnect."""
+        with self.history_lock:
+            if self.history:
+                self.history.sent.append(msg)
+            self.mux.send(TEXT, msg)
+
+    def _open_history(self, remote_id):
+        """The peer's node id arrived: open our log of it and trade last-seen numbers."""
+        try:
+            history = History(remote_id)
+        except (OSError, ValueError) as e:
+            print(f"\n[History] not kept: {e}")
+            return
+        with self.history_lock:
+            self.history = history
+            self._announced = history.sent.last_seq + 1
+            self._catching_up = []
+            self.mux.send(CONTROL, f"since {history.received.last_seq} {self._announced}")
+
+    def _catch_up(self, last_seen, next_seq):
+        """The peer has our messages up to last_seen: replay the rest of what we sent before."""
+        self._incoming_seq = int(next_seq)
+        if self.history is None:
+            return
+        start = max(int(last_seen) + 1, self._announced - CHATLOG_REPLAY_LIMIT)
+
+        def replay():
+            try:
+                for _, records in self.history.sent.raw(start, self._announced):
+                    self.mux.send(HISTORY, records)
+                self.mux.send(CONTROL, "replayed")
+            except OSError:
+                pass
+
+        threading.Thread(target=replay, daemon=True).start()
+
+    def _log_incoming(self, text):
+        if self._incoming_seq is None or self.history is None:
+            return  # the peer keeps no history, so there are no numbers to go by
+        seq, self._incoming_seq = self._incoming_seq, self._incoming_seq + 1
+        if self._catching_up is not None:
+            self._catching_up.append((seq, time.time(), text))  # logged after the replay
+        else:
+            self.history.received.append(text, seq)
+
+    def _store_replay(self, payload):
+        if self.history is None:
+            return
+        try:
+            for seq, at, text in parse_records(payload):
+                if self.history.received.append(text, seq, at):
+                    self._replay_count += 1
+                    self._replayed.append((at, text))
+                    del self._replayed[:-CHATLOG_SHOW]
+        except ValueError as e:
+            print(f"\n[History] bad replay from the peer: {e}")
+
+    def _replay_done(self):
+        """The peer's replay is complete: show it and log what arrived live meanwhile."""
+        held, self._catching_up = self._catching_up or [], None
+        if self.history is None:
+            return
+        for seq, at, text in held:
+            self.history.received.append(text, seq, at)
+        if self._replayed:
+            hidden = self._replay_count - len(self._replayed)
+            print(f"\n[History] {self._replay_count} messages you missed"
+                  + (f" (the first {hidden} are in /history):" if hidden else ":"))
+            for at, text in self._replayed:
+                print(f"  {time.strftime('%m-%d %H:%M', time.localtime(at))} [Remote]: {text}")
+            self._replayed = []
+            self._replay_count = 0
+
+    def _show_history(self, args):
+        """/history [n]: the last n messages with this peer, both directions."""
+        if self.history is None:
+            print("No history with this peer (it keeps none, or has not said who it is).")
+            return
+        n = int(args) if args.isdigit() else CHATLOG_SHOW
+        for at, mine, text in self.history.recent(n):
+            who = "You" if mine else "Remote"
+            print(f"  {time.strftime('%m-%d %H:%M', time.localtime(at))} [{who}]: {text}")
+
+    def _transfer_done(self, job, success, msg):
+        print(f"\n[#{job.id}] {msg}" if success else f"\n[#{job.id}] Failed: {msg}")
+
+    def _show_queue(self):
+        jobs = self.scheduler.active()
+        if not jobs:
+            print("  (no transfers queued)")
+        for job in jobs:
+            state = 'queued, paused' if job.state == 'queued' and job.paused else job.state
+            progress = ''
+            if job.meter is not None:
+                t = job.meter.as_dict()
+                progress = f"  {t['percent']:.0f}%" if t['percent'] is not None else f"  {t['bytes']} bytes"
+                progress += f"  {t['ewma_bps'] / 1000:.0f} KB/s"
+            print(f"  #{job.id}  {state:<15} p{job.priority}  {job.label}{progress}")
+
+    def _control_jobs(self, verb, target=''):
+        """/pause, /resume or /cancel one job by id, or all of them."""
+        if target == 'all':
+            jobs = self.scheduler.active()
+        else:
+            job = self.scheduler.jobs.get(int(target)) if target.isdigit() else None
+            if job is None:
+                print(f"Usage: /{verb} <id|all>  (see /queue)")
+                return
+            jobs = [job]
+        for job in jobs:
+            if verb == 'pause':
+                job.pause()
+            elif verb == 'resume':
+                self.scheduler.resume(job)
+            else:
+                self.scheduler.cancel(job)
+        if verb != 'cancel':
+            print(f"{verb.capitalize()}d {len(jobs)} transfer(s)")
+
+    def _set_limit(self, args):
+        """/limit total|peer <KB/s> (0 = unlimited) or /limit transfers <n>."""
+        if len(args) != 2 or args[0] not in ('total', 'peer', 'transfers') or not args[1].isdigit():
+            s = self.scheduler
+            print("Usage: /limit total|peer <KB/s>  |  /limit transfers <n>")
+            print(f"Now: total {s.bucket.rate // 1000 or 'unlimited'} KB/s, "
+                  f"peer {s.peer_rate // 1000 or 'unlimited'} KB/s, {s.max_concurrent} at once")
             return
+        value = int(args[1])
+        if args[0] == 'transfers':
+            self.scheduler.set_limits(max_concurrent=value)
+        elif args[0] == 'total':
+            self.scheduler.set_limits(rate=value * 1000)
+        else:
+            self.scheduler.set_limits(peer_rate=value * 1000)
+        print(f"Limit {args[0]} set to {value}")
+
+    def _send_file(self, filepath, job=None):
+        """Run one queued transfer; returns (success, message)."""
+        if not self.connected:
+            return False, "Not connected."
+        if not os.path.isfile(filepath):
+            if self.single_files:
+                return self._send_each(filepath, job)
+            self.mux.send(FILE_OFFER, f"{filepath}|?")
+            return self._send_batch(filepath, job)
+        filesize = os.path.getsize(filepath)
+        self.mux.send(FILE_OFFER, f"{os.path.basename(filepath)}|{filesize}")
+        meter = metrics.track('send', name=os.path.basename(filepath), total=filesize)
+        if (filesize >= STRIPE_THRESHOLD and not self.tunnel and not self.remote_sink
+                and not self.single_files):
+            connect = lambda: self._open_transfer(meter, job)
+            success, msg = FileTransfer.send_striped(connect, filepath)
+            meter.finish(success)
+            return success, msg
+        dedup = True
+        for attempt in range(1, TRANSFER_RETRIES + 1):
+            try:
+                sock = self._open_transfer(meter, job)
+                try:
+                    success, msg = FileTransfer.send_file(sock, filepath, resume=True,
+                                                          compress=True, dedup=dedup,
+                                                          verify=True)
+                finally:
+                    sock.close()
+            except Exception as e:
+                success, msg = False, str(e)
+            cancelled = job is not None and job.cancelled
+            if success or cancelled or not self.connected or attempt == TRANSFER_RETRIES:
+                break
+            if msg.startswith("Delta mismatch"):
+                dedup = False  # send it whole next time
+            print(f"Transfer interrupted ({msg}), resuming (attempt {attempt + 1}/{TRANSFER_RETRIES})...")
+            time.sleep(RETRY_DELAY * attempt)
+        meter.finish(success)
+        return success, msg
+
+    def _send_each(self, spec, job=None):
+        """Send a directory or glob file by file, for a host that refuses batches."""
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((self.remote_ip, self.file_port))
-            success, msg = FileTransfer.send_file(sock, filepath)
-            print(msg if success else f"Failed: {msg}")
-            sock.close()
+            paths = flat_paths(spec)
+        except ValueError as e:
+            return False, str(e)
+        if not paths:
+            return False, f"Nothing to send: {spec}"
+        for path in paths:
+            if job is not None and job.cancelled:
+                return False, "Cancelled"
+            success, msg = self._send_file(path, job)
+            if not success:
+                return False, f"{os.path.basename(path)}: {msg}"
+        return True, f"Sent {len(paths)} files one by one"
+
+    def _open_transfer(self, meter=None, job=None):
+        """
+        A connection for one transfer: a stream on the chat socket when
+        tunneled, else an encrypted connection to the file port. With a job
+        it is wrapped in the scheduler's rate limits.
+        """
+        if self.tunnel:
+            sock = self.mux.open_stream()  # already encrypted with the chat connection
+        else:
+            sock = netprofile.connect((self.remote_ip, self.file_port), self.profile)
+        if meter:
+            metrics.attach(sock, meter)
+        if not self.tunnel:
+            try:
+                sock = self.channel.session.secure_outgoing(sock)
+            except OSError:
+                sock.close()
+                raise
+        if job is not None:
+            job.meter = meter
+            sock = self.scheduler.wrap(sock, job)
+        return sock
+
+    def _send_stream(self, name, command, job=None):
+        """Send a command's output; a stream can't be replayed, so there are no retries."""
+        if not self.connected:
+            return False, "Not connected."
+        self.mux.send(FILE_OFFER, f"{name}|?")
+        meter = metrics.track('send', name=name)
+        try:
+            sock = self._open_transfer(meter, job)
+            try:
+                source = CommandSource(command, name)
+                success, msg = FileTransfer.send_stream(sock, source, compress=True, verify=True)
+            finally:
+                sock.close()
         except Exception as e:
-            print(f"File transfer error: {e}")
+            success, msg = False, str(e)
+        meter.finish(success)
+        return success, msg
+
+    def _send_batch(self, spec, job=None, entries=None, deleted=()):
+        """Send a directory or glob (or a mirror's changes) as one batch over a single connection."""
+        meter = metrics.track('send', name=spec)
+        try:
+            sock = self._open_transfer(meter, job)
+            try:
+                success, msg = FileTransfer.send_batch(sock, spec, compress=True,
+                                                       entries=entries, deleted=deleted)
+            finally:
+                sock.close()
+        except Exception as e:
+            success, msg = False, str(e)
+        meter.finish(success)
+        return success, msg
 
     def _disconnect(self):
         self.running = False
         self.connected = False
+        self._stop_mirrors()
+        for job in self.scheduler.active():
+            self.scheduler.cancel(job)
+        if self.progress:
+            self.progress.stop()
         if self.chat_socket:
+            try:
+                self.mux.send(CONTROL, "bye")
+            except (OSError, AttributeError):
+                pass
             self.chat_socket.close()
         print("Disconnected.")
@@ -0,0 +1,445 @@
+"""
+Package-set sync between devices.
+
+A `dpkg -l` snapshot such as dpkg_list.bck is read back and diffed
+against what this device has installed. Everything missing is installed
+in one batch: one index refresh and one install command. That replaces
+basic_software_install.sh's update + install for every single package.
+
+A target without network hosts instead. A device that has the packages
+connects with the password and pushes the cached .deb files as parallel
+streams over the encrypted chat connection (the same Mux a tunneled
+chat uses). The target then installs them, again in one batch.
+
+The package manager is passed in: Apt and Pacman run the real tools, and
+the tests use an in-memory one that records the commands it was given.
+"""
+import abc
+import os
+import queue
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import urllib.parse
+import netprofile
+from chat import Channel, CONTROL, STREAM_OPEN, client_handshake, server_handshake
+from constants import DEFAULT_PORT, PROVISION_PARALLEL, PROVISION_DIR
+from filetransfer import FileTransfer
+from mux import Mux
+from streams import FileSink
+from utils import generate_password, get_local_ip
+
+_INSTALLED_STATES = ('ii', 'hi')  # installed, installed + held
+
+
+def parse_snapshot(lines):
+    """{name: version} of the installed packages in `dpkg -l` output."""
+    packages = {}
+    for line in lines:
+        fields = line.split(None, 3)
+        if len(fields) < 3 or fields[0] not in _INSTALLED_STATES:
+            continue
+        packages[fields[1].split(':', 1)[0]] = fields[2]  # drop a ':arch' qualifier
+    return packages
+
+
+def read_snapshot(path):
+    with open(path, encoding='utf-8', errors='replace') as f:
+        return parse_snapshot(f)
+
+
+def plan(wanted, installed):
+    """(missing names, {name: (installed, snapshot) version} for those that differ)."""
+    missing = sorted(name for name in wanted if name not in installed)
+    changed = {name: (installed[name], version) for name, version in wanted.items()
+               if name in installed and installed[name] != version}
+    return missing, changed
+
+
+def deb_name(path):
+    """(name, version) from a name_version_arch.deb file name, or None."""
+    base = os.path.basename(path)
+    if not base.endswith('.deb') or base.count('_') < 2:
+        return None
+    name, version, _ = base[:-len('.deb')].split('_', 2)
+    return name, urllib.parse.unquote(version)  # epochs are stored as %3a
+
+
+def _pick_debs(paths, wanted):
+    """{name: path} for the wanted names, preferring the snapshot's version, else the newest."""
+    picked = {}
+    for path in paths:
+        parsed = deb_name(path)
+        if parsed is None or parsed[0] not in wanted:
+            continue
+        name, version = parsed
+        current = picked.get(name)
+        if current is None or version == wanted[name] or (
+                deb_name(current)[1] != wanted[name]
+                and os.path.getmtime(path) > os.path.getmtime(current)):
+            picked[name] = path
+    return picked
+
+
+class PackageManager(abc.ABC):
+    """Every method that runs a command returns (success, message)."""
+
+    name = '?'
+
+    def refresh(self):
+        return True, ''
+
+    def installed(self):
+        return {}
+
+    def available(self, names):
+        return list(names)
+
+    @abc.abstractmethod
+    def install(self, names):
+        """Install packages by name from the repositories, in one command."""
+
+    @abc.abstractmethod
+    def install_files(self, paths):
+        """Install local package files, in one command."""
+
+    def cached(self, wanted):
+        """{name: package file} for wanted names found in the local download cache."""
+        return {}
+
+    def download(self, names, dest):
+        """Fetch package files for `names` into dest; returns {name: path}."""
+        return {}
+
+    @staticmethod
+    def _run(cmd, cwd=None):
+        env = dict(os.environ, DEBIAN_FRONTEND='noninteractive')
+        try:
+            result = subprocess.run(cmd, cwd=cwd, env=env, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, text=True)
+        except OSError as e:
+            return False, str(e)
+        return result.returncode == 0, result.stdout
+
+
+def _sudo():
+    """['sudo'] when we need it to install (not root, not Termux), else []."""
+    if 'com.termux' in os.environ.get('PREFIX', '') or not hasattr(os, 'geteuid'):
+        return []
+    if os.geteuid() == 0 or not shutil.which('sudo'):
+        return []
+    return ['sudo']
+
+
+class Apt(PackageManager):
+    """apt/dpkg, on Termux (pkg is a wrapper around it) and Debian-like systems."""
+
+    name = 'apt'
+
+    def __init__(self):
+        prefix = os.environ.get('PREFIX', '') if 'com.termux' in os.environ.get('PREFIX', '') else ''
+        self.cache_dir = os.path.join(prefix or '/', 'var/cache/apt/archives')
+        self.sudo = _sudo()
+
+    def refresh(self):
+        return self._run(self.sudo + ['apt-get', 'update'])
+
+    def installed(self):
+        ok, out = self._run(['dpkg-query', '-W', '-f', '${db:Status-Abbrev}\t${Package}\t${Version}\n'])
+        if not ok:
+            return {}
+        packages = {}
+        for line in out.splitlines():
+            fields = line.split('\t')
+            if len(fields) == 3 and fields[0].strip() in _INSTALLED_STATES:
+                packages[fields[1]] = fields[2]
+        return packages
+
+    def available(self, names):
+        """The names apt has an install candidate for, from one apt-cache call."""
+        if not names:
+            return []
+        _, out = self._run(['apt-cache', 'policy'] + list(names))
+        found, current = set(), None
+        for line in out.splitlines():
+            if line and not line[0].isspace() and line.endswith(':'):
+                current = line[:-1].split(':', 1)[0]
+            elif current and line.strip().startswith('Candidate:'):
+                if line.split(':', 1)[1].strip() != '(none)':
+                    found.add(current)
+        return [name for name in names if name in found]
+
+    def install(self, names):
+        return self._run(self.sudo + ['apt-get', 'install', '-y'] + list(names))
+
+    def install_files(self, paths):
+        # apt works out the order between local files (and dpkg -i would not)
+        return self._run(self.sudo + ['apt-get', 'install', '-y'] +
+                         [os.path.abspath(p) for p in paths])
+
+    def cached(self, wanted):
+        try:
+            paths = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir)]
+        except OSError:
+            return {}
+        return _pick_debs(paths, wanted)
+
+    def download(self, names, dest):
+        if names:
+            self._run(['apt-get', 'download'] + list(names), cwd=dest)
+        return _pick_debs([os.path.join(dest, f) for f in os.listdir(dest)],
+                          {name: None for name in names})
+
+
+class Pacman(PackageManager):
+    """pacman. Online installs only: pushing cached packages needs .deb files."""
+
+    name = 'pacman'
+
+    def __init__(self):
+        self.sudo = _sudo()
+
+    def refresh(self):
+        return self._run(self.sudo + ['pacman', '-Sy'])
+
+    def installed(self):
+        ok, out = self._run(['pacman', '-Q'])
+        return dict(line.split(' ', 1) for line in out.splitlines() if ' ' in line) if ok else {}
+
+    def available(self, names):
+        _, out = self._run(['pacman', '-Slq'])
+        known = set(out.split())
+        return [name for name in names if name in known]
+
+    def install(self, names):
+        return self._run(self.sudo + ['pacman', '-S', '--needed', '--noconfirm'] + list(names))
+
+    def install_files(self, paths):
+        return self._run(self.sudo + ['pacman', '-U', '--noconfirm'] + list(paths))
+
+
+def detect():
+    """The package manager of this device, like basic_software_install.sh picks it."""
+    if shutil.which('pkg') or shutil.which('apt-get'):
+        return Apt()
+    if shutil.which('pacman'):
+        return Pacman()
+    return None
+
+
+def install_missing(wanted, pm, dry_run=False):
+    """
+    Install what `wanted` ({name: version}) has and this device lacks, as
+    one batch. Returns (success, message, missing); success is False with
+    message "offline" when the index refresh fails.
+    """
+    missing, changed = plan(wanted, pm.installed())
+    if not missing:
+        return True, f"Nothing to install ({len(changed)} packages differ in version only)", []
+    if dry_run:
+        return True, f"Would install {len(missing)}: {' '.join(missing)}", missing
+    ok, out = pm.refresh()
+    if not ok:
+        return False, "offline", missing
+    installable = pm.available(missing)
+    unknown = [name for name in missing if name not in installable]
+    if installable:
+        ok, out = pm.install(installable)
+        if not ok:
+            return False, f"Install failed: {out.strip().splitlines()[-1:] or ['?']}", missing
+    note = f"; not in the repositories: {' '.join(unknown)}" if unknown else ''
+    return True, f"Installed {len(installable)} packages in one batch{note}", unknown
+
+
+def receive_packages(wanted, missing, pm, port=DEFAULT_PORT, save_dir=PROVISION_DIR,
+                     password=None):
+    """
+    Target side of an offline sync: host on `port`, tell the connecting
+    device which packages we need, take the .deb files it streams and
+    install them in one batch. Returns (success, message).
+    """
+    password = password or generate_password(4)
+    ip = get_local_ip()
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        server.bind(('', port))
+        server.listen(1)
+        print(f"Waiting for a device with the packages: python main.py provision --push {ip} "
+              f"--port {port}")
+        print(f"Password: {password}")
+        while True:
+            conn, addr = server.accept()
+            netprofile.apply(conn, netprofile.guess(addr[0]), chat=True)
+            channel = Channel(conn)
+            ok, reason = server_handshake(channel, password)
+            if ok:
+                break
+            conn.close()
+            print(f"Handshake from {addr[0]} failed: {reason}")
+    finally:
+        server.close()
+
+    received = []
+    lock = threading.Lock()
+    active = threading.Semaphore(0)
+
+    def on_stream(stream):
+        sink = FileSink(save_dir)  # remembers where the file went
+        try:
+            success, msg = FileTransfer.receive_file(stream, save_dir, sink=sink)
+            parsed = deb_name(sink.target) if success else None
+            if parsed and parsed[0] in missing:
+                with lock:
+                    received.append(sink.target)
+            elif not success:
+                print(f"  {msg}")
+        finally:
+            stream.close()
+            active.release()
+
+    mux = Mux(channel, initiator=False, on_stream=on_stream)
+    mux.send(CONTROL, "need " + ' '.join(f"{name}={wanted[name]}" for name in missing))
+    streams = 0
+    done = None
+    for ftype, payload in channel:
+        if ftype == STREAM_OPEN:  # count it before handle() starts its thread
+            streams += 1
+        if mux.handle(ftype, payload):
+            continue
+        if ftype == CONTROL and bytes(payload[:5]) == b'done ':
+            done = str(payload[5:], 'utf-8', 'replace').split()
+            break
+    for _ in range(streams):
+        active.acquire()
+    if done is None:
+        conn.close()
+        return False, f"Connection lost after {len(received)} packages"
+    print(f"Received {len(received)} package files; installing...")
+    ok, out = pm.install_files(received) if received else (True, '')
+    unavailable = done[1:]
+    message = (f"Installed {len(received)} pushed packages in one batch" if ok else
+               f"Install failed: {out.strip().splitlines()[-1:] or ['?']}")
+    if unavailable:
+        message += f"; the other device had no files for: {' '.join(unavailable)}"
+    mux.send(CONTROL, f"result {'ok' if ok else 'failed'} {message}")
+    conn.close()
+    return ok, message
+
+
+def push_packages(host, password, pm, port=DEFAULT_PORT, parallel=PROVISION_PARALLEL):
+    """
+    Source side of an offline sync: connect to a target waiting in
+    receive_packages, send it the package files it asks for from our
+    cache (downloading what the cache lacks, if we can), `parallel` at a
+    time. Returns (success, message).
+    """
+    conn = netprofile.connect((host, port), netprofile.guess(host), chat=True)
+    channel = Channel(conn)
+    ok, reason = client_handshake(channel, password)
+    if not ok:
+        conn.close()
+        return False, f"Handshake failed: {reason}"
+    mux = Mux(channel, initiator=True, on_stream=lambda stream: stream.close())
+    control = queue.Queue()
+
+    def receive_loop():
+        for ftype, payload in channel:
+            if not mux.handle(ftype, payload) and ftype == CONTROL:
+                control.put(str(payload, 'utf-8', 'replace'))
+        control.put(None)
+        mux.close_all()
+
+    threading.Thread(target=receive_loop, daemon=True).start()
+    need = control.get()
+    if not need or not need.startswith('need'):
+        conn.close()
+        return False, "Target did not say what it needs"
+    wanted = dict(item.partition('=')[::2] for item in need.split()[1:])
+    files = pm.cached(wanted)
+    download_dir = tempfile.mkdtemp(prefix='pc2termux-debs-')
+    try:
+        lacking = [name for name in wanted if name not in files]
+        if lacking:
+            print(f"{len(lacking)} packages not in the cache; trying to download them")
+            files.update(pm.download(lacking, download_dir))
+        print(f"Pushing {len(files)} of {len(wanted)} packages, {parallel} at a time")
+        jobs = queue.Queue()
+        for path in files.values():
+            jobs.put(path)
+        failures = []
+
+        def worker():
+            while True:
+                try:
+                    path = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                stream = mux.open_stream()
+                try:
+                    success, msg = FileTransfer.send_file(stream, path, verify=True)
+                finally:
+                    stream.close()
+                if not success:
+                    failures.append(f"{os.path.basename(path)}: {msg}")
+
+        workers = [threading.Thread(target=worker, daemon=True) for _ in range(parallel)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        unavailable = [name for name in wanted if name not in files]
+        mux.send(CONTROL, f"done {len(files) - len(failures)} {' '.join(unavailable)}".strip())
+        result = control.get()
+    finally:
+        shutil.rmtree(download_dir, ignore_errors=True)
+        conn.close()
+    for failure in failures:
+        print(f"  {failure}")
+    if not result or not result.startswith('result '):
+        return False, "Target did not report the install"
+    status, _, message = result[len('result '):].partition(' ')
+    return status == 'ok' and not failures, f"Target: {message}"
+
+
+def add_arguments(parser):
+    parser.add_argument('snapshot', nargs='?', help="a `dpkg -l` snapshot, e.g. dpkg_list.bck")
+    parser.add_argument('--dry-run', action='store_true', help="only list what is missing")
+    parser.add_argument('--offline', action='store_true',
+                        help="don't try the network: wait for another device to push the packages")
+    parser.add_argument('--push', metavar='HOST',
+                        help="send cached packages to a target waiting with --offline")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--parallel', type=int, default=PROVISION_PARALLEL,
+                        help="package files pushed at once")
+
+
+def run_from_args(args):
+    pm = detect()
+    if pm is None:
+        print("No supported package manager (pkg/apt/pacman) found on PATH.")
+        return
+    if args.push:
+        password = input("Enter the target's password: ").strip()
+        ok, msg = push_packages(args.push, password, pm, args.port, args.parallel)
+        print(msg)
+        return
+    if not args.snapshot:
+        print("Usage: python main.py provision <snapshot> [--dry-run | --offline]  |  "
+              "provision --push HOST")
+        return
+    wanted = read_snapshot(args.snapshot)
+    missing, _ = plan(wanted, pm.installed())
+    if not args.offline:
+        ok, msg, missing = install_missing(wanted, pm, args.dry_run)
+        print(msg)
+        if ok or msg != "offline":
+            return
+        print("No network; another device can push the packages instead.")
+    if missing:
+        ok, msg = receive_packages(wanted, missing, pm, args.port)
+        print(msg)
+    else:
+        print("Nothing to install")
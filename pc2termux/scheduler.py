@@ -0,0 +1,274 @@
+"""
+Transfer scheduler: /sendfile jobs wait in a priority queue, at most
+max_concurrent run at once, and every connection a job opens is charged
+to token buckets (one global, one per peer) so transfers share a metered
+uplink fairly and leave room for chat.
+"""
+import heapq
+import itertools
+import socket
+import threading
+import time
+from constants import (SCHED_MAX_CONCURRENT, SCHED_RATE_LIMIT, SCHED_PEER_RATE_LIMIT,
+                       SCHED_BURST, SCHED_QUANTUM)
+from netprofile import chunk_for
+
+
+class TokenBucket:
+    """
+    Reservation-style token bucket: reserve() takes tokens even if that
+    drives the balance negative and returns how long the caller must
+    sleep. Callers that come back after sleeping queue up in arrival
+    order, which shares the rate evenly. A rate of 0 means unlimited.
+    """
+
+    def __init__(self, rate=0, burst=SCHED_BURST):
+        self.lock = threading.Lock()
+        self.burst = burst
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.tokens = self.burst
+            self.stamp = time.monotonic()
+
+    def reserve(self, n):
+        with self.lock:
+            if not self.rate:
+                return 0.0
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class Job:
+    """One queued transfer. `run(job)` does the work and returns (success, message)."""
+
+    def __init__(self, jid, label, run, priority=0, peer=None):
+        self.id = jid
+        self.label = label
+        self.run = run
+        self.priority = priority
+        self.peer = peer
+        self.state = 'queued'
+        self.message = ''
+        self.meter = None
+        self.cancelled = False
+        self._resume = threading.Event()
+        self._resume.set()
+        self._done = threading.Event()
+        self._socks = []
+        self._lock = threading.Lock()
+
+    def pause(self):
+        """A running job stops at its next send; a queued one is not started."""
+        self._resume.clear()
+        if self.state == 'running':
+            self.state = 'paused'
+
+    def resume(self):
+        if self.state == 'paused':
+            self.state = 'running'
+        self._resume.set()
+
+    @property
+    def paused(self):
+        return not self._resume.is_set()
+
+    def cancel(self):
+        """Stop the job; open connections are shut down so blocked I/O returns at once."""
+        self.cancelled = True
+        self._resume.set()
+        with self._lock:
+            socks = list(self._socks)
+        for sock in socks:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, AttributeError):
+                sock.close()
+
+    def wait(self, timeout=None):
+        """Block until the job has finished (or was cancelled); True once it has."""
+        return self._done.wait(timeout)
+
+    def gate(self):
+        """Called before every send: waits while paused, raises once cancelled."""
+        if not self._resume.is_set():
+            self._resume.wait()
+        if self.cancelled:
+            raise ConnectionAbortedError("Cancelled")
+
+    def _register(self, sock):
+        with self._lock:
+            self._socks.append(sock)
+        if self.cancelled:
+            self.cancel()
+
+
+class ThrottledSocket:
+    """
+    Socket wrapper that charges sends to the job's buckets and honours
+    pause/cancel. fileno() stays available, so send_range keeps using
+    sendfile and calls throttle() before each chunk of quantum() bytes.
+    """
+
+    def __init__(self, sock, job, buckets):
+        self.sock = sock
+        self.job = job
+        self.buckets = buckets
+
+    def quantum(self):
+        return SCHED_QUANTUM if any(b.rate for b in self.buckets) else chunk_for(self.sock)
+
+    def throttle(self, n):
+        self.job.gate()
+        wait = max(b.reserve(n) for b in self.buckets)
+        if wait:
+            time.sleep(wait)
+            self.job.gate()
+
+    def sendall(self, data):
+        view = memoryview(data).cast('B')
+        step = self.quantum()
+        while view:
+            piece = view[:step]
+            self.throttle(len(piece))
+            self.sock.sendall(piece)
+            view = view[len(piece):]
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def recv_into(self, buffer, nbytes=0):
+        return self.sock.recv_into(buffer, nbytes)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def gettimeout(self):
+        return self.sock.gettimeout()
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.sock.close()
+
+
+class Scheduler:
+    """Priority queue of jobs run by at most `max_concurrent` threads."""
+
+    def __init__(self, on_done=None, max_concurrent=SCHED_MAX_CONCURRENT,
+                 rate=SCHED_RATE_LIMIT, peer_rate=SCHED_PEER_RATE_LIMIT):
+        self.on_done = on_done
+        self.max_concurrent = max_concurrent
+        self.bucket = TokenBucket(rate)
+        self.peer_rate = peer_rate
+        self.peer_buckets = {}
+        self.jobs = {}
+        self._heap = []
+        self._running = 0
+        self._ids = itertools.count(1)
+        self._seq = itertools.count()
+        self.cond = threading.Condition()
+
+    def submit(self, label, run, priority=0, peer=None):
+        """Queue `run(job)`; higher priorities start first, ties in order of submission."""
+        with self.cond:
+            job = Job(next(self._ids), label, run, priority, peer)
+            self.jobs[job.id] = job
+            heapq.heappush(self._heap, (-priority, next(self._seq), job))
+        self._dispatch()
+        return job
+
+    def _dispatch(self):
+        with self.cond:
+            deferred = []
+            while self._running < self.max_concurrent and self._heap:
+                entry = heapq.heappop(self._heap)
+                job = entry[2]
+                if job.cancelled:
+                    self._finish(job, False, "Cancelled")
+                    continue
+                if job.paused:
+                    deferred.append(entry)  # a paused queued job keeps its place
+                    continue
+                self._running += 1
+                job.state = 'running'
+                threading.Thread(target=self._run, args=(job,), daemon=True).start()
+            for entry in deferred:
+                heapq.heappush(self._heap, entry)
+
+    def _run(self, job):
+        try:
+            success, message = job.run(job)
+        except Exception as e:
+            success, message = False, str(e)
+        if job.cancelled:
+            success, message = False, "Cancelled"
+        with self.cond:
+            self._running -= 1
+        self._finish(job, success, message)
+        self._dispatch()
+
+    def _finish(self, job, success, message):
+        job.state = 'cancelled' if job.cancelled else ('done' if success else 'failed')
+        job.message = message
+        if self.on_done:
+            self.on_done(job, success, message)
+        job._done.set()
+
+    def wrap(self, sock, job):
+        """Route a connection opened for `job` through its rate limits and controls."""
+        buckets = [self.bucket]
+        if job.peer is not None:
+            with self.cond:
+                bucket = self.peer_buckets.get(job.peer)
+                if bucket is None:
+                    bucket = self.peer_buckets[job.peer] = TokenBucket(self.peer_rate)
+            buckets.append(bucket)
+        job._register(sock)
+        return ThrottledSocket(sock, job, buckets)
+
+    def set_limits(self, rate=None, peer_rate=None, max_concurrent=None):
+        if rate is not None:
+            self.bucket.set_rate(rate)
+        if peer_rate is not None:
+            self.peer_rate = peer_rate
+            with self.cond:
+                for bucket in self.peer_buckets.values():
+                    bucket.set_rate(peer_rate)
+        if max_concurrent is not None:
+            self.max_concurrent = max(1, max_concurrent)
+        self._dispatch()
+
+    def resume(self, job):
+        job.resume()
+        self._dispatch()
+
+    def cancel(self, job):
+        job.cancel()
+        with self.cond:
+            queued = job.state == 'queued'
+            if queued:
+                self._heap = [e for e in self._heap if e[2] is not job]
+                heapq.heapify(self._heap)
+        if queued:
+            self._finish(job, False, "Cancelled")
+        self._dispatch()
+
+    def active(self):
+        """Jobs not yet finished, in id order."""
+        with self.cond:
+            return [j for j in self.jobs.values()
+                    if j.state in ('queued', 'running', 'paused')]
@@ -0,0 +1,511 @@
+"""
+Session keys and encryption for chat and file connections.
+
+The chat handshake runs SPAKE2 over the RFC 3526 2048-bit MODP group.
+Both sides prove they know the password without sending it, and end up
+with a shared session key that an eavesdropper (or serveo) cannot
+derive. Each connection then gets its own keys from the session key.
+Data travels in AEAD records: a 4-byte length, then the sealed payload.
+Nonces are per-direction record counters, so they are never sent and
+never repeat.
+
+Records are sealed with ChaCha20-Poly1305 or AES-256-GCM from the
+`cryptography` package, which encryption requires. Without it nothing
+connects unless both sides start with --plaintext. That opt-in adds a
+'plaintext' cipher, least preferred and so only used when one side has
+no AEAD. The password is still checked, but the data can be read and
+altered on the way; in exchange file connections keep sendfile.
+"""
+import hashlib
+import hmac
+import importlib.util
+import os
+import secrets
+import socket
+import struct
+import threading
+from constants import CRYPTO_CIPHERS, CRYPTO_RECORD_SIZE, CRYPTO_MAX_RECORD, HANDSHAKE_TIMEOUT
+
+# RFC 3526 group 14: a safe prime, generator 2
+P = int(
+    'FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD1'
+    '29024E088A67CC74020BBEA63B139B22514A08798E3404DD'
+    'EF9519B3CD3A431B302B0A6DF25F14374FE1356D6D51C245'
+    'E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED'
+    'EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3D'
+    'C2007CB8A163BF0598DA48361C55D39A69163FA8FD24CF5F'
+    '83655D23DCA3AD961C62F356208552BB9ED529077096966D'
+    '670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B'
+    'E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9'
+    'DE2BCBF6955817183995497CEA956AE515D2261898FA0510'
+    '15728E5A8AACAA68FFFFFFFFFFFFFFFF', 16)
+G = 2
+_GROUP_BYTES = 256
+TAG = 16
+MAGIC = b'PC2E'  # first bytes of an encrypted file connection, then a 16-byte salt and a tag
+_LEN = struct.Struct('!I')
+
+
+def _group_element(label):
+    """A fixed element nobody knows the discrete log of: a hash, squared into the subgroup."""
+    h = int.from_bytes(hashlib.shake_256(label).digest(_GROUP_BYTES + 16), 'big') % P
+    return pow(h, 2, P)
+
+
+_M = _group_element(b'pc2termux SPAKE2 M')
+_N = _group_element(b'pc2termux SPAKE2 N')
+
+
+def derive(key, label):
+    """A 32-byte subkey of `key` for one purpose."""
+    return hashlib.blake2b(label, key=key, digest_size=32).digest()
+
+
+def _lp(data):
+    return len(data).to_bytes(4, 'big') + data
+
+
+class Spake2:
+    """
+    One side of a SPAKE2 exchange, without any I/O. Send message(),
+    pass the peer's message to finish(), then exchange confirm values.
+    check() tells whether the peer used the same password.
+    """
+
+    def __init__(self, password, initiator):
+        self.initiator = initiator
+        self.w = int.from_bytes(hashlib.sha256(b'pc2termux password ' + password.encode()).digest(), 'big')
+        self.x = secrets.randbits(256) | 1
+        self.element = pow(G, self.x, P) * pow(_M if initiator else _N, self.w, P) % P
+        self.key = None
+        self.confirm = None
+        self._expected = None
+
+    def message(self):
+        return self.element.to_bytes(_GROUP_BYTES, 'big').hex()
+
+    def finish(self, message, offered, cipher):
+        """
+        Derive the session key from the peer's message; raises ValueError if
+        it is malformed. The client's cipher offer and the chosen cipher
+        go into the transcript, so stripping ciphers on the way fails the
+        confirm check like a wrong password does.
+        """
+        try:
+            element = int(message, 16)
+        except ValueError:
+            raise ValueError("Malformed key exchange") from None
+        if not 1 < element < P - 1:
+            raise ValueError("Invalid key exchange value")
+        unmasked = element * pow(_N if self.initiator else _M, -self.w, P) % P
+        shared = pow(unmasked, self.x, P)
+        X, Y = (self.element, element) if self.initiator else (element, self.element)
+        transcript = b''.join(_lp(part) for part in (
+            b'pc2termux-spake2-v2', X.to_bytes(_GROUP_BYTES, 'big'), Y.to_bytes(_GROUP_BYTES, 'big'),
+            shared.to_bytes(_GROUP_BYTES, 'big'), self.w.to_bytes(32, 'big'),
+            offered.encode(), cipher.encode()))
+        keys = hashlib.blake2b(transcript, digest_size=64).digest()
+        self.key, confirm_key = keys[:32], keys[32:]
+        ours, theirs = (b'client', b'server') if self.initiator else (b'server', b'client')
+        self.confirm = hmac.new(confirm_key, ours, hashlib.sha256).hexdigest()
+        self._expected = hmac.new(confirm_key, theirs, hashlib.sha256).hexdigest()
+
+    def check(self, confirm):
+        return self._expected is not None and hmac.compare_digest(confirm, self._expected)
+
+
+PLAINTEXT = 'plaintext'
+
+_backend = None
+_allow_plaintext = False
+
+
+def _cryptography():
+    """The cryptography AEAD classes, imported on first use (slow to import)."""
+    global _backend
+    if _backend is None:
+        try:
+            from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+            from cryptography.exceptions import InvalidTag
+            _backend = {'chacha20-poly1305': ChaCha20Poly1305, 'aes-256-gcm': AESGCM,
+                        'invalid': InvalidTag}
+        except ImportError:
+            _backend = {}
+    return _backend
+
+
+def allow_plaintext():
+    """Offer unencrypted sessions too (--plaintext); the AEADs stay preferred."""
+    global _allow_plaintext
+    _allow_plaintext = True
+
+
+def plaintext_allowed():
+    return _allow_plaintext
+
+
+def available_ciphers():
+    """The ciphers this installation can use, in preference order."""
+    ciphers = [c for c in CRYPTO_CIPHERS if c in _cryptography()]
+    return ciphers + [PLAINTEXT] if _allow_plaintext else ciphers
+
+
+def check_ciphers():
+    """
+    (ok, message) for the start-up check: ok unless no session could be
+    set up at all. The message says why, or warns about --plaintext.
+    """
+    if importlib.util.find_spec('cryptography') is not None:
+        return True, ''
+    if _allow_plaintext:
+        return True, ("WARNING: the cryptography package is not installed; chat and files "
+                      "will travel UNENCRYPTED (--plaintext)")
+    return False, ("Encryption needs the cryptography package: pkg install python-cryptography "
+                   "(Termux) or pip install cryptography. Start with --plaintext to connect "
+                   "without encryption instead.")
+
+
+def plaintext_note(session):
+    """What to tell the user about a session that is not encrypted ('' when it is)."""
+    return '' if session.encrypted else " -- NOT ENCRYPTED (--plaintext)"
+
+
+def pick_cipher(offered):
+    """Our most preferred cipher among those the peer offered, or None."""
+    for cipher in available_ciphers():
+        if cipher in offered:
+            return cipher
+    return None
+
+
+class Sealer:
+    """Seals or opens the records of one direction, counting nonces."""
+
+    def __init__(self, cipher, key):
+        backend = _cryptography()
+        if cipher not in CRYPTO_CIPHERS or cipher not in backend:
+            raise ValueError(f"Cipher {cipher} is not available")
+        self.aead = backend[cipher](key)
+        self.invalid = backend['invalid']
+        self.seq = 0
+
+    def _nonce(self):
+        nonce = self.seq.to_bytes(12, 'big')
+        self.seq += 1
+        return nonce
+
+    def seal(self, data):
+        """Returns (header, sealed) for one record of `data`."""
+        head = _LEN.pack(len(data) + TAG)
+        return head, self.aead.encrypt(self._nonce(), data, head)
+
+    def open(self, head, sealed):
+        try:
+            return self.aead.decrypt(self._nonce(), sealed, head)
+        except self.invalid:
+            raise ConnectionError("Record failed authentication") from None
+
+
+class Session:
+    """The outcome of a handshake: a session key and the agreed cipher."""
+
+    def __init__(self, key, cipher):
+        self.key = key
+        self.cipher = cipher
+
+    @property
+    def encrypted(self):
+        return self.cipher != PLAINTEXT
+
+    def keys(self, label, initiator):
+        """(send key, receive key) for one connection."""
+        c2s = derive(self.key, label + b' c2s')
+        s2c = derive(self.key, label + b' s2c')
+        return (c2s, s2c) if initiator else (s2c, c2s)
+
+    def wrap(self, sock, label, initiator, pending=b''):
+        """`sock` sealed with this connection's keys; as it is for a plaintext session."""
+        if not self.encrypted:
+            return sock
+        send_key, recv_key = self.keys(label, initiator)
+        return SecureSocket(sock, Sealer(self.cipher, send_key), Sealer(self.cipher, recv_key),
+                            pending=pending)
+
+    def file_tag(self, salt):
+        """Proves that a file connection was opened by the holder of this session."""
+        return derive(self.key, b'file auth ' + salt)[:TAG]
+
+    def secure_outgoing(self, sock):
+        """Start an encrypted file connection on a freshly connected socket."""
+        salt = os.urandom(16)
+        sock.sendall(MAGIC + salt + self.file_tag(salt))
+        return self.wrap(sock, b'file ' + salt, initiator=True)
+
+
+_PREAMBLE = len(MAGIC) + 16 + TAG
+
+
+def _match_preamble(preamble, sessions):
+    """(session, salt) of the session that opened a file connection; raises ConnectionError."""
+    if not preamble.startswith(MAGIC):
+        raise ConnectionError("Unencrypted or unknown transfer refused")
+    salt, tag = preamble[len(MAGIC):-TAG], preamble[-TAG:]
+    for session in sessions:
+        if hmac.compare_digest(tag, session.file_tag(salt)):
+            return session, salt
+    raise ConnectionError("Transfer refused: not from a connected peer")
+
+
+def secure_incoming(sock, sessions):
+    """
+    Accept an encrypted file connection opened by the peer of one of
+    `sessions` (a host has one, a hub one per member), decrypted with
+    that session's keys; raises ConnectionError for anything else.
+    """
+    preamble = b''
+    timeout = sock.gettimeout()
+    sock.settimeout(HANDSHAKE_TIMEOUT)
+    try:
+        while len(preamble) < _PREAMBLE:
+            chunk = sock.recv(_PREAMBLE - len(preamble))
+            if not chunk:
+                raise ConnectionError("Connection closed before the preamble")
+            preamble += chunk
+    finally:
+        sock.settimeout(timeout)
+    session, salt = _match_preamble(preamble, sessions)
+    return session.wrap(sock, b'file ' + salt, initiator=False)
+
+
+class SecureSocket:
+    """
+    AEAD record layer over a connected socket, with the socket methods
+    FileTransfer and Channel use. It deliberately has no fileno(): sendfile
+    would bypass the encryption, so send_range falls back to its copy
+    loop, which reads into one reused buffer of record_size and hands us
+    whole records. Records are sent as header + sealed payload with
+    sendmsg, without joining them. Incoming records are read into one
+    reused buffer and opened straight from it. Losing zero-copy costs a
+    read and a seal per byte; `python bench.py crypto` measures it against
+    sendfile. Plaintext sessions are never wrapped and keep sendfile.
+    """
+
+    def __init__(self, sock, sender, receiver, record_size=CRYPTO_RECORD_SIZE, pending=b''):
+        self.sock = sock
+        self.sender = sender
+        self.receiver = receiver
+        self.record_size = record_size
+        self._send_lock = threading.Lock()  # record order on the wire must match the nonces
+        self._pending = bytearray(pending)  # raw bytes read before we took over
+        self._raw = bytearray(record_size + TAG)
+        self._plain = memoryview(b'')
+
+    def sendall(self, data):
+        view = memoryview(data).cast('B')
+        with self._send_lock:
+            for i in range(0, len(view), self.record_size):
+                self._send_parts(self.sender.seal(view[i:i + self.record_size]))
+
+    def _send_parts(self, parts):
+        if not hasattr(self.sock, 'sendmsg'):
+            self.sock.sendall(b''.join(parts))
+            return
+        parts = [memoryview(part) for part in parts]
+        while parts:
+            n = self.sock.sendmsg(parts)
+            while parts and n >= len(parts[0]):
+                n -= len(parts[0])
+                parts.pop(0)
+            if parts:
+                parts[0] = parts[0][n:]
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def _fill(self, n):
+        """
+        Read n raw bytes into the reused buffer; False on a clean EOF before
+        any. After a timeout the bytes read so far are kept for the retry.
+        """
+        if len(self._raw) < n:
+            self._raw = bytearray(n)
+        view = memoryview(self._raw)
+        got = 0
+        if self._pending:
+            got = min(n, len(self._pending))
+            view[:got] = self._pending[:got]
+            del self._pending[:got]
+        while got < n:
+            try:
+                k = self.sock.recv_into(view[got:n])
+            except socket.timeout:
+                self._pending[0:0] = view[:got]
+                raise
+            if not k:
+                if got:
+                    raise ConnectionError("Connection closed mid-record")
+                return False
+            got += k
+        return True
+
+    def _next_record(self):
+        if not self._fill(_LEN.size):
+            return False
+        head = bytes(self._raw[:_LEN.size])
+        (length,) = _LEN.unpack(head)
+        if not TAG <= length <= CRYPTO_MAX_RECORD + TAG:
+            raise ConnectionError(f"Bad record length {length}")
+        try:
+            if not self._fill(length):
+                raise ConnectionError("Connection closed mid-record")
+        except socket.timeout:
+            self._pending[0:0] = head
+            raise
+        self._plain = memoryview(self.receiver.open(head, memoryview(self._raw)[:length]))
+        return True
+
+    def recv_into(self, buffer, nbytes=0):
+        view = memoryview(buffer).cast('B')
+        if nbytes:
+            view = view[:nbytes]
+        while not self._plain:  # skips empty records
+            if not self._next_record():
+                return 0
+        n = min(len(view), len(self._plain))
+        view[:n] = self._plain[:n]
+        self._plain = self._plain[n:]
+        return n
+
+    def recv(self, size):
+        while not self._plain:
+            if not self._next_record():
+                return b''
+        data = bytes(self._plain[:size])
+        self._plain = self._plain[len(data):]
+        return data
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def gettimeout(self):
+        return self.sock.gettimeout()
+
+    def setsockopt(self, *args):
+        self.sock.setsockopt(*args)
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncSecureReader:
+    """The asyncio counterpart of SecureSocket's receive side, for StreamReader users."""
+
+    def __init__(self, reader, receiver):
+        self.reader = reader
+        self.receiver = receiver
+        self.buf = bytearray()
+
+    async def _more(self):
+        try:
+            head = await self.reader.readexactly(_LEN.size)
+        except EOFError as e:
+            if getattr(e, 'partial', b''):
+                raise ConnectionError("Connection closed mid-record") from None
+            return False
+        (length,) = _LEN.unpack(head)
+        if not TAG <= length <= CRYPTO_MAX_RECORD + TAG:
+            raise ConnectionError(f"Bad record length {length}")
+        try:
+            sealed = await self.reader.readexactly(length)
+        except EOFError:
+            raise ConnectionError("Connection closed mid-record") from None
+        self.buf += self.receiver.open(head, sealed)
+        return True
+
+    async def readexactly(self, n):
+        while len(self.buf) < n:
+            if not await self._more():
+                import asyncio  # already loaded by the caller; kept off the chat start-up path
+                raise asyncio.IncompleteReadError(bytes(self.buf), n)
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    async def read(self, n=-1):
+        if not self.buf and not await self._more():
+            return b''
+        n = len(self.buf) if n < 0 else min(n, len(self.buf))
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    async def readline(self):
+        while b'\n' not in self.buf:
+            if not await self._more():
+                data = bytes(self.buf)
+                self.buf.clear()
+                return data
+        end = self.buf.index(b'\n') + 1
+        data = bytes(self.buf[:end])
+        del self.buf[:end]
+        return data
+
+
+class AsyncSecureWriter:
+    """
+    The asyncio counterpart of SecureSocket's send side. It has no
+    transport attribute, so loop.sendfile cannot be used on it by mistake.
+    """
+
+    def __init__(self, writer, sender, record_size=CRYPTO_RECORD_SIZE):
+        self.writer = writer
+        self.sender = sender
+        self.record_size = record_size
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        for i in range(0, len(view), self.record_size):
+            self.writer.writelines(self.sender.seal(view[i:i + self.record_size]))
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def get_extra_info(self, name, default=None):
+        return self.writer.get_extra_info(name, default)
+
+    def close(self):
+        self.writer.close()
+
+
+def wrap_streams(session, reader, writer, label, initiator):
+    if not session.encrypted:
+        return reader, writer
+    send_key, recv_key = session.keys(label, initiator)
+    return (AsyncSecureReader(reader, Sealer(session.cipher, recv_key)),
+            AsyncSecureWriter(writer, Sealer(session.cipher, send_key)))
+
+
+async def secure_outgoing_streams(session, reader, writer):
+    salt = os.urandom(16)
+    writer.write(MAGIC + salt + session.file_tag(salt))
+    await writer.drain()
+    return wrap_streams(session, reader, writer, b'file ' + salt, initiator=True)
+
+
+async def secure_incoming_streams(sessions, reader, writer):
+    try:
+        preamble = await reader.readexactly(_PREAMBLE)
+    except EOFError:
+        raise ConnectionError("Connection closed before the preamble") from None
+    session, salt = _match_preamble(preamble, sessions)
+    return wrap_streams(session, reader, writer, b'file ' + salt, initiator=False)
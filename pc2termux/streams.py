@@ -0,0 +1,221 @@
+"""
+Where received data goes, and where sent data comes from, when it isn't
+a file on disk.
+
+A sink takes the bytes of one incoming transfer. FileSink is the usual
+received_files/<name>. PipeSink writes to a binary stream (stdout).
+CommandSink feeds a command's stdin (tar -x, a decompressor).
+ConsumerSink hands an iterator of chunks to a function running on its
+own thread.
+
+A source produces an outgoing stream of unknown length: stdin, a
+command's stdout, or any iterable of bytes. FileTransfer.send_stream
+sends it in chunks.
+
+Sinks and sources are used for one transfer each. Data moves through
+one reused buffer, plus a bounded queue for consumers, so a stream of
+any length uses constant memory.
+"""
+import os
+import queue
+import subprocess
+import sys
+import threading
+from constants import STREAM_QUEUE_DEPTH
+
+
+class FileSink:
+    """Write into save_dir/<name>, removing the partial file if the transfer fails."""
+
+    def __init__(self, save_dir='received_files'):
+        self.save_dir = save_dir
+        self.target = save_dir
+        self.f = None
+
+    def open(self, name, size):
+        os.makedirs(self.save_dir, exist_ok=True)
+        self.target = os.path.join(self.save_dir, name)
+        self.f = open(self.target, 'wb')
+
+    def write(self, data):
+        self.f.write(data)
+
+    def close(self, ok):
+        """Finish the transfer; returns an error message or None."""
+        self.f.close()
+        if not ok:
+            os.remove(self.target)
+        return None
+
+
+_pipe_lock = threading.Lock()
+
+
+class PipeSink:
+    """
+    Write to a binary stream, stdout by default. Transfers into the same
+    process's pipe take turns instead of interleaving their bytes.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout.buffer
+        self.target = 'stdout' if stream is None else getattr(stream, 'name', 'pipe')
+
+    def open(self, name, size):
+        _pipe_lock.acquire()
+
+    def write(self, data):
+        self.stream.write(data)
+
+    def close(self, ok):
+        try:
+            self.stream.flush()
+        except OSError as e:
+            return str(e)
+        finally:
+            _pipe_lock.release()
+        return None
+
+
+class CommandSink:
+    """
+    Pipe into a shell command's stdin, started per transfer with the
+    file name in $PC2TERMUX_NAME. A full pipe blocks the receive loop,
+    which in turn slows the sender down.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.target = f"`{command}`"
+        self.proc = None
+
+    def open(self, name, size):
+        env = dict(os.environ, PC2TERMUX_NAME=name)
+        self.proc = subprocess.Popen(self.command, shell=True, stdin=subprocess.PIPE, env=env)
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def close(self, ok):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass  # it already exited; the status says why
+        status = self.proc.wait()
+        if status:
+            return f"{self.target} exited with status {status}"
+        return None
+
+
+class ConsumerSink:
+    """
+    Run consumer(name, chunks) on its own thread, where chunks iterates
+    over the received bytes. A generator function works too. At most
+    STREAM_QUEUE_DEPTH chunks wait for it. A consumer that stops
+    reading early fails the transfer.
+    """
+
+    _DONE = object()
+
+    def __init__(self, consumer, depth=STREAM_QUEUE_DEPTH):
+        self.consumer = consumer
+        self.target = getattr(consumer, '__name__', 'consumer')
+        self.chunks = queue.Queue(depth)
+        self.error = None
+        self.thread = None
+
+    def open(self, name, size):
+        self.thread = threading.Thread(target=self._run, args=(name,), daemon=True)
+        self.thread.start()
+
+    def _iterate(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is self._DONE:
+                return
+            yield chunk
+
+    def _run(self, name):
+        try:
+            result = self.consumer(name, self._iterate())
+            for _ in result if hasattr(result, '__next__') else ():
+                pass  # drive a generator consumer
+        except Exception as e:
+            self.error = f"{self.target} failed: {e}"
+
+    def _put(self, item):
+        while self.thread.is_alive():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def write(self, data):
+        if not self._put(bytes(data)):
+            raise BrokenPipeError(self.error or f"{self.target} stopped reading")
+
+    def close(self, ok):
+        self._put(self._DONE)
+        self.thread.join()
+        return self.error
+
+
+class StdinSource:
+    """Read a stream from stdin (or another binary stream) until EOF."""
+
+    def __init__(self, name='stdin', stream=None):
+        self.name = name
+        self.stream = stream or sys.stdin.buffer
+
+    def readinto(self, buffer):
+        # read1-style: return what has arrived instead of waiting to fill the buffer
+        read = getattr(self.stream, 'readinto1', self.stream.readinto)
+        return read(buffer) or 0
+
+    def close(self):
+        """Returns an error message or None."""
+        return None
+
+
+class CommandSource:
+    """Stream a shell command's stdout; a non-zero exit status fails the transfer."""
+
+    def __init__(self, command, name=None):
+        self.command = command
+        self.name = name or command.split()[0]
+        self.proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, bufsize=0)
+
+    def readinto(self, buffer):
+        return self.proc.stdout.readinto(buffer) or 0
+
+    def close(self):
+        self.proc.stdout.close()
+        status = self.proc.wait()
+        if status:
+            return f"`{self.command}` exited with status {status}"
+        return None
+
+
+class IterSource:
+    """Stream the bytes an iterable (e.g. a generator) yields."""
+
+    def __init__(self, chunks, name='stream'):
+        self.name = name
+        self.chunks = iter(chunks)
+        self.pending = memoryview(b'')
+
+    def readinto(self, buffer):
+        while not self.pending:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.pending = memoryview(chunk).cast('B')
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def close(self):
+        return None
@@ -1,7 +1,6 @@
 import socket
 import secrets
-import urllib.request
-import json
+from constants import PUBLIC_IP_TIMEOUT
 
 def get_local_ip():
     """Get the local IP address of this machine."""
@@ -19,17 +18,20 @@ def generate_password(length=4):
     """Generate a random hex string (2*length characters)."""
     return secrets.token_hex(length)
 
-def get_public_ip():
-    """Get your public IP via api.ipify.org (optional)."""
+def get_public_ip(timeout=PUBLIC_IP_TIMEOUT):
+    """Get your public IP via api.ipify.org (optional); gives up after `timeout` seconds."""
+    import json
+    import urllib.request  # slow to import (ssl), and only needed here
     try:
-        with urllib.request.urlopen('https://api.ipify.org?format=json') as resp:
+        with urllib.request.urlopen('https://api.ipify.org?format=json', timeout=timeout) as resp:
             data = json.loads(resp.read().decode())
             return data['ip']
     except Exception:
         return 'Unknown'
 
-def get_serveo_command(port1, port2):
+def get_serveo_command(port):
     """
-    Return the SSH command to forward two ports via serveo.net.
+    Return the SSH command to forward the chat port via serveo.net (files
+    travel over the chat connection, so it is the only port needed).
     """
-    return f"ssh -R {port1}:localhost:{port1} -R {port2}:localhost:{port2} serveo.net"
+    return f"ssh -R {port}:localhost:{port} serveo.net"
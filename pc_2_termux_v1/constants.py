@@ -1,4 +1,4 @@
 # Network settings
 DEFAULT_PORT = 5555          # port for chat
 DEFAULT_FILE_PORT = 5556     # port for file transfers
-BUFFER_SIZE = 4096           # chunk size for file transfer
+BUFFER_SIZE = 64 * 1024      # chunk size for file transfer
@@ -118,6 +118,10 @@ class Peer:
 
     def _start_chat(self):
         """Start receiver thread and then handle user input."""
+        # Chat lines are tiny: send them at once instead of waiting on Nagle,
+        # and let keepalive notice a peer that silently went away
+        self.chat_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.chat_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         # Prepare a buffered reader for incoming chat lines
         self.chat_reader = self.chat_socket.makefile('r')
         receiver = threading.Thread(target=self._receive_loop, daemon=True)
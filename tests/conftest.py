@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the modules import each other by their bare names, as main.py runs them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'pc2termux'))
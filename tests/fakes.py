@@ -0,0 +1,63 @@
+import os
+import urllib.parse
+from provision import PackageManager, deb_name
+
+
+class FakePackageManager(PackageManager):
+    """
+    In-memory stand-in. `repo` is what the network would offer, `cache`
+    maps names to package files we hold and installing any of `broken`
+    fails; every command lands in `calls`.
+    """
+
+    name = 'fake'
+
+    def __init__(self, installed=None, repo=None, cache=None, online=True, broken=()):
+        self.packages = dict(installed or {})
+        self.repo = dict(repo or {})
+        self.cache = dict(cache or {})
+        self.online = online
+        self.broken = set(broken)
+        self.calls = []
+
+    def refresh(self):
+        self.calls.append(('refresh',))
+        return self.online, '' if self.online else "Network unreachable"
+
+    def installed(self):
+        return dict(self.packages)
+
+    def available(self, names):
+        return [name for name in names if name in self.repo]
+
+    def install(self, names):
+        self.calls.append(('install', list(names)))
+        if not self.online:
+            return False, "Network unreachable"
+        if self.broken.intersection(names):
+            return False, "E: Sub-process /usr/bin/dpkg returned an error code (1)\n"
+        for name in names:
+            self.packages[name] = self.repo[name]
+        return True, f"Installed {len(names)} packages"
+
+    def install_files(self, paths):
+        self.calls.append(('install_files', sorted(os.path.basename(p) for p in paths)))
+        for path in paths:
+            name, version = deb_name(path)
+            self.packages[name] = version
+        return True, f"Installed {len(paths)} package files"
+
+    def cached(self, wanted):
+        return {name: path for name, path in self.cache.items() if name in wanted}
+
+    def download(self, names, dest):
+        self.calls.append(('download', list(names)))
+        if not self.online:
+            return {}
+        found = {}
+        for name in names:
+            if name in self.repo:
+                found[name] = os.path.join(dest, f"{name}_{urllib.parse.quote(self.repo[name])}_all.deb")
+                with open(found[name], 'wb') as f:
+                    f.write(name.encode())
+        return found
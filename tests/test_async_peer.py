@@ -0,0 +1,80 @@
+import asyncio
+import os
+import socket
+import pytest
+import async_peer
+from filetransfer import FileTransfer, flat_paths
+
+
+async def _serve_one(handler):
+    """Serve `handler(reader, writer)`; returns (server, port, future of its first result)."""
+    done = asyncio.get_running_loop().create_future()
+
+    async def on_connect(reader, writer):
+        try:
+            done.set_result(await handler(reader, writer))
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(on_connect, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1], done
+
+
+def _against_async_receiver(save_dir, send):
+    """Run `send(sock)` in a thread against async_peer.receive_file; returns both results."""
+    async def main():
+        server, port, done = await _serve_one(
+            lambda reader, writer: async_peer.receive_file(reader, writer, str(save_dir)))
+        sock = socket.create_connection(('127.0.0.1', port))
+        try:
+            sent = await asyncio.get_running_loop().run_in_executor(None, send, sock)
+        finally:
+            sock.close()
+        received = await asyncio.wait_for(done, 10)
+        server.close()
+        return sent, received
+    return asyncio.run(main())
+
+
+def test_the_async_host_announces_single_files():
+    async def main():
+        server, port, done = await _serve_one(
+            lambda reader, writer: async_peer.server_handshake(reader, writer, 'pw'))
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        client = await async_peer.client_handshake(reader, writer, 'pw')
+        writer.close()
+        host = await asyncio.wait_for(done, 10)
+        server.close()
+        return client, host
+    (ok, features, session), (host_ok, _, _) = asyncio.run(main())
+    assert ok and host_ok and session is not None
+    assert 'single' in features.split()
+
+
+def test_a_threaded_sender_delivers_a_single_file(tmp_path):
+    data = os.urandom(700000)
+    src = tmp_path / 'one.bin'
+    src.write_bytes(data)
+    sent, received = _against_async_receiver(tmp_path / 'in', lambda sock: FileTransfer.send_file(
+        sock, str(src), resume=True, compress=True, verify=True))
+    assert sent[0] and received[0], (sent, received)
+    assert (tmp_path / 'in' / 'one.bin').read_bytes() == data
+
+
+def test_batches_are_refused_cleanly(tmp_path):
+    (tmp_path / 'dir').mkdir()
+    (tmp_path / 'dir' / 'a.txt').write_bytes(b'a')
+    sent, received = _against_async_receiver(
+        tmp_path / 'in', lambda sock: FileTransfer.send_batch(sock, str(tmp_path / 'dir')))
+    assert not sent[0] and not received[0]
+    assert not (tmp_path / 'in' / 'dir').exists()
+
+
+def test_flat_paths_refuses_names_that_collide(tmp_path):
+    for rel in ('a/x.txt', 'a/y.txt', 'b/z.txt'):
+        (tmp_path / rel).parent.mkdir(exist_ok=True)
+        (tmp_path / rel).write_bytes(rel.encode())
+    assert [os.path.basename(p) for p in flat_paths(str(tmp_path))] == ['x.txt', 'y.txt', 'z.txt']
+    (tmp_path / 'b' / 'x.txt').write_bytes(b'again')
+    with pytest.raises(ValueError):
+        flat_paths(str(tmp_path))
@@ -0,0 +1,103 @@
+import os
+import socket
+import threading
+import pytest
+from chat import CONTROL, PING, TEXT, Channel, FrameParser, encode_frame
+from filetransfer import FileTransfer
+from mux import Mux
+
+def test_frames_split_across_reads_are_reassembled():
+    frames = [(TEXT, b'hi'), (CONTROL, b''), (PING, os.urandom(200000)), (TEXT, 'ünïcode')]
+    wire = b''.join(encode_frame(t, p) for t, p in frames)
+    parser = FrameParser(size=16)
+    got = []
+    for i in range(0, len(wire), 7):
+        parser.feed(wire[i:i + 7])
+        got += [(t, bytes(p)) for t, p in parser.frames()]
+    assert got == [(t, p.encode() if isinstance(p, str) else p) for t, p in frames]
+
+def test_oversized_frames_are_rejected():
+    parser = FrameParser(max_frame=1000)
+    parser.feed(encode_frame(TEXT, b'x' * 1001))
+    with pytest.raises(ValueError):
+        list(parser.frames())
+
+def test_channel_round_trip_and_eof():
+    a, b = socket.socketpair()
+    left, right = Channel(a), Channel(b)
+    threading.Thread(target=lambda: (left.send_text("hello"),
+                                     left.send_parts(CONTROL, b'verb ', b'args'),
+                                     left.send(PING, b'\x00' * 100000))).start()
+    received = []
+    for _ in range(3):
+        ftype, payload = right.recv()
+        received.append((ftype, bytes(payload)))
+    assert received == [(TEXT, b"hello"), (CONTROL, b"verb args"), (PING, b'\x00' * 100000)]
+    a.close()
+    assert right.recv() is None
+
+def test_channel_keeps_frame_order():
+    a, b = socket.socketpair()
+    left, right = Channel(a), Channel(b)
+    sent = [(TEXT, f"message {i}".encode()) for i in range(500)]
+    threading.Thread(target=lambda: ([left.send(t, p) for t, p in sent], a.close())).start()
+    assert [(t, bytes(p)) for t, p in right] == sent
+
+def _mux_pair(on_stream):
+    a, b = socket.socketpair()
+    client, host = Channel(a), Channel(b)
+    muxes = {'client': Mux(client, True, lambda s: None),
+             'host': Mux(host, False, on_stream)}
+    chat = []
+
+    def pump(channel, mux):
+        try:
+            for ftype, payload in channel:
+                if not mux.handle(ftype, payload):
+                    chat.append((ftype, bytes(payload)))
+        except OSError:
+            pass
+        mux.close_all()
+
+    for channel, mux in ((client, muxes['client']), (host, muxes['host'])):
+        threading.Thread(target=pump, args=(channel, mux), daemon=True).start()
+    return a, b, muxes, chat
+
+def test_files_travel_over_mux_streams_next_to_chat(tmp_path):
+    data = os.urandom(3 * 1024 * 1024 + 1)
+    src = tmp_path / 'over-mux.bin'
+    src.write_bytes(data)
+    results = []
+    done = threading.Event()
+
+    def on_stream(stream):
+        results.append(FileTransfer.receive_file(stream, str(tmp_path / 'in')))
+        stream.close()
+        done.set()
+
+    a, b, muxes, chat = _mux_pair(on_stream)
+    stream = muxes['client'].open_stream()
+    sender = threading.Thread(target=lambda: results.append(
+        FileTransfer.send_file(stream, str(src), verify=True)))
+    sender.start()
+    for i in range(20):
+        muxes['client'].send(TEXT, f"chat {i}")
+    sender.join(10)
+    assert done.wait(10)
+    stream.close()
+    assert all(ok for ok, _ in results), results
+    assert (tmp_path / 'in' / 'over-mux.bin').read_bytes() == data
+    assert [p for _, p in chat] == [f"chat {i}".encode() for i in range(20)]
+    a.close()
+    b.close()
+
+def test_streams_see_end_of_stream_when_the_connection_drops():
+    opened = []
+    a, b, muxes, _ = _mux_pair(opened.append)
+    stream = muxes['client'].open_stream()
+    stream.sendall(b'partial')
+    a.shutdown(socket.SHUT_RDWR)
+    stream.settimeout(5)
+    assert stream.recv(10) == b''
+    with pytest.raises(BrokenPipeError):
+        stream.sendall(b'more')
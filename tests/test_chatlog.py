@@ -0,0 +1,118 @@
+import os
+import pytest
+import chatlog
+from chatlog import ChatLog, History, encode_record, parse_records
+
+
+def _texts(log, start=1, stop=None):
+    return [text for _, _, text in log.read(start, stop)]
+
+
+def test_records_round_trip():
+    data = encode_record(1, 10.0, "hi") + encode_record(2, 11.5, "ünï")
+    assert list(parse_records(data)) == [(1, 10.0, "hi"), (2, 11.5, "ünï")]
+    with pytest.raises(ValueError):
+        list(parse_records(data[:-1]))
+
+
+def test_append_read_and_reopen(tmp_path):
+    log = ChatLog(str(tmp_path), segment_bytes=200, index_bytes=64)
+    for i in range(100):
+        assert log.append(f"message {i}") == i + 1
+    assert log.append("old", seq=50) is None
+    assert _texts(log, 40, 43) == ["message 39", "message 40", "message 41"]
+    assert [t for _, _, t in log.tail(2)] == ["message 98", "message 99"]
+    log.close()
+
+    log = ChatLog(str(tmp_path), segment_bytes=200, index_bytes=64)
+    assert log.last_seq == 100
+    assert log.append("after restart") == 101
+    assert _texts(log, 99) == ["message 98", "message 99", "after restart"]
+    assert any(name.endswith('.logz') for name in os.listdir(tmp_path))
+
+
+def test_a_torn_tail_is_dropped_on_reopen(tmp_path):
+    log = ChatLog(str(tmp_path), segment_bytes=1 << 20, index_bytes=64)
+    for i in range(20):
+        log.append(f"message {i}")
+    log.close()
+    (active,) = [name for name in os.listdir(tmp_path) if name.endswith('.log')]
+    path = tmp_path / active
+    size = path.stat().st_size
+    with open(path, 'r+b') as f:
+        f.truncate(size - 3)  # the last record lost its end in a crash
+
+    log = ChatLog(str(tmp_path), segment_bytes=1 << 20, index_bytes=64)
+    assert log.last_seq == 19
+    assert log.append("next") == 20
+    assert _texts(log, 18) == ["message 17", "message 18", "next"]
+
+
+def test_a_torn_record_header_and_stale_index_entries_are_dropped(tmp_path):
+    log = ChatLog(str(tmp_path), segment_bytes=1 << 20, index_bytes=1)
+    for i in range(5):
+        log.append(f"m{i}")
+    log.close()
+    path = tmp_path / f"{1:020d}.log"
+    whole = path.stat().st_size
+    with open(path, 'ab') as f:
+        f.write(encode_record(6, 0.0, "torn")[:5])
+    idx = tmp_path / f"{1:020d}.idx"
+    with open(idx, 'ab') as f:
+        f.write(chatlog._INDEX.pack(6, whole))  # indexed, then the crash
+
+    log = ChatLog(str(tmp_path), segment_bytes=1 << 20, index_bytes=1)
+    assert log.last_seq == 5 and path.stat().st_size == whole
+    assert len(idx.read_bytes()) == 5 * chatlog._INDEX.size
+    log.append("m5")
+    assert _texts(log) == ["m0", "m1", "m2", "m3", "m4", "m5"]
+
+
+def test_the_oldest_segments_are_evicted(tmp_path):
+    log = ChatLog(str(tmp_path), segment_bytes=1000, max_bytes=3000)
+    for i in range(2000):
+        log.append(f"message number {i} " + "x" * (i % 50))
+    total = sum(os.path.getsize(tmp_path / name) for name in os.listdir(tmp_path))
+    assert total <= 3000 + 1000
+    kept = _texts(log)
+    assert kept and kept[-1].startswith("message number 1999 ")
+    first = int(kept[0].split()[2])
+    assert first > 0 and len(kept) == 2000 - first
+    assert _texts(log, 1, 10) == []
+
+
+def test_a_segment_left_both_compacted_and_not_is_listed_once(tmp_path):
+    log = ChatLog(str(tmp_path), segment_bytes=100)
+    for i in range(10):
+        log.append(f"msg {i}")
+    log.close()
+    sealed = tmp_path / f"{1:020d}.logz"
+    assert sealed.exists()
+    (tmp_path / f"{1:020d}.log").write_bytes(b'\x00' * 5)  # crash between replace and remove
+
+    log = ChatLog(str(tmp_path), segment_bytes=100)
+    assert log.segments == sorted(set(log.segments))
+    assert not (tmp_path / f"{1:020d}.log").exists()
+    assert _texts(log) == [f"msg {i}" for i in range(10)]
+
+
+def test_raw_batches_respect_the_frame_size(tmp_path):
+    log = ChatLog(str(tmp_path), segment_bytes=500)
+    for i in range(50):
+        log.append(f"record {i}")
+    batches = list(log.raw(5, 45, frame=100))
+    assert sum(count for count, _ in batches) == 40
+    assert all(len(data) <= 100 for _, data in batches)
+    records = [r for _, data in batches for r in parse_records(data)]
+    assert [seq for seq, _, _ in records] == list(range(5, 45))
+
+
+def test_history_merges_both_directions(tmp_path):
+    history = History('0123456789abcdef', root=str(tmp_path))
+    history.sent.append("mine", at=1.0)
+    history.received.append("theirs", seq=7, at=2.0)
+    history.sent.append("mine again", at=3.0)
+    assert history.recent(2) == [(2.0, False, "theirs"), (3.0, True, "mine again")]
+    history.close()
+    with pytest.raises(ValueError):
+        History('../../etc', root=str(tmp_path))
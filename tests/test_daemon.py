@@ -0,0 +1,96 @@
+import os
+import socket
+import threading
+import time
+import pytest
+import daemon
+from daemon import Daemon, request, split_address
+
+
+class _FakePeer:
+    """A pooled session that 'sends' by recording the path."""
+
+    def __init__(self, host, port, password):
+        self.host, self.port = host, port
+        self.secret = daemon._fingerprint(password)
+        self.tunnel = False
+        self.alive = True
+        self.busy = 0
+        self.last_used = 0
+        self.sent = []
+
+    def send(self, path, job, scheduler):
+        self.sent.append(path)
+        return (True, f"File '{path}' sent") if path != 'missing' else (False, "File not found")
+
+    def close(self):
+        self.alive = False
+
+
+@pytest.fixture
+def running(tmp_path, monkeypatch):
+    """A daemon on a socket in tmp_path whose sessions are _FakePeers."""
+    monkeypatch.setattr(daemon, 'PooledPeer', _FakePeer)
+    path = str(tmp_path / 'd.sock')
+    server = Daemon(path)
+    thread = threading.Thread(target=server.serve, daemon=True)
+    thread.start()
+    while not daemon._reachable(path):
+        assert thread.is_alive()
+        time.sleep(0.01)
+    yield server, path
+    if server.running:
+        list(request({'op': 'stop'}, path))
+    thread.join(5)
+
+
+def test_split_address():
+    assert split_address('10.0.0.2:6000') == ('10.0.0.2', 6000)
+    assert split_address('phone') == ('phone', daemon.DEFAULT_PORT)
+    with pytest.raises(ValueError):
+        split_address(':6000')
+
+
+def test_a_send_answers_per_file_then_done(running):
+    server, path = running
+    replies = list(request({'op': 'send', 'to': 'phone:6000', 'password': 'pw',
+                            'files': ['a.txt', 'missing']}, path))
+    assert replies[:2] == [{'file': 'a.txt', 'ok': True, 'message': "File 'a.txt' sent"},
+                           {'file': 'missing', 'ok': False, 'message': "File not found"}]
+    assert replies[2]['done'] and not replies[2]['ok'] and not replies[2]['reused']
+
+    replies = list(request({'op': 'send', 'to': 'phone:6000', 'files': ['b.txt']}, path))
+    assert replies[-1]['ok'] and replies[-1]['reused']  # no password needed the second time
+    assert server.pool[('phone', 6000)].sent == ['a.txt', 'missing', 'b.txt']
+    (session,) = next(request({'op': 'status'}, path))['sessions']
+    assert session['to'] == 'phone:6000' and session['busy'] == 0
+
+
+def test_sessions_need_the_right_password(running):
+    _, path = running
+    (reply,) = request({'op': 'send', 'to': 'phone', 'files': ['a']}, path)
+    assert not reply['ok'] and 'password is needed' in reply['message']
+    list(request({'op': 'send', 'to': 'phone', 'password': 'pw', 'files': ['a']}, path))
+    (reply,) = request({'op': 'send', 'to': 'phone', 'password': 'other', 'files': ['a']}, path)
+    assert not reply['ok'] and 'Wrong password' in reply['message']
+
+
+def test_bad_requests_get_an_error_line(running):
+    _, path = running
+    assert next(request({'op': 'dance'}, path)) == {'ok': False, 'message': "Unknown request 'dance'"}
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall(b'not json\n')
+    reply = sock.makefile('rb').readline()
+    sock.close()
+    assert b'"done": true' in reply and b'"ok": false' in reply
+
+
+def test_stop_closes_the_socket(running):
+    server, path = running
+    assert next(request({'op': 'stop'}, path)) == {'ok': True}
+    for _ in range(100):
+        if not os.path.exists(path):
+            break
+        time.sleep(0.02)
+    assert not os.path.exists(path) and not server.running
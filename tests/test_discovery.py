@@ -0,0 +1,81 @@
+import json
+import socket
+import threading
+import time
+import discovery
+from discovery import BeaconResponder, Cache, Discovery, describe, query_beacons
+
+
+def _free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(('', 0))
+        return s.getsockname()[1]
+
+
+def test_cache_entries_expire(tmp_path):
+    cache = Cache(str(tmp_path / 'sub' / 'discovery.json'))
+    cache.put('ip', '1.2.3.4')
+    assert Cache(cache.path).get('ip') == '1.2.3.4'
+    cache.data['ip']['at'] = time.time() - 100
+    assert cache.get('ip', ttl=50) is None and cache.get('missing') is None
+
+
+def test_beacon_replies_are_parsed_and_filtered():
+    port = _free_udp_port()
+    host = BeaconResponder(lambda: {'port': 6000, 'file_port': 6001, 'name': 'desk', 'hub': True},
+                           port=port)
+    ours = BeaconResponder(lambda: {'port': 7000}, port=port)
+    silent = BeaconResponder(lambda: None, port=port)
+    try:
+        found = query_beacons('127.0.0.1', timeout=0.5, exclude=ours.id, port=port)
+    finally:
+        for responder in (host, ours, silent):
+            responder.close()
+    (peer,) = found
+    ip = peer.pop('ip')  # the broadcast answer may come from any local address
+    assert peer == {'port': 6000, 'file_port': 6001, 'name': 'desk', 'hub': True, 'via': 'beacon'}
+    assert describe(dict(peer, ip=ip)) == f"{ip}:6000  desk  (hub)  [beacon]"
+
+
+def test_replies_from_other_services_are_ignored():
+    port = _free_udp_port()
+    impostor = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    impostor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    impostor.bind(('', port))
+
+    def answer():
+        for _ in range(3):
+            try:
+                _, addr = impostor.recvfrom(512)
+            except OSError:
+                return
+            for reply in (b'not json', json.dumps([1]).encode(),
+                          json.dumps({'service': 'other', 'port': 1}).encode()):
+                impostor.sendto(reply, addr)
+
+    threading.Thread(target=answer, daemon=True).start()
+    try:
+        assert query_beacons('127.0.0.1', timeout=0.3, port=port) == []
+    finally:
+        impostor.close()
+
+
+def test_lan_peers_is_empty_until_a_lookup_starts(tmp_path, monkeypatch):
+    monkeypatch.setattr(discovery, 'sweep', lambda local_ip: [])
+    assert Discovery(Cache(str(tmp_path / 'd.json'))).lan_peers() == []
+
+
+def test_lan_peers_merges_fresh_and_remembered_peers(tmp_path, monkeypatch):
+    cache = Cache(str(tmp_path / 'd.json'))
+    cache.put('lan_peers', [{'ip': '10.0.0.5', 'port': 5555, 'via': 'beacon', 'seen': time.time() - 60},
+                            {'ip': '10.0.0.9', 'port': 5555, 'via': 'beacon', 'seen': 0}])
+    monkeypatch.setattr(discovery, 'query_beacons', lambda local_ip, exclude=None: [
+        {'ip': '10.0.0.7', 'port': 5555, 'via': 'beacon'}])
+    swept = []
+    monkeypatch.setattr(discovery, 'sweep', lambda local_ip: swept.append(local_ip) or [])
+    finder = Discovery(cache)
+    finder.find_lan_peers('10.0.0.2')
+    peers = finder.lan_peers()
+    assert [(p['ip'], p['via']) for p in peers] == [('10.0.0.7', 'beacon'), ('10.0.0.5', 'cached')]
+    assert swept == []
+    assert [p['ip'] for p in Cache(cache.path).get('lan_peers')] == ['10.0.0.7', '10.0.0.5']
@@ -0,0 +1,437 @@
+import os
+import socket
+import threading
+import time
+import pytest
+import dedup
+import filetransfer
+from filetransfer import FileTransfer
+from streams import IterSource
+
+def _transfer(send, save_dir, **receive_options):
+    """Run send(sock) against FileTransfer.receive_file over a socket pair."""
+    ours, theirs = socket.socketpair()
+    result = {}
+
+    def receive():
+        result['received'] = FileTransfer.receive_file(theirs, str(save_dir), **receive_options)
+        theirs.close()
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+    try:
+        sent = send(ours)
+    finally:
+        ours.close()
+    receiver.join(10)
+    return sent, result['received']
+
+def _write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return str(path)
+
+class _CutAfter:
+    """A socket that drops the connection once `budget` bytes have been sent."""
+
+    def __init__(self, sock, budget):
+        self.sock = sock
+        self.budget = budget
+
+    def sendall(self, data):
+        if len(data) > self.budget:
+            self.sock.sendall(bytes(data[:self.budget]))
+            self.sock.shutdown(socket.SHUT_RDWR)
+            raise ConnectionResetError("cut")
+        self.budget -= len(data)
+        self.sock.sendall(data)
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def recv_into(self, buffer, nbytes=0):
+        return self.sock.recv_into(buffer, nbytes)
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(filetransfer, 'RESUME_BLOCK_SIZE', 64 * 1024)
+    monkeypatch.setattr(filetransfer, 'STRIPE_RANGE_SIZE', 64 * 1024)
+
+@pytest.mark.parametrize('zero_copy', [True, False])
+def test_round_trip_with_and_without_sendfile(tmp_path, zero_copy):
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    src = _write(tmp_path / 'out' / 'blob.bin', data)
+    sent, received = _transfer(lambda s: FileTransfer.send_file(s, src, zero_copy=zero_copy),
+                               tmp_path / 'in')
+    assert sent[0] and received[0], (sent, received)
+    assert (tmp_path / 'in' / 'blob.bin').read_bytes() == data
+
+
+def test_a_missing_file_is_reported(tmp_path):
+    assert FileTransfer.send_file(None, str(tmp_path / 'nope')) == (False, "File not found")
+
+def test_mmap_receive_spans_several_windows(tmp_path, monkeypatch):
+    monkeypatch.setattr(filetransfer, 'MMAP_WINDOW', 1024 * 1024)
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    src = _write(tmp_path / 'out' / 'blob.bin', data)
+    sent, received = _transfer(lambda s: FileTransfer.send_file(s, src), tmp_path / 'in',
+                               use_mmap=True)
+    assert sent[0] and received[0], (sent, received)
+    assert (tmp_path / 'in' / 'blob.bin').read_bytes() == data
+
+
+def test_a_short_transfer_is_truncated_to_what_arrived(tmp_path):
+    ours, theirs = socket.socketpair()
+    ours.sendall(filetransfer._format_header('cut.bin', 1000) + b'x' * 300)
+    ours.close()
+    ok, msg = FileTransfer.receive_file(theirs, str(tmp_path))
+    assert (ok, msg) == (False, "File transfer incomplete")
+    assert (tmp_path / 'cut.bin').stat().st_size == 300
+
+def test_resume_continues_after_the_verified_blocks(tmp_path, small_blocks):
+    data = os.urandom(1024 * 1024)
+    src = _write(tmp_path / 'out' / 'blob.bin', data)
+    cut = 300 * 1024
+    sent, received = _transfer(
+        lambda s: FileTransfer.send_file(_CutAfter(s, cut), src, zero_copy=False, resume=True),
+        tmp_path / 'in')
+    assert not sent[0] and not received[0]
+    assert 'kept for resume' in received[1]
+    assert (tmp_path / 'in' / 'blob.bin.part').exists()
+
+    sent, received = _transfer(lambda s: FileTransfer.send_file(s, src, resume=True),
+                               tmp_path / 'in')
+    assert sent[0] and received[0], (sent, received)
+    start = int(sent[1].split('resumed at byte ')[1].split(')')[0])
+    assert start and start % (64 * 1024) == 0 and start <= cut
+    assert (tmp_path / 'in' / 'blob.bin').read_bytes() == data
+    assert sorted(os.listdir(tmp_path / 'in')) == ['blob.bin']
+
+def test_resume_ignores_blocks_that_changed_on_disk(tmp_path, small_blocks):
+    data = os.urandom(512 * 1024)
+    src = _write(tmp_path / 'out' / 'blob.bin', data)
+    _transfer(lambda s: FileTransfer.send_file(_CutAfter(s, 400 * 1024), src, zero_copy=False,
+                                               resume=True), tmp_path / 'in')
+    part = tmp_path / 'in' / 'blob.bin.part'
+    with open(part, 'r+b') as f:
+        f.write(b'garbage')  # the first block no longer matches its checkpoint
+    sent, received = _transfer(lambda s: FileTransfer.send_file(s, src, resume=True), tmp_path / 'in')
+    assert sent[0] and received[0], (sent, received)
+    assert 'resumed' not in sent[1]
+    assert (tmp_path / 'in' / 'blob.bin').read_bytes() == data
+
+def _stripe_server(save_dir):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(16)
+    results = []
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            threading.Thread(target=lambda c=conn: (
+                results.append(FileTransfer.receive_file(c, str(save_dir))), c.close())).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server, results
+
+@pytest.mark.parametrize('streams', [1, 3, None])
+def test_striped_round_trip(tmp_path, small_blocks, streams):
+    data = os.urandom(1024 * 1024 + 5)
+    src = _write(tmp_path / 'out' / 'big.bin', data)
+    server, results = _stripe_server(tmp_path / 'in')
+    address = server.getsockname()
+    try:
+        ok, msg = FileTransfer.send_striped(lambda: socket.create_connection(address), src,
+                                            streams=streams, max_streams=4)
+    finally:
+        server.close()
+    assert ok, msg
+    assert (tmp_path / 'in' / 'big.bin').read_bytes() == data
+    assert not (tmp_path / 'in' / 'big.bin.part').exists()
+
+def test_striping_resends_only_unacknowledged_ranges(tmp_path, small_blocks):
+    data = os.urandom(1024 * 1024)
+    src = _write(tmp_path / 'out' / 'big.bin', data)
+    server, _ = _stripe_server(tmp_path / 'in')
+    address = server.getsockname()
+    calls = []
+    wire = []
+
+    class Counting:
+        def __init__(self, sock, budget=None):
+            self.sock = sock
+            self.budget = budget
+
+        def sendall(self, data):
+            if self.budget is not None and len(data) > self.budget:
+                time.sleep(0.5)  # let the acks for what already went out arrive
+                self.sock.shutdown(socket.SHUT_RDWR)
+                raise ConnectionResetError("cut")
+            if self.budget is not None:
+                self.budget -= len(data)
+            wire.append(len(data))
+            self.sock.sendall(data)
+
+        def __getattr__(self, name):
+            return getattr(self.sock, name)
+
+    def connect():
+        calls.append(1)
+        sock = socket.create_connection(address)
+        return Counting(sock, 600 * 1024 if len(calls) == 1 else None)
+
+    try:
+        ok, msg = FileTransfer.send_striped(connect, src, streams=1, zero_copy=False)
+    finally:
+        server.close()
+    assert ok, msg
+    assert len(calls) == 2
+    assert (tmp_path / 'in' / 'big.bin').read_bytes() == data
+    assert sum(wire) < len(data) + 200 * 1024  # not the whole file twice
+
+def test_a_late_stripe_is_told_the_file_is_done(tmp_path, small_blocks):
+    data = os.urandom(256 * 1024)
+    src = _write(tmp_path / 'out' / 'big.bin', data)
+    server, _ = _stripe_server(tmp_path / 'in')
+    address = server.getsockname()
+    ids = []
+    real = filetransfer._RangeSender.__init__
+
+    def remember(self, *args):
+        real(self, *args)
+        ids.append(self.stripe_id)
+
+    filetransfer._RangeSender.__init__ = remember
+    try:
+        ok, msg = FileTransfer.send_striped(lambda: socket.create_connection(address), src,
+                                            streams=1)
+    finally:
+        filetransfer._RangeSender.__init__ = real
+    assert ok, msg
+    with socket.create_connection(address) as late:
+        late.sendall(filetransfer._format_header('big.bin', len(data), {'stripe': ids[0]}))
+        assert late.recv(100) == b"done\n"
+    server.close()
+    assert sorted(os.listdir(tmp_path / 'in')) == ['big.bin']
+
+def test_batch_round_trip(tmp_path):
+    root = tmp_path / 'out' / 'project'
+    files = {'a.txt': b'alpha', 'sub/b.bin': os.urandom(3 * 1024 * 1024),
+             'sub/deeper/c': b'', 'd.txt': b'x' * 100000}
+    for rel, data in files.items():
+        _write(root / rel, data)
+    os.chmod(root / 'a.txt', 0o600)
+    sent, received = _transfer(lambda s: FileTransfer.send_batch(s, str(root)), tmp_path / 'in')
+    assert sent == (True, f"Sent 4 files ({sum(map(len, files.values()))} bytes) from 'project'")
+    assert received[0], received
+    got = tmp_path / 'in' / 'project'
+    for rel, data in files.items():
+        assert (got / rel).read_bytes() == data
+    assert (got / 'a.txt').stat().st_mode & 0o777 == 0o600
+
+def test_batch_refuses_paths_outside_the_save_dir(tmp_path):
+    src = _write(tmp_path / 'out' / 'evil.txt', b'pwned')
+    sent, received = _transfer(
+        lambda s: FileTransfer.send_batch(s, src, entries=[(src, '../evil.txt')]),
+        tmp_path / 'in')
+    assert not received[0]
+    assert not (tmp_path / 'evil.txt').exists()
+
+def _raw_batch(save_dir, body):
+    """Send a hand-written batch body; returns (reply lines, receiver result)."""
+    ours, theirs = socket.socketpair()
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(
+        r=FileTransfer.receive_file(theirs, str(save_dir))))
+    thread.start()
+    ours.sendall(filetransfer._format_header('raw', 0, {'batch': 1}))
+    ready, _ = filetransfer._read_line(ours)
+    ours.sendall(body)
+    status, _ = filetransfer._read_line(ours)
+    thread.join(10)
+    ours.close()
+    theirs.close()
+    return (ready, status), result['r']
+
+
+def test_batch_modes_lose_setuid_setgid_and_sticky_bits(tmp_path):
+    replies, received = _raw_batch(tmp_path, b"tool|6755|5\nhello" + b"dir-ish|1777|0\nend\n")
+    assert replies == ('ready', 'ok|2') and received[0]
+    assert (tmp_path / 'tool').stat().st_mode & 0o7777 == 0o755
+    assert (tmp_path / 'dir-ish').stat().st_mode & 0o7777 == 0o777
+
+
+@pytest.mark.parametrize('entry', [b"a|rw-r--r--|5\n", b"a||5\n", b"a|644|-1\n", b"a|644\n"])
+def test_a_bad_batch_entry_is_answered_with_an_error(tmp_path, entry):
+    replies, received = _raw_batch(tmp_path, b"first|644|2\nok" + entry + b"hello" + b"end\n")
+    assert replies == ('ready', 'error: bad batch entry after 1 files')
+    assert not received[0] and 'Bad batch entry' in received[1]
+    assert not (tmp_path / 'a').exists()
+
+
+def test_compressed_round_trip(tmp_path):
+    data = b"compressible line of text\n" * 100000
+    src = _write(tmp_path / 'out' / 'log.txt', data)
+    sent, received = _transfer(lambda s: FileTransfer.send_file(s, src, compress=True),
+                               tmp_path / 'in')
+    assert sent[0] and received[0], (sent, received)
+    assert 'bytes on the wire' in sent[1]
+    assert (tmp_path / 'in' / 'log.txt').read_bytes() == data
+
+def test_compressed_batch(tmp_path):
+    root = tmp_path / 'out' / 'docs'
+    for i in range(50):
+        _write(root / f"{i}.txt", b"same old text " * 1000)
+    sent, received = _transfer(lambda s: FileTransfer.send_batch(s, str(root), compress=True),
+                               tmp_path / 'in')
+    assert sent == (True, f"Sent 50 files ({50 * 14000} bytes) from 'docs'")
+    assert received[0]
+    assert (tmp_path / 'in' / 'docs' / '49.txt').read_bytes() == b"same old text " * 1000
+
+def test_dedup_reuses_the_cached_copy_then_sends_a_delta(tmp_path):
+    data = bytearray(os.urandom(2 * 1024 * 1024))
+    src = _write(tmp_path / 'out' / 'blob.bin', bytes(data))
+    sent, received = _transfer(lambda s: FileTransfer.send_file(s, src, dedup=True),
+                               tmp_path / 'in')
+    assert sent[0] and received[0], (sent, received)
+
+    os.remove(tmp_path / 'in' / 'blob.bin')
+    sent, received = _transfer(lambda s: FileTransfer.send_file(s, src, dedup=True),
+                               tmp_path / 'in')
+    assert sent == (True, "File 'blob.bin' already on receiver (cached copy used)")
+    assert (tmp_path / 'in' / 'blob.bin').read_bytes() == data
+
+    data[1000:1010] = b'0123456789'
+    src = _write(tmp_path / 'out' / 'blob.bin', bytes(data))
+    sent, received = _transfer(lambda s: FileTransfer.send_file(s, src, dedup=True),
+                               tmp_path / 'in')
+    assert sent[0] and received[0], (sent, received)
+    assert 'rebuilt from a delta' in received[1]
+    delta_bytes = int(sent[1].split('delta of ')[1].split()[0])
+    assert delta_bytes < 256 * 1024
+    assert (tmp_path / 'in' / 'blob.bin').read_bytes() == data
+
+def test_the_digest_cache_keeps_only_the_most_recent_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(dedup, 'DIGEST_CACHE_ENTRIES', 3)
+    monkeypatch.setattr(dedup, '_digest_cache', dedup.OrderedDict())
+    paths = [_write(tmp_path / f'f{i}', bytes([i])) for i in range(5)]
+    for path in paths[:3]:
+        dedup.file_digest(path)
+    dedup.file_digest(paths[0])  # used again, so f1 is now the oldest
+    for path in paths[3:]:
+        dedup.file_digest(path)
+    assert sorted(os.path.basename(key[0]) for key in dedup._digest_cache) == ['f0', 'f3', 'f4']
+
+def test_concurrent_receives_share_one_content_store(tmp_path):
+    save_dir = tmp_path / 'in'
+    assert dedup.content_store(str(save_dir)) is dedup.content_store(str(save_dir) + '/')
+    sources = [_write(tmp_path / 'out' / f'file{i}.bin', os.urandom(20000)) for i in range(8)]
+    threads = [threading.Thread(target=_transfer, args=(
+        lambda s, src=src: FileTransfer.send_file(s, src, resume=True, dedup=True), save_dir))
+        for src in sources]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    store = dedup.ContentStore(str(save_dir))  # what a later run reads from index.json
+    assert sorted(store.index['names']) == [f'file{i}.bin' for i in range(8)]
+
+def test_empty_and_tiny_files(tmp_path):
+    for data in (b'', b'x'):
+        src = _write(tmp_path / 'out' / 'tiny', data)
+        sent, received = _transfer(lambda s: FileTransfer.send_file(s, src, verify=True),
+                                   tmp_path / 'in')
+        assert sent[0] and received == (True, "File received: tiny (verified)")
+        assert (tmp_path / 'in' / 'tiny').read_bytes() == data
+
+class _Flipping(_CutAfter):
+    """A socket that flips one bit in every large send (file data, not header lines)."""
+
+    def sendall(self, data):
+        if len(data) > 1000:
+            data = bytearray(data)
+            data[500] ^= 1
+        self.sock.sendall(data)
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_verify_catches_a_corrupted_copy(tmp_path, use_mmap):
+    data = os.urandom(512 * 1024)
+    src = _write(tmp_path / 'out' / 'blob.bin', data)
+    sent, received = _transfer(
+        lambda s: FileTransfer.send_file(_Flipping(s, 0), src, zero_copy=False, verify=True),
+        tmp_path / 'in', use_mmap=use_mmap)
+    assert not received[0] and 'Integrity check failed' in received[1]
+    assert not sent[0]
+    assert os.listdir(tmp_path / 'in') == []
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_a_corrupted_resend_keeps_the_last_good_copy(tmp_path, use_mmap):
+    old = os.urandom(300 * 1024)
+    _write(tmp_path / 'in' / 'blob.bin', old)
+    src = _write(tmp_path / 'out' / 'blob.bin', os.urandom(512 * 1024))
+    sent, received = _transfer(
+        lambda s: FileTransfer.send_file(_Flipping(s, 0), src, zero_copy=False, verify=True),
+        tmp_path / 'in', use_mmap=use_mmap)
+    assert not received[0]
+    assert (tmp_path / 'in' / 'blob.bin').read_bytes() == old
+    assert os.listdir(tmp_path / 'in') == ['blob.bin']
+
+    sent, received = _transfer(lambda s: FileTransfer.send_file(s, src, verify=True),
+                               tmp_path / 'in', use_mmap=use_mmap)
+    assert sent[0] and received == (True, "File received: blob.bin (verified)")
+    assert (tmp_path / 'in' / 'blob.bin').read_bytes() == open(src, 'rb').read()
+
+
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('verify', [False, True])
+def test_stream_framing(tmp_path, compress, verify):
+    chunks = [os.urandom(n) for n in (1, 0, 70000, 300 * 1024, 5)] + [b'tail' * 1000]
+    sent, received = _transfer(
+        lambda s: FileTransfer.send_stream(s, IterSource(chunks, 'piped'), compress, verify),
+        tmp_path / 'in')
+    assert sent[0] and received[0], (sent, received)
+    assert (tmp_path / 'in' / 'piped').read_bytes() == b''.join(chunks)
+    assert ('verified' in sent[1]) == verify
+
+def test_a_failing_stream_source_discards_the_partial_file(tmp_path):
+    def chunks():
+        yield b'partial data'
+        raise OSError("disk on fire")
+
+    class Failing(IterSource):
+        def readinto(self, buffer):
+            try:
+                return super().readinto(buffer)
+            except OSError as e:
+                self.error = str(e)
+                return 0
+
+        def close(self):
+            return getattr(self, 'error', None)
+
+    sent, received = _transfer(lambda s: FileTransfer.send_stream(s, Failing(chunks(), 'piped')),
+                               tmp_path / 'in')
+    assert not sent[0] and 'disk on fire' in sent[1]
+    assert not received[0] and 'disk on fire' in received[1]
+    assert not (tmp_path / 'in' / 'piped').exists()
+
+def test_batch_deletes(tmp_path):
+    root = tmp_path / 'out' / 'project'
+    _write(root / 'kept.txt', b'kept')
+    stale = _write(tmp_path / 'in' / 'project' / 'gone.txt', b'old')
+    old_dir = _write(tmp_path / 'in' / 'project' / 'old' / 'x', b'old')
+    sent, received = _transfer(
+        lambda s: FileTransfer.send_batch(s, str(root), entries=[],
+                                          deleted=['project/gone.txt', 'project/old/x']),
+        tmp_path / 'in')
+    assert sent == (True, "Sent 0 files (0 bytes) from 'project', deleted 2")
+    assert received[0], received
+    assert not os.path.exists(stale)
+    assert not os.path.exists(os.path.dirname(old_dir))
+    assert not os.path.exists(tmp_path / 'in' / 'project')  # emptied up to save_dir
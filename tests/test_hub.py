@@ -0,0 +1,70 @@
+import hashlib
+import os
+import socket
+import threading
+from types import SimpleNamespace
+from filetransfer import FileTransfer
+from hub import FanoutReader, Hub
+from scheduler import Scheduler
+from secure import Session, available_ciphers, secure_incoming
+
+
+def test_fanout_reads_once_for_every_consumer(tmp_path):
+    data = os.urandom(10 * 1000 + 7)
+    path = tmp_path / 'src.bin'
+    path.write_bytes(data)
+    fanout = FanoutReader(str(path), 3, chunk=1000, window=2)
+    got = {}
+
+    def consume(consumer):
+        got[consumer] = b''.join(fanout.chunks_for(consumer))
+
+    threads = [threading.Thread(target=consume, args=(c,)) for c in (0, 1)]
+    for t in threads:
+        t.start()
+    fanout.drop(2)  # this one's connection failed; the others must not wait for it
+    for t in threads:
+        t.join(10)
+    assert got == {0: data, 1: data}
+    assert fanout.chunks == {}
+    assert fanout.hexdigest() == hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+def _file_server(sessions, save_dirs):
+    """A file port that takes one encrypted transfer into each of `save_dirs`."""
+    server = socket.create_server(('127.0.0.1', 0))
+    results = []
+
+    def serve():
+        for save_dir in save_dirs:
+            conn, _ = server.accept()
+            with conn:
+                sock = secure_incoming(conn, sessions)
+                results.append(FileTransfer.receive_file(sock, str(save_dir)))
+        server.close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    return server.getsockname()[1], thread, results
+
+
+def test_send_file_fans_out_verified_as_a_scheduler_job(tmp_path):
+    data = os.urandom(3 * 1024 * 1024 + 5)
+    src = tmp_path / 'shared.bin'
+    src.write_bytes(data)
+    sessions = [Session(os.urandom(32), available_ciphers()[0]) for _ in range(2)]
+    port, server, results = _file_server(sessions, [tmp_path / 'a', tmp_path / 'b'])
+    done = []
+    peer = SimpleNamespace(file_port=port, scheduler=Scheduler(
+        on_done=lambda job, ok, msg: done.append((ok, msg))))
+    hub = Hub(peer)
+    hub.peers = {f'peer{i}': (SimpleNamespace(session=session), '127.0.0.1')
+                 for i, session in enumerate(sessions, 1)}
+
+    job = hub.send_file(str(src))
+    assert job.wait(20)
+    server.join(10)
+    assert done == [(True, "shared.bin sent to 2 peers")]
+    assert sorted(results) == [(True, "File received: shared.bin (verified)")] * 2
+    for save_dir in ('a', 'b'):
+        assert (tmp_path / save_dir / 'shared.bin').read_bytes() == data
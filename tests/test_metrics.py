@@ -0,0 +1,76 @@
+import json
+import os
+import socket
+import threading
+import urllib.request
+import metrics
+from filetransfer import FileTransfer
+from metrics import Meter, meter_for, progress_line
+
+
+class _Wrapper:
+    def __init__(self, sock):
+        self.sock = sock
+
+
+def test_rates_and_the_ewma():
+    meter = Meter('send', 'x', 10000)
+    meter.net(1000, 0.1)
+    meter.sample(meter.started + 1)
+    assert meter.rate == 1000 and meter.ewma == 1000
+    meter.net(3000, 0.1)
+    meter.sample(meter.started + 2)
+    assert meter.rate == 3000
+    assert meter.ewma == metrics.METRICS_EWMA_ALPHA * 3000 + (1 - metrics.METRICS_EWMA_ALPHA) * 1000
+    t = meter.as_dict()
+    assert t['bytes'] == 4000 and t['percent'] == 40.0 and t['eta_s'] is not None
+
+
+def test_meters_are_found_under_wrappers():
+    a, b = socket.socketpair()
+    meter = metrics.track('send', a, name='wrapped')
+    try:
+        assert meter_for(_Wrapper(_Wrapper(a))) is meter
+        assert meter_for(b) is metrics.NULL
+        assert meter_for(object()) is metrics.NULL
+    finally:
+        meter.finish(True)
+        a.close()
+        b.close()
+
+
+def test_a_transfer_is_counted_and_exported(tmp_path):
+    data = os.urandom(300000)
+    src = tmp_path / 'metered.bin'
+    src.write_bytes(data)
+    before = metrics.snapshot()['totals'].get('send_ok', {'transfers': 0, 'bytes': 0})
+    a, b = socket.socketpair()
+    meter = metrics.track('send', a)
+    receiver = threading.Thread(target=FileTransfer.receive_file, args=(b, str(tmp_path / 'in')))
+    receiver.start()
+    assert FileTransfer.send_file(a, str(src))[0]
+    assert 'metered.bin' in progress_line()
+    meter.finish(True)
+    receiver.join(10)
+    a.close()
+    b.close()
+
+    after = metrics.snapshot()['totals']['send_ok']
+    assert after == {'transfers': before['transfers'] + 1, 'bytes': before['bytes'] + len(data)}
+    text = metrics.prometheus_text()
+    assert f'pc2termux_transfers_total{{direction="send",result="ok"}} {after["transfers"]}' in text
+    assert '# TYPE pc2termux_active_transfers gauge' in text
+
+
+def test_the_http_endpoint_serves_both_formats():
+    server = metrics.serve(0)
+    port = server.server_address[1]
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics.json", timeout=5) as r:
+            assert set(json.load(r)) == {'active', 'finished', 'totals'}
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as r:
+            assert r.headers['Content-Type'].startswith('text/plain')
+            assert b'pc2termux_active_transfers' in r.read()
+    finally:
+        server.shutdown()
+        server.server_close()
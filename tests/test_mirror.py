@@ -0,0 +1,155 @@
+import os
+import socket
+import threading
+import time
+from filetransfer import FileTransfer
+from mirror import Mirror, MirrorIndex, Poller, scan
+
+
+def _write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+class _Recorder:
+    """A Mirror send() that records each batch and can be told to fail."""
+
+    def __init__(self):
+        self.batches = []
+        self.fail = False
+
+    def __call__(self, entries, deleted):
+        if self.fail:
+            return False, "peer gone"
+        self.batches.append((sorted(rel for _, rel in entries), sorted(deleted)))
+        return True, ''
+
+
+def test_index_lookups_and_directory_ranges(tmp_path):
+    index = MirrorIndex(str(tmp_path / 'index.sqlite'))
+    index.update('m', {'a/x': (1, 2, 'h1'), 'a/y': (3, 4, 'h2'), 'a0': (5, 6, 'h3'),
+                       'ab/z': (7, 8, 'h4')})
+    index.update('other', {'a/x': (9, 9, 'h9')})
+    assert index.get('m', ['a/x', 'missing']) == {'a/x': (1, 2, 'h1')}
+    assert sorted(index.under('m', 'a')) == ['a/x', 'a/y']
+    assert sorted(index.under('m', '')) == ['a/x', 'a/y', 'a0', 'ab/z']
+    index.update('m', {}, deleted=['a/x'])
+    assert index.under('m', 'a') == ['a/y']
+    assert index.get('other', ['a/x']) == {'a/x': (9, 9, 'h9')}
+    index.close()
+
+    index = MirrorIndex(str(tmp_path / 'index.sqlite'))  # kept across runs
+    assert sorted(index.under('m', '')) == ['a/y', 'a0', 'ab/z']
+
+
+def test_sync_sends_only_what_changed(tmp_path):
+    root = tmp_path / 'notes'
+    _write(root / 'a.txt', b'one')
+    _write(root / 'sub' / 'b.txt', b'two')
+    send = _Recorder()
+    mirror = Mirror(str(root), 'peer:notes', send, index=MirrorIndex(str(tmp_path / 'i.sqlite')))
+    assert mirror.sync(set(scan(str(root))))
+    assert send.batches == [(['notes/a.txt', 'notes/sub/b.txt'], [])]
+
+    assert mirror.sync({'a.txt', 'sub/b.txt'})  # nothing changed
+    os.utime(root / 'a.txt', ns=(1, 1))  # touched, same content
+    assert mirror.sync({'a.txt'})
+    assert len(send.batches) == 1
+
+    _write(root / 'a.txt', b'one, edited')
+    assert mirror.sync({'a.txt'})
+    assert send.batches[-1] == (['notes/a.txt'], [])
+
+
+def test_deleting_a_directory_deletes_its_former_contents(tmp_path):
+    root = tmp_path / 'notes'
+    for rel in ('keep.txt', 'old/a', 'old/deeper/b'):
+        _write(root / rel, rel.encode())
+    send = _Recorder()
+    mirror = Mirror(str(root), 'k', send, index=MirrorIndex(str(tmp_path / 'i.sqlite')))
+    mirror.sync(set(scan(str(root))))
+    for rel in ('old/deeper/b', 'old/a'):
+        os.remove(root / rel)
+    os.rmdir(root / 'old' / 'deeper')
+    os.rmdir(root / 'old')
+    assert mirror.sync({'old'})
+    assert send.batches[-1] == ([], ['notes/old/a', 'notes/old/deeper/b'])
+    assert mirror.index.under('k', '') == ['keep.txt']
+
+
+def test_a_failed_send_leaves_the_index_alone(tmp_path):
+    root = tmp_path / 'notes'
+    _write(root / 'a.txt', b'one')
+    send = _Recorder()
+    mirror = Mirror(str(root), 'k', send, index=MirrorIndex(str(tmp_path / 'i.sqlite')))
+    send.fail = True
+    assert not mirror.sync({'a.txt'})
+    assert mirror.index.under('k', '') == []
+    send.fail = False
+    assert mirror.sync({'a.txt'})
+    assert send.batches == [(['notes/a.txt'], [])]
+
+
+def test_a_restart_only_ships_what_changed_meanwhile(tmp_path):
+    root = tmp_path / 'notes'
+    _write(root / 'same.txt', b'same')
+    _write(root / 'edited.txt', b'v1')
+    _write(root / 'removed.txt', b'bye')
+    index_path = str(tmp_path / 'i.sqlite')
+    first = Mirror(str(root), 'k', _Recorder(), index=MirrorIndex(index_path))
+    first.sync(set(scan(str(root))))
+    first.index.close()
+
+    _write(root / 'edited.txt', b'v2')
+    os.remove(root / 'removed.txt')
+    _write(root / 'new.txt', b'new')
+    send = _Recorder()
+    mirror = Mirror(str(root), 'k', send, index=MirrorIndex(index_path), debounce=0.05)
+    mirror.start()
+    try:
+        deadline = time.monotonic() + 5
+        while not send.batches and time.monotonic() < deadline:
+            time.sleep(0.02)
+    finally:
+        mirror.stop()
+    assert send.batches[0] == (['notes/edited.txt', 'notes/new.txt'], ['notes/removed.txt'])
+
+
+def test_the_poller_reports_changes_and_deletions(tmp_path):
+    _write(tmp_path / 'a', b'1')
+    _write(tmp_path / 'b', b'2')
+    poller = Poller(str(tmp_path), interval=0)
+    _write(tmp_path / 'a', b'changed')
+    os.remove(tmp_path / 'b')
+    _write(tmp_path / 'c' / 'd', b'new')
+    assert poller.changes(None) == {'a', 'b', 'c/d'}
+    assert poller.changes(None) == set()
+
+
+def test_mirrored_batches_apply_on_the_receiver(tmp_path):
+    root = tmp_path / 'out' / 'site'
+    _write(root / 'index.html', b'<h1>hi</h1>')
+    _write(root / 'img' / 'logo.png', os.urandom(300000))
+    received = tmp_path / 'in'
+
+    def send(entries, deleted):
+        a, b = socket.socketpair()
+        result = {}
+        thread = threading.Thread(target=lambda: result.update(
+            r=FileTransfer.receive_file(b, str(received))))
+        thread.start()
+        sent = FileTransfer.send_batch(a, str(root), entries=entries, deleted=deleted)
+        thread.join(10)
+        a.close()
+        b.close()
+        assert result['r'][0], result
+        return sent
+
+    mirror = Mirror(str(root), 'k', send, index=MirrorIndex(str(tmp_path / 'i.sqlite')))
+    assert mirror.sync(set(scan(str(root))))
+    assert (received / 'site' / 'img' / 'logo.png').read_bytes() == \
+        (root / 'img' / 'logo.png').read_bytes()
+    os.remove(root / 'index.html')
+    assert mirror.sync({'index.html'})
+    assert not (received / 'site' / 'index.html').exists()
+    assert mirror.synced == 3
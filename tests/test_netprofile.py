@@ -0,0 +1,59 @@
+import socket
+import threading
+import netprofile
+from constants import SENDFILE_CHUNK
+from netprofile import KB, MB, PROFILES, LinkProbe, Profile
+
+
+def test_fit_rounds_up_to_a_power_of_two_within_bounds():
+    assert netprofile._fit(100 * KB, 64 * KB, MB) == 128 * KB
+    assert netprofile._fit(128 * KB, 64 * KB, MB) == 128 * KB
+    assert netprofile._fit(10, 64 * KB, MB) == 64 * KB
+    assert netprofile._fit(10 * MB, 64 * KB, MB) == MB
+
+
+def test_profiles_sized_from_the_bandwidth_delay_product():
+    far = Profile.for_link(rtt=0.1, bandwidth=10 * MB)  # 1 MB in flight
+    assert (far.buffer, far.lowat, far.chunk) == (2 * MB, 256 * KB, MB)
+    assert far.keepalive == PROFILES['tunnel'].keepalive
+    near = Profile.for_link(rtt=0.0005, bandwidth=100 * MB)
+    assert (near.buffer, near.lowat, near.chunk) == (256 * KB, 16 * KB, 64 * KB)
+    assert near.keepalive == PROFILES['lan'].keepalive
+
+
+def test_guesses_by_address():
+    assert netprofile.guess('127.0.0.1') is PROFILES['lan']
+    assert netprofile.guess('192.168.1.20') is PROFILES['wifi']
+    assert netprofile.guess('8.8.8.8') is PROFILES['tunnel']
+    assert netprofile.guess('127.0.0.1', tunnel=True) is PROFILES['tunnel']
+    assert netprofile.resolve('cellular', '127.0.0.1') is PROFILES['cellular']
+    assert netprofile.resolve('auto', '127.0.0.1') is PROFILES['lan']
+
+
+class _Wrapper:
+    def __init__(self, sock):
+        self.sock = sock
+
+
+def test_apply_sets_options_and_the_sendfile_chunk():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        netprofile.apply(sock, PROFILES['tunnel'], chat=True)
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        assert netprofile.chunk_for(_Wrapper(sock)) == PROFILES['tunnel'].chunk
+        netprofile.apply(object(), PROFILES['lan'])  # not a socket: left alone
+        assert netprofile.chunk_for(object()) == SENDFILE_CHUNK
+    finally:
+        sock.close()
+
+
+def test_the_link_probe_measures_rtt_and_bandwidth():
+    probe = LinkProbe(lambda payload: threading.Timer(0.01, probe.on_ack, (payload,)).start())
+    rtt, bandwidth = probe.run(timeout=2)
+    assert 0.005 < rtt < 1 and bandwidth > 0
+    assert not probe.on_ack(b'somebody else')
+
+
+def test_an_unanswered_probe_gives_up():
+    assert LinkProbe(lambda payload: None).run(timeout=0.05) is None
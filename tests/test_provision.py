@@ -0,0 +1,154 @@
+import os
+import socket
+import threading
+import pytest
+import provision
+from fakes import FakePackageManager
+
+SNAPSHOT = """\
+Desired=Unknown/Install/Remove/Purge/Hold
+| Status=Not/Inst/Conf-files/Unpacked/halF-conf/Half-inst/trig-aWait/Trig-pend
+|/ Err?=(none)/Reinst-required (Status,Err: uppercase=bad)
+||/ Name           Version        Architecture Description
++++-==============-==============-============-==========================
+ii  bash           5.3.3-1        aarch64      GNU Bourne Again SHell
+ii  curl           8.16.0         aarch64      Command line URL tool
+hi  git            2.51.0         aarch64      Version control (held)
+ii  libfoo:arm64   1.0            arm64        A library with an arch qualifier
+rc  removed        0.1            aarch64      Only its config files are left
+ii  vim            9.1.1800       aarch64      Vi IMproved
+"""
+
+REPO = {'bash': '5.3.3-1', 'curl': '8.16.0', 'git': '2.51.0', 'libfoo': '1.0', 'vim': '9.1.1800'}
+
+
+def test_parse_snapshot_keeps_installed_and_held_packages():
+    wanted = provision.parse_snapshot(SNAPSHOT.splitlines())
+    assert wanted == {'bash': '5.3.3-1', 'curl': '8.16.0', 'git': '2.51.0', 'libfoo': '1.0',
+                      'vim': '9.1.1800'}
+
+
+def test_plan_separates_missing_from_version_changes():
+    wanted = provision.parse_snapshot(SNAPSHOT.splitlines())
+    missing, changed = provision.plan(wanted, {'bash': '5.3.3-1', 'vim': '9.0'})
+    assert missing == ['curl', 'git', 'libfoo']
+    assert changed == {'vim': ('9.0', '9.1.1800')}
+
+
+def test_missing_packages_install_in_one_batch():
+    wanted = provision.parse_snapshot(SNAPSHOT.splitlines())
+    pm = FakePackageManager(installed={'bash': '5.3.3-1'}, repo=REPO)
+    ok, msg, left = provision.install_missing(wanted, pm)
+    assert ok and left == []
+    assert pm.calls == [('refresh',), ('install', ['curl', 'git', 'libfoo', 'vim'])]
+    assert "Installed 4 packages in one batch" in msg
+    assert provision.plan(wanted, pm.installed())[0] == []
+
+
+def test_nothing_runs_when_everything_is_installed():
+    wanted = provision.parse_snapshot(SNAPSHOT.splitlines())
+    pm = FakePackageManager(installed=dict(REPO, vim='9.0'), repo=REPO)
+    ok, msg, left = provision.install_missing(wanted, pm)
+    assert ok and left == [] and pm.calls == []
+    assert msg.startswith("Nothing to install (1 packages differ")
+
+
+def test_dry_run_runs_nothing():
+    wanted = provision.parse_snapshot(SNAPSHOT.splitlines())
+    pm = FakePackageManager(repo=REPO)
+    ok, msg, left = provision.install_missing(wanted, pm, dry_run=True)
+    assert ok and len(left) == 5 and pm.calls == []
+
+
+def test_packages_the_repositories_lack_are_left_out_of_the_batch():
+    wanted = provision.parse_snapshot(SNAPSHOT.splitlines())
+    pm = FakePackageManager(repo={k: v for k, v in REPO.items() if k != 'libfoo'})
+    ok, msg, left = provision.install_missing(wanted, pm)
+    assert ok and left == ['libfoo']
+    assert pm.calls == [('refresh',), ('install', ['bash', 'curl', 'git', 'vim'])]
+    assert msg.endswith("not in the repositories: libfoo")
+
+
+def test_a_failing_install_is_reported_with_the_last_output_line():
+    wanted = provision.parse_snapshot(SNAPSHOT.splitlines())
+    pm = FakePackageManager(repo=REPO, broken={'git'})
+    ok, msg, left = provision.install_missing(wanted, pm)
+    assert not ok and left == ['bash', 'curl', 'git', 'libfoo', 'vim']
+    assert len([call for call in pm.calls if call[0] == 'install']) == 1
+    assert "dpkg returned an error code" in msg
+    assert pm.installed() == {}
+
+
+def test_offline_is_reported_before_any_install():
+    wanted = provision.parse_snapshot(SNAPSHOT.splitlines())
+    pm = FakePackageManager(repo=REPO, online=False)
+    ok, msg, left = provision.install_missing(wanted, pm)
+    assert (ok, msg) == (False, 'offline') and len(left) == 5
+    assert pm.calls == [('refresh',)]
+
+
+def test_deb_names_and_picking_the_snapshot_version(tmp_path):
+    assert provision.deb_name('/x/ca-certificates_1%3a2025.09.09_all.deb') == \
+        ('ca-certificates', '1:2025.09.09')
+    assert provision.deb_name('notes.txt') is None
+    old = tmp_path / 'vim_9.0_aarch64.deb'
+    new = tmp_path / 'vim_9.2_aarch64.deb'
+    exact = tmp_path / 'vim_9.1.1800_aarch64.deb'
+    for path in (old, exact, new):
+        path.write_bytes(b'x')
+    os.utime(new, (2e9, 2e9))
+    paths = [str(old), str(exact), str(new)]
+    assert provision._pick_debs(paths, {'vim': '9.1.1800'}) == {'vim': str(exact)}
+    assert provision._pick_debs(paths, {'vim': '8.0'}) == {'vim': str(new)}
+
+
+def test_a_package_manager_must_implement_installing():
+    class Incomplete(provision.PackageManager):
+        def install(self, names):
+            return True, ''
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_offline_target_installs_pushed_packages_in_one_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(provision, 'get_local_ip', lambda: '127.0.0.1')
+    wanted = provision.parse_snapshot(SNAPSHOT.splitlines())
+    target = FakePackageManager(installed={'bash': '5.3.3-1'}, online=False)
+    missing, _ = provision.plan(wanted, target.installed())
+    cache = tmp_path / 'cache'
+    cache.mkdir()
+    held = {}
+    for name in ('curl', 'git', 'vim'):
+        held[name] = str(cache / f"{name}_{REPO[name]}_aarch64.deb")
+        with open(held[name], 'wb') as f:
+            f.write(os.urandom(50000))
+    source = FakePackageManager(cache=held, repo={'libfoo': '1.0'})
+    port = _free_port()
+    result = {}
+    receiver = threading.Thread(target=lambda: result.update(target=provision.receive_packages(
+        wanted, missing, target, port, str(tmp_path / 'debs'), password='secret')))
+    receiver.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except OSError:
+            threading.Event().wait(0.05)
+    result['source'] = provision.push_packages('127.0.0.1', 'secret', source, port, parallel=2)
+    receiver.join(10)
+    assert result['target'][0], result
+    assert result['source'][0], result
+    assert [call for call in target.calls if call[0] == 'install_files'] == [
+        ('install_files', ['curl_8.16.0_aarch64.deb', 'git_2.51.0_aarch64.deb',
+                           'libfoo_1.0_all.deb', 'vim_9.1.1800_aarch64.deb'])]
+    assert provision.plan(wanted, target.installed())[0] == []
+    for name, path in held.items():
+        saved = tmp_path / 'debs' / os.path.basename(path)
+        assert saved.read_bytes() == open(path, 'rb').read()
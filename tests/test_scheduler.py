@@ -0,0 +1,98 @@
+import os
+import socket
+import threading
+import pytest
+from filetransfer import FileTransfer
+from scheduler import Job, Scheduler, ThrottledSocket, TokenBucket
+
+
+class _Counting(TokenBucket):
+    """A limited bucket that records every reservation."""
+
+    def __init__(self):
+        super().__init__(rate=1 << 40)
+        self.charged = 0
+
+    def reserve(self, n):
+        self.charged += n
+        return super().reserve(n)
+
+
+class _NoFileno:
+    """A wrapped stream like SecureSocket or MuxStream: no fileno(), so no sendfile."""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+
+
+def test_token_bucket_reservations():
+    assert TokenBucket(0).reserve(10 ** 9) == 0.0
+    bucket = TokenBucket(rate=1000, burst=100)
+    assert bucket.reserve(100) == 0.0
+    assert bucket.reserve(100) == pytest.approx(0.1, abs=0.01)
+    assert bucket.reserve(100) == pytest.approx(0.2, abs=0.01)
+
+
+def _drain(sock, into):
+    while True:
+        data = sock.recv(1 << 16)
+        if not data:
+            return
+        into.extend(data)
+
+
+@pytest.mark.parametrize('wrap', [lambda s: s, _NoFileno], ids=['socket', 'wrapped'])
+def test_send_range_charges_each_byte_once(tmp_path, wrap):
+    data = os.urandom(1_000_000)
+    src = tmp_path / 'src.bin'
+    src.write_bytes(data)
+    a, b = socket.socketpair()
+    got = bytearray()
+    reader = threading.Thread(target=_drain, args=(b, got))
+    reader.start()
+    bucket = _Counting()
+    sock = ThrottledSocket(wrap(a), Job(1, 'test', None), [bucket])
+    with open(src, 'rb') as f:
+        assert FileTransfer.send_range(sock, f, 1000, len(data) - 1000) == len(data) - 1000
+    a.close()
+    reader.join(10)
+    b.close()
+    assert bytes(got) == data[1000:]
+    assert bucket.charged == len(data) - 1000
+
+
+def test_jobs_start_by_priority():
+    release = threading.Event()
+    order = []
+
+    def run(job):
+        order.append(job.label)
+        if job.label == 'first':
+            release.wait(5)
+        return True, ''
+
+    scheduler = Scheduler(max_concurrent=1)
+    first = scheduler.submit('first', run)
+    jobs = [scheduler.submit('low', run), scheduler.submit('high', run, priority=5),
+            scheduler.submit('low again', run)]
+    release.set()
+    assert all(job.wait(5) for job in [first] + jobs)
+    assert order == ['first', 'high', 'low', 'low again']
+
+
+def test_a_cancelled_queued_job_never_runs():
+    release = threading.Event()
+    ran = []
+    finished = []
+    scheduler = Scheduler(on_done=lambda job, ok, msg: finished.append((job.label, ok, msg)),
+                          max_concurrent=1)
+    blocker = scheduler.submit('blocker', lambda job: (release.wait(5), (True, ''))[1])
+    queued = scheduler.submit('queued', lambda job: (ran.append(job), (True, ''))[1])
+    scheduler.cancel(queued)
+    release.set()
+    assert blocker.wait(5) and queued.wait(5)
+    assert ran == [] and queued.state == 'cancelled'
+    assert ('queued', False, "Cancelled") in finished
@@ -0,0 +1,222 @@
+import os
+import socket
+import threading
+import pytest
+import secure
+from chat import (CONTROL, TEXT, Channel, FrameParser, client_handshake, encode_frame,
+                  server_handshake)
+from secure import PLAINTEXT, SecureSocket, Session, Spake2, secure_incoming
+
+pytest.importorskip('cryptography')
+
+
+def _handshake(client_password, server_password, tamper=None):
+    """Run both handshakes over socket pairs, through a frame-rewriting relay if given."""
+    if tamper is None:
+        client_sock, server_sock = socket.socketpair()
+    else:
+        client_sock, near = socket.socketpair()
+        far, server_sock = socket.socketpair()
+
+        def relay(src, dst, direction):
+            parser = FrameParser()
+            try:
+                while parser.recv_from(src):
+                    for ftype, payload in parser.frames():
+                        dst.sendall(encode_frame(ftype, tamper(bytes(payload), direction)))
+            except OSError:
+                pass
+            dst.close()
+
+        threading.Thread(target=relay, args=(near, far, 'up'), daemon=True).start()
+        threading.Thread(target=relay, args=(far, near, 'down'), daemon=True).start()
+    client, server = Channel(client_sock), Channel(server_sock)
+    result = {}
+    thread = threading.Thread(
+        target=lambda: result.update(server=server_handshake(server, server_password, 'files')))
+    thread.start()
+    result['client'] = client_handshake(client, client_password)
+    if not result['client'][0]:
+        client_sock.close()
+    thread.join(10)
+    return client, server, result
+
+
+@pytest.fixture
+def no_plaintext(monkeypatch):
+    monkeypatch.setattr(secure, '_allow_plaintext', False)
+
+
+def test_spake2_agrees_on_a_key_only_with_the_same_password():
+    a, b = Spake2('hunter2', initiator=True), Spake2('hunter2', initiator=False)
+    a.finish(b.message(), 'x,y', 'x')
+    b.finish(a.message(), 'x,y', 'x')
+    assert a.key == b.key and a.check(b.confirm) and b.check(a.confirm)
+
+    c, d = Spake2('hunter2', initiator=True), Spake2('hunter3', initiator=False)
+    c.finish(d.message(), 'x,y', 'x')
+    d.finish(c.message(), 'x,y', 'x')
+    assert c.key != d.key and not c.check(d.confirm) and not d.check(c.confirm)
+
+
+def test_spake2_confirm_covers_the_cipher_offer():
+    a, b = Spake2('pw', initiator=True), Spake2('pw', initiator=False)
+    a.finish(b.message(), 'chacha20-poly1305,aes-256-gcm', 'aes-256-gcm')
+    b.finish(a.message(), 'aes-256-gcm', 'aes-256-gcm')
+    assert not a.check(b.confirm)
+
+
+@pytest.mark.parametrize('message', ['zz', '0', '1', hex(secure.P - 1)[2:]])
+def test_spake2_rejects_bad_messages(message):
+    with pytest.raises(ValueError):
+        Spake2('pw', initiator=True).finish(message, 'x', 'x')
+
+
+def test_handshake_with_the_right_password_encrypts_the_channel(no_plaintext):
+    client, server, result = _handshake('secret', 'secret')
+    assert result == {'client': (True, 'files'), 'server': (True, '')}
+    assert client.session.key == server.session.key
+    assert client.session.cipher == server.session.cipher == 'chacha20-poly1305'
+    assert isinstance(client.sock, SecureSocket) and isinstance(server.sock, SecureSocket)
+    client.send_text("hello " * 20000)
+    ftype, payload = server.recv()
+    assert ftype == TEXT and bytes(payload) == ("hello " * 20000).encode()
+    server.send(CONTROL, "bye")
+    assert bytes(client.recv()[1]) == b"bye"
+
+
+def test_handshake_with_a_wrong_password_fails_on_both_sides(no_plaintext):
+    _, server, result = _handshake('secret', 'guess')
+    assert result['client'] == (False, "Wrong password (or the handshake was tampered with)")
+    assert result['server'][0] is False
+    assert server.session is None
+
+
+def test_stripping_the_preferred_cipher_is_detected(no_plaintext):
+    def strip(payload, direction):
+        if direction == 'up' and payload.startswith(b'spake2 '):
+            return payload.replace(b'chacha20-poly1305,', b'')
+        return payload
+
+    client, _, result = _handshake('secret', 'secret', strip)
+    assert result['client'][0] is False and 'tampered' in result['client'][1]
+    assert client.session is None
+
+
+def test_a_cipher_the_client_never_offered_is_refused(no_plaintext):
+    def swap(payload, direction):
+        if direction == 'down' and payload.startswith(b'spake2 '):
+            return payload.replace(b'chacha20-poly1305', b'rot13')
+        return payload
+
+    _, _, result = _handshake('secret', 'secret', swap)
+    assert result['client'] == (False, "Malformed handshake reply")
+
+
+def test_plaintext_only_when_opted_in(monkeypatch):
+    monkeypatch.setattr(secure, '_backend', {})  # as if cryptography were missing
+    monkeypatch.setattr(secure, '_allow_plaintext', False)
+    _, _, result = _handshake('secret', 'secret')
+    assert result['server'] == (False, "no common cipher")
+    assert result['client'] == (False, "No common cipher")
+
+    monkeypatch.setattr(secure, '_allow_plaintext', True)
+    client, server, result = _handshake('secret', 'secret')
+    assert result['client'][0] and result['server'][0]
+    assert client.session.cipher == PLAINTEXT and not client.session.encrypted
+    assert isinstance(client.sock, socket.socket)  # unwrapped, so sendfile still works
+    assert secure.plaintext_note(client.session)
+
+
+def test_encrypted_peers_prefer_an_aead_over_plaintext(monkeypatch):
+    monkeypatch.setattr(secure, '_allow_plaintext', True)
+    client, _, result = _handshake('secret', 'secret')
+    assert result['client'][0] and client.session.cipher == 'chacha20-poly1305'
+    assert secure.plaintext_note(client.session) == ''
+
+
+def _secure_pair(cipher, record_size=1024):
+    session = Session(os.urandom(32), cipher)
+    a, b = socket.socketpair()
+    left = session.wrap(a, b'test', initiator=True)
+    right = session.wrap(b, b'test', initiator=False)
+    left.record_size = right.record_size = record_size
+    return a, b, left, right
+
+
+@pytest.mark.parametrize('cipher', secure.CRYPTO_CIPHERS)
+def test_secure_socket_round_trip(cipher):
+    _, _, left, right = _secure_pair(cipher)
+    data = os.urandom(100000)
+    threading.Thread(target=lambda: (left.sendall(data), left.sendall(b'!'))).start()
+    got = bytearray()
+    while len(got) < len(data) + 1:
+        chunk = right.recv(7000)
+        assert chunk
+        got += chunk
+    assert bytes(got) == data + b'!'
+    right.sendall(b'back')
+    assert left.recv(100) == b'back'
+    left.close()
+    assert right.recv(100) == b''
+
+
+def test_secure_socket_puts_no_plaintext_on_the_wire():
+    _, b, left, _ = _secure_pair('aes-256-gcm')
+    left.sendall(b'attack at dawn' * 10)
+    assert b'attack' not in b.recv(10000)
+
+
+def test_a_tampered_record_is_rejected():
+    a, b = socket.socketpair()
+    session = Session(os.urandom(32), 'chacha20-poly1305')
+    sender = session.wrap(a, b'test', initiator=True)
+    sender.sendall(b'pay 10 euros')
+    wire = bytearray(b.recv(1000))
+    wire[-5] ^= 1  # inside the tag
+    c, d = socket.socketpair()
+    c.sendall(bytes(wire))
+    receiver = session.wrap(d, b'test', initiator=False)
+    with pytest.raises(ConnectionError):
+        receiver.recv(100)
+
+
+def test_file_connections_are_matched_to_the_session_that_opened_them():
+    sessions = [Session(os.urandom(32), 'chacha20-poly1305') for _ in range(3)]
+    a, b = socket.socketpair()
+    out = sessions[1].secure_outgoing(a)
+    out.sendall(b'file data')
+    incoming = secure_incoming(b, sessions)
+    assert incoming.recv(100) == b'file data'
+
+    stranger = Session(os.urandom(32), 'chacha20-poly1305')
+    a, b = socket.socketpair()
+    stranger.secure_outgoing(a)
+    with pytest.raises(ConnectionError, match="not from a connected peer"):
+        secure_incoming(b, sessions)
+
+    a, b = socket.socketpair()
+    a.sendall(b'name|5\n' + b'x' * 100)
+    with pytest.raises(ConnectionError, match="Unencrypted"):
+        secure_incoming(b, sessions)
+
+
+def test_files_round_trip_over_an_encrypted_connection(tmp_path):
+    from filetransfer import FileTransfer
+    session = Session(os.urandom(32), 'aes-256-gcm')
+    src = tmp_path / 'secret.bin'
+    data = os.urandom(2 * 1024 * 1024 + 3)
+    src.write_bytes(data)
+    a, b = socket.socketpair()
+    result = {}
+
+    def receive():
+        result['received'] = FileTransfer.receive_file(secure_incoming(b, [session]),
+                                                       str(tmp_path / 'in'))
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    sent = FileTransfer.send_file(session.secure_outgoing(a), str(src), verify=True)
+    thread.join(10)
+    assert sent[0] and result['received'][0], (sent, result)
+    assert (tmp_path / 'in' / 'secret.bin').read_bytes() == data